@@ -0,0 +1,179 @@
+"""Async Modbus Client module.
+
+This module provides the asyncio counterpart of `ModbusClient`, for use by the asyncio runtime.
+Writes are planned exactly as in the threaded client, then sent through pymodbus's
+`AsyncModbusTcpClient`, so that the event loop can keep handling MQTT messages while a request
+is in flight.
+
+Example:
+    Write commands from a coroutine:
+
+    ```
+    client = AsyncModbusClient(configuration, AsyncModbusTcpClient(...), error_handler)
+    await client.connect()
+    await client.write_commands(messages)
+    ```
+
+Note:
+    This module requires the `pymodbus` package to be installed.
+
+"""
+
+import asyncio
+import logging
+from typing import Callable
+
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from app.configuration import Configuration, ModbusDevice
+from app.payload_cache import PayloadCache
+from app.write_planner import WritePlanner, WriteRequest
+from app.exceptions import ModbusClientError
+from app.error_handler import ErrorHandler
+
+
+class _PooledClient:
+    def __init__(self, client: AsyncModbusTcpClient) -> None:
+        self.client = client
+        # Commands for a device are written in the order they were received
+        self.lock = asyncio.Lock()
+
+
+class AsyncModbusClient:
+    _client: AsyncModbusTcpClient
+
+    def __init__(
+        self,
+        configuration: Configuration,
+        modbus_client: AsyncModbusTcpClient,
+        error_handler: ErrorHandler,
+        client_factory: Callable[[str, int], AsyncModbusTcpClient] = None,
+    ) -> None:
+        """Create a client writing to the Modbus devices in the configuration.
+
+        `modbus_client` is used for the default device. Clients for any other devices are
+        created by `client_factory` when they are first needed.
+        """
+        self.configuration = configuration
+        self._client = modbus_client
+        self.error_handler = error_handler
+        self._modbus_settings = configuration.get_modbus_settings()
+        self._client_factory = client_factory or self._create_client
+        self._planner = WritePlanner(
+            configuration,
+            error_handler,
+            self._modbus_settings.max_coils_per_write,
+            self._modbus_settings.write_cache_max_age,
+            self._modbus_settings.payload_cache_size,
+        )
+        self._pool = {}
+        self._get_pooled_client(self._modbus_settings.get_device(), modbus_client)
+
+    def _create_client(self, host: str, port: int) -> AsyncModbusTcpClient:
+        return AsyncModbusTcpClient(
+            host,
+            port=port,
+            reconnect_delay=self._modbus_settings.reconnect_delay,
+            reconnect_delay_max=self._modbus_settings.reconnect_delay_max,
+        )
+
+    def _get_pooled_client(
+        self, device: ModbusDevice, client: AsyncModbusTcpClient = None
+    ) -> _PooledClient:
+        key = (device.host, device.port, device.unit_id)
+        if key not in self._pool:
+            self._pool[key] = _PooledClient(
+                client or self._client_factory(device.host, device.port)
+            )
+        return self._pool[key]
+
+    async def connect(self) -> bool:
+        """Connect to the default Modbus device.
+
+        Once connected, pymodbus re-establishes a lost connection by itself. If this first
+        attempt fails, another is made when the next command is written. Other devices are
+        connected when they are first written to.
+        """
+        return await self._connect(self._client)
+
+    async def _connect(self, client: AsyncModbusTcpClient) -> bool:
+        connected = await client.connect()
+        if not connected:
+            logging.warning("Unable to connect to Modbus server, will retry")
+        return connected
+
+    @property
+    def coalesced(self) -> int:
+        """The number of commands dropped because a newer one for the same action arrived."""
+        return self._planner.coalesced
+
+    @property
+    def skipped(self) -> int:
+        """The number of commands not written because they repeated the last value written."""
+        return self._planner.skipped
+
+    @property
+    def payload_cache(self) -> PayloadCache:
+        """The cache of encoded holding register values, or None if it is disabled."""
+        return self._planner.payload_cache
+
+    def close(self) -> None:
+        for pooled in self._pool.values():
+            pooled.client.close()
+
+    async def write_command(self, message):
+        return await self.write_commands([message])
+
+    async def write_commands(self, messages: list):
+        """Write all the commands from one MQTT message, merging adjacent writes.
+
+        Requests for different devices are written concurrently, while requests for the same
+        device are written in order.
+        """
+        self._planner.track(messages)
+        by_device = {}
+        for message in messages:
+            device = self._planner.get_device(message.entry.device)
+            by_device.setdefault(self._get_pooled_client(device), []).append(message)
+        sent = await asyncio.gather(
+            *[
+                self._write_messages(pooled, messages)
+                for pooled, messages in by_device.items()
+            ]
+        )
+        return sum(sent)
+
+    async def _write_messages(self, pooled: _PooledClient, messages: list):
+        sent = 0
+        # Planning waits for the lock, so that commands superseded meanwhile are dropped
+        async with pooled.lock:
+            if not pooled.client.connected:
+                # The device may have been reset while the connection was down
+                self._planner.invalidate(
+                    self._planner.get_device(messages[0].entry.device)
+                )
+            for request in self._planner.plan(messages):
+                try:
+                    sent += await self._write_request(pooled.client, request)
+                    self._planner.written(request)
+                except ModbusClientError as ex:
+                    self._planner.report_failure(ex, request)
+        return sent
+
+    async def _write_request(self, client: AsyncModbusTcpClient, request: WriteRequest):
+        if not client.connected and not await self._connect(client):
+            raise ModbusClientError("Not connected to Modbus server")
+        unit = request.device.unit_id
+        values = request.values[0] if request.single_coil else request.values
+        try:
+            write = getattr(client, request.write_method)
+            response = await write(request.address, values, unit)
+        except ModbusException as ex:
+            raise ModbusClientError(ex)
+        if response.isError():
+            raise ModbusClientError(response)
+        logging.debug(
+            f"wrote {len(request.values)} {request.input_type.lower()}(s)"
+            f" at address {request.address} on device {request.device.name!r}"
+        )
+        return request.count
@@ -0,0 +1,141 @@
+"""Asyncio runtime module.
+
+This module runs the handler on a single asyncio event loop instead of paho's network thread.
+The paho client's socket is registered with the event loop, so incoming MQTT messages are read
+and parsed on the loop, and the resulting Modbus writes are scheduled as tasks. A slow Modbus
+request no longer holds up command intake.
+
+Example:
+    Run the handler with the asyncio runtime:
+
+    ```
+    asyncio.run(run(MqttReader(...), AsyncModbusClient(...)))
+    ```
+
+"""
+
+import asyncio
+import logging
+import signal
+import socket
+
+import paho.mqtt.client as mqtt
+
+from app.async_modbus_client import AsyncModbusClient
+from app.mqtt_reader import MqttReader
+
+# How often paho's housekeeping (keepalives, retries, reconnects) is run
+_MISC_INTERVAL = 1.0
+
+
+class AsyncioMqttAdapter:
+    """Drive a paho client's network I/O from an asyncio event loop.
+
+    Messages may still be published from other threads, such as the error handler's flusher
+    when errors are published on the reader's connection. The socket is then registered for
+    writing on the loop's own thread, which also wakes the loop to send them.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, client: mqtt.Client, reconnect=True
+    ) -> None:
+        self.loop = loop
+        self.client = client
+        self.reconnect = reconnect
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def start(self) -> None:
+        self._misc = self.loop.create_task(self.misc_loop())
+
+    def stop(self) -> None:
+        self.reconnect = False
+        if self._misc:
+            self._misc.cancel()
+
+    def on_socket_open(self, client, _userdata, sock: socket.socket) -> None:
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, _client, _userdata, sock: socket.socket) -> None:
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, _userdata, sock: socket.socket) -> None:
+        if self._in_loop():
+            self.loop.add_writer(sock, client.loop_write)
+        else:
+            self.loop.call_soon_threadsafe(
+                self.loop.add_writer, sock, client.loop_write
+            )
+
+    def on_socket_unregister_write(self, _client, _userdata, sock) -> None:
+        self.loop.remove_writer(sock)
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def misc_loop(self) -> None:
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and self.reconnect:
+                try:
+                    self.client.reconnect()
+                except OSError as ex:
+                    logging.error(f"Unable to reconnect to MQTT broker: {ex}")
+            await asyncio.sleep(_MISC_INTERVAL)
+
+
+async def run(
+    mqtt_reader: MqttReader,
+    modbus_client: AsyncModbusClient,
+    stopped: asyncio.Event = None,
+) -> None:
+    """Run the handler until the `stopped` event is set, or SIGINT or SIGTERM is received."""
+    loop = asyncio.get_running_loop()
+    if stopped is None:
+        stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+    tasks = set()
+
+    def on_done(task: asyncio.Task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            mqtt_reader.error_handler.publish(
+                mqtt_reader.error_handler.Category.UNHANDLED, str(task.exception())
+            )
+
+    def write_to_modbus(messages, written):
+        task = loop.create_task(modbus_client.write_commands(messages))
+        tasks.add(task)
+        task.add_done_callback(on_done)
+        # The message is acknowledged whether the write succeeded or not
+        task.add_done_callback(lambda _task: written())
+
+    mqtt_reader.add_batch_callback(write_to_modbus, deferred=True)
+    mqtt_reader.register_callbacks()
+    adapter = AsyncioMqttAdapter(loop, mqtt_reader.client)
+
+    await modbus_client.connect()
+    mqtt_reader.connect()
+    adapter.start()
+    logging.info("Service started with asyncio runtime")
+
+    await stopped.wait()
+    logging.info("Shutting down...")
+    adapter.stop()
+    mqtt_reader.stop()
+    if tasks:
+        await asyncio.wait(tasks)
+    logging.info(
+        f"Coalesced {modbus_client.coalesced} superseded command(s), "
+        f"skipped {modbus_client.skipped} unchanged command(s)"
+    )
+    if modbus_client.payload_cache:
+        logging.info(f"Payload cache metrics: {modbus_client.payload_cache.metrics()}")
+    modbus_client.close()
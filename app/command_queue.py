@@ -0,0 +1,209 @@
+"""Command Queue module.
+
+This module provides a bounded queue between the `MqttReader` and the `ModbusClient`. The MQTT
+network thread only parses a message and puts its commands on the queue; dedicated writer
+threads take them off and write them to Modbus. This keeps the network thread free to handle
+keepalives and acknowledgements while a slow Modbus request is in progress.
+
+With several writer threads, batches for different devices are written in parallel. A batch is
+not taken off the queue while another thread is writing to one of its devices, or while an
+earlier batch for one of its devices is still queued, so the writes to each device keep the
+order they arrived in.
+
+Queued commands for coils and registers configured with `coalesce` are dropped when a newer
+command for the same action is queued, so that only the latest value is written.
+
+A batch may be queued with an `on_done` function, which is called once the batch has been
+written, has failed, has been dropped or has been entirely superseded.
+
+Example:
+    Queue batches of commands for a Modbus client:
+
+    ```
+    queue = CommandQueue(modbus_client.write_commands, error_handler, capacity=100)
+    queue.start()
+    mqtt_reader.add_batch_callback(queue.put, deferred=True)
+    ```
+
+"""
+
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable
+
+from app.error_handler import ErrorHandler
+
+
+class OverflowPolicy(str, Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+
+@dataclass
+class QueueMetrics:
+    depth: int = 0
+    max_depth: int = 0
+    enqueued: int = 0
+    processed: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+
+
+class CommandQueue:
+    def __init__(
+        self,
+        handler: Callable[[list], None],
+        error_handler: ErrorHandler,
+        capacity: int = 1000,
+        overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        workers: int = 1,
+    ) -> None:
+        self._handler = handler
+        self.error_handler = error_handler
+        self.capacity = capacity
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.workers = workers
+        self._items = deque()
+        # Devices being written to by a writer thread
+        self._busy = set()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._running = False
+        self._metrics = QueueMetrics()
+
+    def metrics(self) -> QueueMetrics:
+        with self._condition:
+            return QueueMetrics(
+                len(self._items),
+                self._metrics.max_depth,
+                self._metrics.enqueued,
+                self._metrics.processed,
+                self._metrics.dropped,
+                self._metrics.coalesced,
+            )
+
+    def start(self) -> None:
+        with self._condition:
+            self._running = True
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"modbus-writer-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None) -> None:
+        """Stop the writer threads once the commands already queued have been written."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, messages: list, on_done: Callable[[], None] = None) -> bool:
+        """Queue a batch of commands, applying the overflow policy if the queue is full.
+
+        Returns False if the batch was dropped.
+        """
+        item = (messages, on_done)
+        dropped = None
+        with self._condition:
+            done = self._coalesce(messages)
+            if len(self._items) >= self.capacity:
+                if self.overflow_policy == OverflowPolicy.DROP_NEWEST:
+                    dropped = item
+                elif self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                    dropped = self._items.popleft()
+                else:
+                    self._condition.wait_for(
+                        lambda: len(self._items) < self.capacity or not self._running
+                    )
+            if dropped is not item:
+                self._items.append(item)
+                self._metrics.enqueued += 1
+                self._metrics.max_depth = max(self._metrics.max_depth, len(self._items))
+                self._condition.notify_all()
+            if dropped is not None:
+                self._metrics.dropped += 1
+                done.append(dropped[1])
+
+        if dropped is not None:
+            self.error_handler.publish(
+                self.error_handler.Category.QUEUE_OVERFLOW,
+                f"Command queue is full, dropped {len(dropped[0])} command(s): "
+                f"{', '.join(message.name for message in dropped[0])}",
+            )
+        for callback in done:
+            if callback:
+                callback()
+        return dropped is not item
+
+    def _coalesce(self, messages: list) -> list:
+        """Drop the queued commands that `messages` supersede.
+
+        Returns the `on_done` functions of the batches left empty.
+        """
+        superseded = {
+            message.name for message in messages if message.configuration.coalesce
+        }
+        done = []
+        if not superseded:
+            return done
+        items = deque()
+        for queued, on_done in self._items:
+            current = [message for message in queued if message.name not in superseded]
+            self._metrics.coalesced += len(queued) - len(current)
+            if current:
+                items.append((current, on_done))
+            else:
+                done.append(on_done)
+        self._items = items
+        self._condition.notify_all()
+        return done
+
+    def _next(self) -> tuple:
+        """Take the first queued batch whose devices no earlier batch is waiting for or writing.
+
+        Returns None if every queued batch has to wait.
+        """
+        blocked = set(self._busy)
+        for index, (messages, on_done) in enumerate(self._items):
+            devices = {message.configuration.device for message in messages}
+            if blocked.isdisjoint(devices):
+                del self._items[index]
+                return messages, on_done, devices
+            blocked |= devices
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                item = None
+                while item is None:
+                    if not self._items and not self._running:
+                        return
+                    item = self._next()
+                    if item is None:
+                        self._condition.wait()
+                messages, on_done, devices = item
+                self._busy |= devices
+                self._condition.notify_all()
+            try:
+                self._handler(messages)
+            # As in MqttReader, unexpected errors are trapped here so the writer thread survives
+            except Exception as ex:
+                logging.error(f"Encountered error {ex} writing queued commands")
+                self.error_handler.publish(
+                    self.error_handler.Category.UNHANDLED, str(ex)
+                )
+            if on_done:
+                on_done()
+            with self._condition:
+                self._busy -= devices
+                self._metrics.processed += 1
+                self._condition.notify_all()
@@ -0,0 +1,116 @@
+"""Configuration snapshot module.
+
+This module saves the time taken to parse, validate and build a large configuration every time
+the handler starts. Once a configuration file has been loaded, the resulting `Configuration`
+is pickled into a snapshot file next to it. Later starts load the snapshot instead, as long as
+it was made from the same file contents, the same values of the environment variables the file
+refers to, and the same version of the handler and of Python.
+
+A snapshot that is stale, unreadable or cannot be written is ignored, and the configuration is
+loaded from the file as usual.
+
+Note:
+    A snapshot is a pickle, which can run code when loaded. It must be kept where only whoever
+    may change the configuration file can write.
+
+Example:
+    Load a configuration, from its snapshot if it is still valid:
+
+    ```
+    configuration = load("config/configuration.yaml")
+    ```
+
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+from app.configuration import ENV_VAR_PATTERN, Configuration, gc_paused
+from app.exceptions import ConfigurationFileNotFoundError
+from app.version import VERSION
+
+# Changed whenever what a snapshot holds changes without a new version of the handler
+_FORMAT = 1
+
+
+def snapshot_path_for(path: str) -> str:
+    return f"{path}.snapshot"
+
+
+def load(path: str, snapshot_path: str = None) -> Configuration:
+    """Load the configuration at `path`, from its snapshot if still valid, otherwise writing one."""
+    snapshot_path = snapshot_path or snapshot_path_for(path)
+    try:
+        with open(path, "rb") as file:
+            content = file.read()
+    except FileNotFoundError:
+        raise ConfigurationFileNotFoundError(path) from None
+    key = snapshot_key(content)
+
+    configuration = _read(snapshot_path, key)
+    if configuration is not None:
+        logging.info(f"Loaded configuration from snapshot {snapshot_path}")
+        return configuration
+
+    configuration = Configuration.from_file(path)
+    with open(path, "rb") as file:
+        # Not written if the file changed while it was loaded
+        if snapshot_key(file.read()) == key:
+            _write(snapshot_path, key, configuration)
+    return configuration
+
+
+def snapshot_key(content: bytes) -> bytes:
+    """Return the key of a snapshot of a configuration file with `content`."""
+    digest = hashlib.sha256(f"{_FORMAT}\0{VERSION}\0{sys.version}\0".encode())
+    digest.update(content)
+    for name in sorted(set(ENV_VAR_PATTERN.findall(content.decode(errors="replace")))):
+        digest.update(f"\0{name}={os.getenv(name, '')}".encode())
+    return digest.digest()
+
+
+def _read(snapshot_path: str, key: bytes) -> Configuration:
+    try:
+        with open(snapshot_path, "rb") as file:
+            if file.read(len(key)) != key:
+                logging.info(f"Configuration snapshot {snapshot_path} is out of date")
+                return None
+            with gc_paused():
+                configuration = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    # Whatever is wrong with the snapshot, the configuration file can still be loaded
+    except Exception as ex:
+        logging.warning(f"Cannot read configuration snapshot {snapshot_path}: {ex}")
+        return None
+    if not isinstance(configuration, Configuration):
+        logging.warning(
+            f"Configuration snapshot {snapshot_path} is not a configuration"
+        )
+        return None
+    return configuration
+
+
+def _write(snapshot_path: str, key: bytes, configuration: Configuration) -> None:
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    try:
+        # Written in full before it replaces the old snapshot, so no start reads half of one
+        file = tempfile.NamedTemporaryFile(
+            "wb", dir=directory, prefix=".snapshot-", delete=False
+        )
+    except OSError as ex:
+        logging.warning(f"Cannot write configuration snapshot {snapshot_path}: {ex}")
+        return
+    try:
+        with file:
+            file.write(key)
+            pickle.dump(configuration, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, snapshot_path)
+    # As when reading, a snapshot that cannot be written only costs time on the next start
+    except Exception as ex:
+        logging.warning(f"Cannot write configuration snapshot {snapshot_path}: {ex}")
+        os.remove(file.name)
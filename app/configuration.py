@@ -10,6 +10,7 @@ Example:
     ```
     configuration = Configuration.from_file("config.yaml")
     coil = configuration.get_coil("coil_name")
+    command = configuration.get_command("coil_name")
     holding_registers = configuration.get_holding_registers()
     mqtt_settings = configuration.get_mqtt_settings()
     modbus_settings = configuration.get_modbus_settings()
@@ -20,18 +21,33 @@ Note:
 
 """
 
+import gc
 import re
 import os
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
 from enum import Enum
-from typing import ClassVar
+from types import MappingProxyType
+from typing import ClassVar, Union
 import yaml
 from app.memory_order import MemoryOrder
+from app.payload_format import PAYLOAD_FORMATS
+from app.register_encoder import DATA_TYPES, Encoder, compile_encoder
+from app.transform import (
+    Transform,
+    TransformMany,
+    compile_transform,
+    compile_transform_many,
+)
 
 
 from app.exceptions import ConfigurationFileNotFoundError, ConfigurationFileInvalidError
+from app.validation import to_bool
 
 ENV_VAR_PATTERN = re.compile(r"\${([A-Z\_]+)}")
+# libyaml's loader is much faster, where PyYAML was built with it
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+DEFAULT_DEVICE = "default"
 
 
 class InputTypes(str, Enum):
@@ -44,6 +60,9 @@ class Coil:
     input_type: ClassVar[str] = InputTypes.COIL
     name: str
     address: list[int]
+    device: str = None
+    # Drop a command that is superseded by a newer one for the same action before it is written
+    coalesce: bool = False
 
 
 @dataclass
@@ -55,6 +74,80 @@ class HoldingRegister:
     scale: float
     address: list[int]
     invert_sign: bool = False
+    device: str = None
+    coalesce: bool = False
+    # Compiled from data_type and memory_order, so values need not be looked up on every write
+    encoder: Encoder = field(init=False, repr=False, compare=False)
+    # Compiled from scale, data_type and invert_sign, for one value or a list of values
+    transform: Transform = field(init=False, repr=False, compare=False)
+    transform_many: TransformMany = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.encoder = compile_encoder(self.data_type, self.memory_order)
+        self.transform = compile_transform(self)
+        self.transform_many = compile_transform_many(self)
+
+    def __getstate__(self):
+        # The compiled functions cannot be pickled, so are compiled again when unpickled
+        state = self.__dict__.copy()
+        for name in ("encoder", "transform", "transform_many"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__post_init__()
+
+
+# The pymodbus client method writing several coils or registers at once
+WRITE_METHODS = {
+    InputTypes.COIL: "write_coils",
+    InputTypes.REGISTER: "write_registers",
+}
+
+
+@dataclass(frozen=True)
+class CommandEntry:
+    """Everything needed to write a command for one action, resolved when configuration is loaded."""
+
+    name: str
+    input_type: InputTypes
+    device: str
+    configuration: Union[Coil, HoldingRegister]
+    transform: Transform
+    encoder: Encoder
+    write_method: str
+
+    @property
+    def address(self) -> int:
+        """The address of the first coil or register written."""
+        return self.configuration.address[0]
+
+
+def _no_transform(value):
+    return value
+
+
+def _encode_coils(value) -> list:
+    if isinstance(value, list):
+        return [to_bool(item) for item in value]
+    return [to_bool(value)]
+
+
+def _command_entry(configuration: Union[Coil, HoldingRegister]) -> CommandEntry:
+    if configuration.input_type == InputTypes.COIL:
+        transform, encoder = _no_transform, _encode_coils
+    else:
+        transform, encoder = configuration.transform, configuration.encoder
+    return CommandEntry(
+        configuration.name,
+        configuration.input_type,
+        configuration.device or DEFAULT_DEVICE,
+        configuration,
+        transform,
+        encoder,
+        WRITE_METHODS[configuration.input_type],
+    )
 
 
 @dataclass
@@ -64,15 +157,80 @@ class MqttSettings:
     command_topic: str
     error_topic: str = None
     pub_errors: bool = False
+    protocol_version: str = "3.1.1"
+    # Topic filters of command messages that are not JSON, and the format they are in
+    payload_formats: dict = field(default_factory=dict)
+    # Messages on `<scalar_topic>/<action>` carry a single value, rather than a list of commands
+    scalar_topic: str = None
+    # JSON messages of at least this many bytes are read one command at a time (0 disables)
+    stream_threshold: int = 0
+    # Commands read from a streamed message are passed on for writing in batches of this size
+    stream_batch_size: int = 500
+    # Instances in the same share group have each message delivered to only one of them
+    share_group: str = None
+    # Instances may split the Modbus devices between them, writing the commands of their own
+    partition_count: int = 1
+    partition_index: int = 0
+    # Commands are subscribed to at this QoS
+    qos: int = 0
+    # Messages are acknowledged once their commands are written, rather than on receipt
+    manual_ack: bool = False
+    # Messages received but not yet acknowledged, at most
+    max_inflight: int = 100
+    # With a client id, the broker keeps the session while the handler is disconnected
+    client_id: str = None
+    # Error messages waiting to be published, at most
+    error_queue_size: int = 1000
+    # Repeats of an error are summarised once per this many seconds (0 reports every one)
+    error_window: float = 0
+    # Errors of each category reported a second at most, in bursts of up to error_burst
+    error_rate: float = 0
+    error_burst: int = 10
+    # Errors are published on the reader's MQTT client, rather than a second connection
+    shared_connection: bool = False
 
     def __post_init__(self):
         self.pub_errors = self.error_topic is not None and len(self.error_topic) > 0
 
 
+@dataclass
+class ModbusDevice:
+    name: str
+    host: str
+    port: int
+    unit_id: int = 1
+
+
 @dataclass
 class ModbusSettings:
     host: str
     port: int
+    persistent_connection: bool = False
+    reconnect_delay: float = 0.5
+    reconnect_delay_max: float = 30.0
+    max_coils_per_write: int = 1968
+    unit_id: int = 1
+    devices: list[ModbusDevice] = field(default_factory=list)
+    write_cache_max_age: float = 0
+    payload_cache_size: int = 1024
+
+    def get_device(self, name: str = None) -> ModbusDevice:
+        """Return the named device, or the default device given by `host`, `port` and `unit_id`."""
+        for device in self.devices:
+            if device.name == name:
+                return device
+        return ModbusDevice(DEFAULT_DEVICE, self.host, self.port, self.unit_id)
+
+    def get_devices(self) -> list[ModbusDevice]:
+        return [self.get_device()] + self.devices
+
+
+@dataclass
+class QueueSettings:
+    enabled: bool = False
+    capacity: int = 1000
+    overflow_policy: str = "block"
+    workers: int = 1
 
 
 @dataclass
@@ -89,18 +247,43 @@ class Configuration:
         mqtt_settings: MqttSettings,
         modbus_settings: ModbusSettings,
         site_settings: SiteSettings,
+        queue_settings: QueueSettings = None,
     ):
         self.coils_map = {x.name: x for x in coils}
         self.holding_register_map = {x.name: x for x in holding_registers}
+        # Coils take precedence over holding registers of the same name
+        self.command_table = MappingProxyType(
+            {x.name: _command_entry(x) for x in [*holding_registers, *coils]}
+        )
         self.mqtt_settings = mqtt_settings
         self.modbus_settings = modbus_settings
         self.site_settings = site_settings
+        self.queue_settings = queue_settings or QueueSettings()
+
+    def __reduce__(self):
+        # The command table is built again from the settings, rather than pickled
+        return (
+            Configuration,
+            (
+                self.get_coils(),
+                self.get_holding_registers(),
+                self.mqtt_settings,
+                self.modbus_settings,
+                self.site_settings,
+                self.queue_settings,
+            ),
+        )
 
     @classmethod
     def from_file(cls, path: str):
         if not os.path.exists(path):
             raise ConfigurationFileNotFoundError(path)
 
+        with gc_paused():
+            return cls._from_file(path)
+
+    @classmethod
+    def _from_file(cls, path: str):
         try:
             yaml_data = _interpolate_environment_vars(path_to_yaml_data(path))
         except yaml.YAMLError as exc:
@@ -119,8 +302,14 @@ class Configuration:
             mqtt_settings = _mqtt_settings_from_yaml_data(yaml_data)
             modbus_settings = _modbus_settings_from_yaml_data(yaml_data)
             site_settings = _site_settings_from_yaml_data(yaml_data)
+            queue_settings = _queue_settings_from_yaml_data(yaml_data)
             return cls(
-                coils, holding_registers, mqtt_settings, modbus_settings, site_settings
+                coils,
+                holding_registers,
+                mqtt_settings,
+                modbus_settings,
+                site_settings,
+                queue_settings,
             )
         except TypeError as ex:
             raise ConfigurationFileInvalidError(
@@ -131,6 +320,9 @@ class Configuration:
                 f"Error parsing configuration YAML: expected key {ex} was not found"
             )
 
+    def get_command(self, name: str) -> CommandEntry:
+        return self.command_table.get(name)
+
     def get_coil(self, name: str) -> Coil:
         return self.coils_map.get(name)
 
@@ -147,7 +339,10 @@ class Configuration:
         return self.mqtt_settings
 
     def get_modbus_settings(self) -> ModbusSettings:
-        return ModbusSettings(self.modbus_settings.host, self.modbus_settings.port)
+        return replace(self.modbus_settings)
+
+    def get_queue_settings(self) -> QueueSettings:
+        return replace(self.queue_settings)
 
     def get_site_settings(self) -> SiteSettings:
         return SiteSettings(
@@ -155,22 +350,58 @@ class Configuration:
         )
 
 
+@contextmanager
+def gc_paused():
+    """Pause garbage collection while a configuration is loaded.
+
+    Everything loaded lives on, so collecting garbage part way through only wastes time, which
+    grows with the size of the configuration.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 def path_to_yaml_data(path: str):
     with open(path, "r", encoding="UTF8") as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=_SafeLoader)
 
 
 def _interpolate_environment_vars(config: dict):
-    config_str = yaml.safe_dump(config)
-    for var_name in re.findall(ENV_VAR_PATTERN, config_str):
-        match_str = "${" + var_name + "}"
-        env_value = os.getenv(var_name, "")
-        if not env_value:
-            raise ConfigurationFileInvalidError(
-                f"Missing value for expected environment variable {var_name!r} in config"
-            )
-        config_str = config_str.replace(match_str, env_value)
-    return yaml.safe_load(config_str)
+    """Replace every `${VAR}` in the configuration with the value of the environment variable.
+
+    A value that is just `${VAR}` is read as YAML, so that `port: ${PORT}` gives a number.
+    A missing variable is reported in the order the configuration is written in.
+    """
+    node_type = type(config)
+    if node_type is str:
+        if "${" not in config:
+            return config
+        match = ENV_VAR_PATTERN.fullmatch(config)
+        if match:
+            return yaml.load(_env_value(match[1]), Loader=_SafeLoader)
+        return ENV_VAR_PATTERN.sub(lambda match: _env_value(match[1]), config)
+    if node_type is dict:
+        return {
+            _interpolate_environment_vars(key): _interpolate_environment_vars(value)
+            for key, value in config.items()
+        }
+    if node_type is list:
+        return [_interpolate_environment_vars(item) for item in config]
+    return config
+
+
+def _env_value(var_name: str) -> str:
+    env_value = os.getenv(var_name, "")
+    if not env_value:
+        raise ConfigurationFileInvalidError(
+            f"Missing value for expected environment variable {var_name!r} in config"
+        )
+    return env_value
 
 
 def _site_settings_from_yaml_data(data: dict) -> SiteSettings:
@@ -178,9 +409,35 @@ def _site_settings_from_yaml_data(data: dict) -> SiteSettings:
     return SiteSettings(site_settings["site_name"], site_settings["serial_number"])
 
 
+def _queue_settings_from_yaml_data(data: dict) -> QueueSettings:
+    queue_settings = data.get("queue_settings") or {}
+    return QueueSettings(
+        queue_settings.get("enabled", False),
+        queue_settings.get("capacity", 1000),
+        queue_settings.get("overflow_policy", "block"),
+        queue_settings.get("workers", 1),
+    )
+
+
 def _modbus_settings_from_yaml_data(data: dict) -> ModbusSettings:
     modbus_settings = data["modbus_settings"]
-    return ModbusSettings(modbus_settings["host"], modbus_settings["port"])
+    return ModbusSettings(
+        modbus_settings["host"],
+        modbus_settings["port"],
+        modbus_settings.get("persistent_connection", False),
+        modbus_settings.get("reconnect_delay", 0.5),
+        modbus_settings.get("reconnect_delay_max", 30.0),
+        modbus_settings.get("max_coils_per_write", 1968),
+        modbus_settings.get("unit_id", 1),
+        [
+            ModbusDevice(
+                device["name"], device["host"], device["port"], device.get("unit_id", 1)
+            )
+            for device in modbus_settings.get("devices") or []
+        ],
+        modbus_settings.get("write_cache_max_age", 0),
+        modbus_settings.get("payload_cache_size", 1024),
+    )
 
 
 def _mqtt_settings_from_yaml_data(data: dict) -> MqttSettings:
@@ -190,13 +447,36 @@ def _mqtt_settings_from_yaml_data(data: dict) -> MqttSettings:
         mqtt_settings["port"],
         mqtt_settings["command_topic"],
         mqtt_settings.get("error_topic"),
+        protocol_version=str(mqtt_settings.get("protocol_version", "3.1.1")),
+        payload_formats=mqtt_settings.get("payload_formats") or {},
+        scalar_topic=mqtt_settings.get("scalar_topic") or None,
+        stream_threshold=mqtt_settings.get("stream_threshold", 0),
+        stream_batch_size=mqtt_settings.get("stream_batch_size", 500),
+        share_group=mqtt_settings.get("share_group") or None,
+        partition_count=mqtt_settings.get("partition_count", 1),
+        partition_index=mqtt_settings.get("partition_index", 0),
+        qos=mqtt_settings.get("qos", 0),
+        manual_ack=mqtt_settings.get("manual_ack", False),
+        max_inflight=mqtt_settings.get("max_inflight", 100),
+        client_id=mqtt_settings.get("client_id") or None,
+        error_queue_size=mqtt_settings.get("error_queue_size", 1000),
+        error_window=mqtt_settings.get("error_window", 0),
+        error_rate=mqtt_settings.get("error_rate", 0),
+        error_burst=mqtt_settings.get("error_burst", 10),
+        shared_connection=mqtt_settings.get("shared_connection", False),
     )
 
 
 def _coils_data_from_yaml_data(data: dict):
     modbus_mapping = data.get("modbus_mapping", {})
     coils = [
-        Coil(coil["name"], coil["address"]) for coil in modbus_mapping.get("coils", [])
+        Coil(
+            coil["name"],
+            coil["address"],
+            coil.get("device"),
+            coil.get("coalesce", False),
+        )
+        for coil in modbus_mapping.get("coils", [])
     ]
 
     return coils
@@ -215,6 +495,8 @@ def _holding_register_from_yaml_data(data: dict):
             register.get("scale", 1.0),
             register["address"],
             register.get("invert_sign", False),
+            register.get("device"),
+            register.get("coalesce", False),
         )
         holding_registers.append(register)
 
@@ -242,6 +524,10 @@ def _validate_config(config: dict):
             # Command topic must be str, must not have more than 7 levels
             return isinstance(topic, str) and topic.count("/") <= 7
 
+        def _is_valid_unit_id(unit_id):
+            # Bools are ints in Python, but not a unit id
+            return type(unit_id) is int and 0 <= unit_id <= 255
+
         assert _is_valid_mqtt_topic(
             config["mqtt_settings"]["command_topic"]
         ), "The command topic must be a valid MQTT topic name"
@@ -256,6 +542,154 @@ def _validate_config(config: dict):
                 error_topic.count("#") + error_topic.count("+") == 0
             ), "The error topic must not contain a wildcard character"
 
+        scalar_topic = config["mqtt_settings"].get("scalar_topic")
+        if scalar_topic:
+            # The action adds one more level to the scalar topic
+            assert (
+                _is_valid_mqtt_topic(scalar_topic) and scalar_topic.count("/") < 7
+            ), "The scalar topic must be a valid MQTT topic name"
+
+            assert (
+                scalar_topic.count("#") + scalar_topic.count("+") == 0
+            ), "The scalar topic must not contain a wildcard character"
+
+        for key, default, minimum in (
+            ("stream_threshold", 0, 0),
+            ("stream_batch_size", 500, 1),
+            ("error_queue_size", 1000, 1),
+            ("error_burst", 10, 1),
+        ):
+            value = config["mqtt_settings"].get(key, default)
+            assert (
+                isinstance(value, int) and value >= minimum
+            ), f"The MQTT {key} must be a whole number of at least {minimum}"
+
+        for key in ("error_window", "error_rate"):
+            value = config["mqtt_settings"].get(key, 0)
+            assert (
+                type(value) in (int, float) and value >= 0
+            ), f"The MQTT {key} must be a number of at least 0"
+
+        protocol_version = str(config["mqtt_settings"].get("protocol_version", "3.1.1"))
+        assert protocol_version in (
+            "3.1.1",
+            "5",
+        ), "The MQTT protocol_version must be '3.1.1' or '5'"
+
+        share_group = config["mqtt_settings"].get("share_group")
+        if share_group:
+            assert isinstance(share_group, str) and not any(
+                char in share_group for char in "/+#"
+            ), "The MQTT share_group must be a name without '/', '+' or '#'"
+            assert (
+                protocol_version == "5"
+            ), "The MQTT share_group needs protocol_version 5"
+
+        partition_count = config["mqtt_settings"].get("partition_count", 1)
+        partition_index = config["mqtt_settings"].get("partition_index", 0)
+        assert (
+            isinstance(partition_count, int) and partition_count >= 1
+        ), "The MQTT partition_count must be a whole number of at least 1"
+        assert (
+            isinstance(partition_index, int) and 0 <= partition_index < partition_count
+        ), "The MQTT partition_index must be from 0 to partition_count - 1"
+
+        qos = config["mqtt_settings"].get("qos", 0)
+        assert qos in (0, 1, 2) and not isinstance(
+            qos, bool
+        ), "The MQTT qos must be 0, 1 or 2"
+        manual_ack = config["mqtt_settings"].get("manual_ack", False)
+        assert isinstance(manual_ack, bool), "The MQTT manual_ack must be true or false"
+        assert not manual_ack or qos > 0, "The MQTT manual_ack needs qos 1 or 2"
+        max_inflight = config["mqtt_settings"].get("max_inflight", 100)
+        # The largest receive maximum an MQTT v5 client can ask for
+        assert (
+            isinstance(max_inflight, int) and 1 <= max_inflight <= 65535
+        ), "The MQTT max_inflight must be a whole number from 1 to 65535"
+        # Only an MQTT v5 broker can be asked to limit the messages in flight
+        assert (
+            "max_inflight" not in config["mqtt_settings"] or protocol_version == "5"
+        ), "The MQTT max_inflight needs protocol_version 5"
+        client_id = config["mqtt_settings"].get("client_id")
+        assert client_id is None or isinstance(
+            client_id, str
+        ), "The MQTT client_id must be a string"
+
+        payload_formats = config["mqtt_settings"].get("payload_formats") or {}
+        assert isinstance(
+            payload_formats, dict
+        ), "The MQTT payload_formats must map topic filters to formats"
+        for topic_filter, payload_format in payload_formats.items():
+            assert _is_valid_mqtt_topic(
+                topic_filter
+            ), f"The payload format topic {topic_filter!r} must be a valid MQTT topic name"
+            assert payload_format in PAYLOAD_FORMATS, (
+                f"The payload format {payload_format!r} must be one of "
+                f"{', '.join(PAYLOAD_FORMATS)}"
+            )
+
+        queue_settings = config.get("queue_settings") or {}
+        assert isinstance(
+            queue_settings, dict
+        ), "The 'queue_settings' section must be a dict"
+        assert queue_settings.get("overflow_policy", "block") in (
+            "block",
+            "drop_oldest",
+            "drop_newest",
+        ), "The queue overflow_policy must be one of 'block', 'drop_oldest' or 'drop_newest'"
+        for key in ("capacity", "workers"):
+            assert (
+                queue_settings.get(key, 1) > 0
+            ), f"The queue {key} must be a positive number"
+
+        write_cache_max_age = config["modbus_settings"].get("write_cache_max_age", 0)
+        assert (
+            isinstance(write_cache_max_age, (int, float)) and write_cache_max_age >= 0
+        ), "The Modbus write_cache_max_age must be a number of seconds, or 0 to disable"
+
+        payload_cache_size = config["modbus_settings"].get("payload_cache_size", 1024)
+        assert (
+            isinstance(payload_cache_size, int) and payload_cache_size >= 0
+        ), "The Modbus payload_cache_size must be a whole number, or 0 to disable"
+
+        max_coils_per_write = config["modbus_settings"].get("max_coils_per_write", 1968)
+        # The most coils one Modbus write multiple coils request can carry
+        assert (
+            isinstance(max_coils_per_write, int) and 1 <= max_coils_per_write <= 1968
+        ), "The Modbus max_coils_per_write must be a whole number from 1 to 1968"
+
+        reconnect_delay = config["modbus_settings"].get("reconnect_delay", 0.5)
+        reconnect_delay_max = config["modbus_settings"].get("reconnect_delay_max", 30.0)
+        for key, value in (
+            ("reconnect_delay", reconnect_delay),
+            ("reconnect_delay_max", reconnect_delay_max),
+        ):
+            assert (
+                type(value) in (int, float) and value > 0
+            ), f"The Modbus {key} must be a positive number of seconds"
+        assert (
+            reconnect_delay <= reconnect_delay_max
+        ), "The Modbus reconnect_delay must not be more than reconnect_delay_max"
+
+        assert _is_valid_unit_id(
+            config["modbus_settings"].get("unit_id", 1)
+        ), "The Modbus unit_id must be a whole number from 0 to 255"
+
+        device_names = set()
+        for index, device in enumerate(config["modbus_settings"].get("devices") or []):
+            assert isinstance(device, dict), f"Modbus device #{index} must be a dict"
+            for key in ("name", "host", "port"):
+                assert device.get(
+                    key
+                ), f"Modbus device #{index} has no config setting for {key!r}"
+            assert device["name"] not in device_names | {
+                DEFAULT_DEVICE
+            }, f"Modbus device #{index} has a duplicate name {device['name']!r}"
+            assert _is_valid_unit_id(
+                device.get("unit_id", 1)
+            ), f"Modbus device #{index} must have a unit_id from 0 to 255"
+            device_names.add(device["name"])
+
         mapping = config["modbus_mapping"]
         if mapping.get("coils") is None:
             mapping["coils"] = []
@@ -272,6 +706,10 @@ def _validate_config(config: dict):
                 assert (
                     key in ref
                 ), f"Coil reference #{index} has no config setting for {key!r}"
+            if ref.get("device") is not None:
+                assert (
+                    ref["device"] in device_names
+                ), f"Coil reference #{index} refers to an unknown device {ref['device']!r}"
 
         section_keys.extend(["byte_order", "data_type"])
         for index, ref in enumerate(mapping.get("holding_registers", [])):
@@ -279,6 +717,14 @@ def _validate_config(config: dict):
                 assert (
                     key in ref
                 ), f"Holding register reference #{index} has no config setting for {key!r}"
+            if ref.get("device") is not None:
+                assert (
+                    ref["device"] in device_names
+                ), f"Holding register reference #{index} refers to an unknown device {ref['device']!r}"
+            assert ref["data_type"] in DATA_TYPES, (
+                f"Holding register reference #{index} has an unknown data_type "
+                f"{ref['data_type']!r}"
+            )
             if ref.get("invert_sign"):
                 assert not ref["data_type"].startswith(
                     "UINT"
@@ -0,0 +1,155 @@
+"""Error aggregator module.
+
+This module keeps a storm of identical errors, such as one Modbus error for every command while
+a device is offline, from flooding the MQTT broker and the logs.
+
+The first occurrence of an error is reported at once. Repeats of the same category and message
+within `window` seconds are only counted, and reported together in one summary, with the count
+and the times of the first and last repeat, when the window ends. If the error is still
+repeating, the next window starts straight away; once a window passes without a repeat, the
+next occurrence is reported at once again.
+
+Reports of each category are also limited to `rate` a second, with bursts of up to `burst`.
+An error over the limit is added to the next summary instead, or dropped and counted in
+`suppressed` when there is no window.
+
+Example:
+    Report a storm of errors once, then once every minute:
+
+    ```
+    aggregator = ErrorAggregator(window=60, rate=1, burst=10)
+    for report in aggregator.add("ModbusError", "Cannot connect"):
+        publish(report)
+    ```
+
+"""
+
+from dataclasses import dataclass
+import threading
+import time
+
+
+@dataclass
+class ErrorReport:
+    category: str
+    message: str
+    count: int
+    first: float
+    last: float
+    # Whether this sums up repeats, rather than being an error as it occurred
+    summary: bool = False
+
+
+@dataclass
+class _Repeats:
+    deadline: float
+    count: int = 0
+    first: float = None
+    last: float = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = now
+
+    def take(self, now: float) -> bool:
+        """Take a token if one is left, refilling at `rate` a second up to `burst`."""
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class ErrorAggregator:
+    def __init__(self, window: float = 0, rate: float = 0, burst: int = 10) -> None:
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = 0
+        self._repeats = {}
+        self._buckets = {}
+        self._next_deadline = float("inf")
+        self._lock = threading.Lock()
+
+    def add(self, category: str, message: str) -> list[ErrorReport]:
+        """Count an error, returning the reports that are now due, including any summaries."""
+        now = time.monotonic()
+        wall = time.time()
+        with self._lock:
+            reports = self._expire(now) if now >= self._next_deadline else []
+            key = (category, message)
+            repeats = self._repeats.get(key)
+            if repeats is None:
+                if self._take(category, now):
+                    reports.append(ErrorReport(category, message, 1, wall, wall))
+                    if self.window:
+                        self._start_window(key, now)
+                    return reports
+                if not self.window:
+                    self.suppressed += 1
+                    return reports
+                # Over the limit, so reported with the repeats
+                repeats = self._start_window(key, now)
+            repeats.count += 1
+            if repeats.first is None:
+                repeats.first = wall
+            repeats.last = wall
+            return reports
+
+    def flush(self, force: bool = False) -> list[ErrorReport]:
+        """Return the summaries of the windows that have ended, or of all repeats if `force`."""
+        with self._lock:
+            if force:
+                reports = [
+                    ErrorReport(category, message, *_counts(repeats), summary=True)
+                    for (category, message), repeats in self._repeats.items()
+                    if repeats.count
+                ]
+                self._repeats = {}
+                self._next_deadline = float("inf")
+                return reports
+            now = time.monotonic()
+            return self._expire(now) if now >= self._next_deadline else []
+
+    def _expire(self, now: float) -> list[ErrorReport]:
+        reports = []
+        next_deadline = float("inf")
+        for key, repeats in list(self._repeats.items()):
+            if repeats.deadline > now:
+                next_deadline = min(next_deadline, repeats.deadline)
+                continue
+            if not repeats.count:
+                del self._repeats[key]
+                continue
+            if self._take(key[0], now):
+                reports.append(ErrorReport(*key, *_counts(repeats), summary=True))
+                # The storm may go on, so its repeats are counted for another window
+                self._repeats[key] = repeats = _Repeats(now + self.window)
+            else:
+                # Tried again once a token is back, still counting repeats
+                repeats.deadline = now + 1 / self.rate
+            next_deadline = min(next_deadline, repeats.deadline)
+        self._next_deadline = next_deadline
+        return reports
+
+    def _start_window(self, key: tuple[str, str], now: float) -> _Repeats:
+        repeats = self._repeats[key] = _Repeats(now + self.window)
+        self._next_deadline = min(self._next_deadline, repeats.deadline)
+        return repeats
+
+    def _take(self, category: str, now: float) -> bool:
+        if not self.rate:
+            return True
+        bucket = self._buckets.get(category)
+        if bucket is None:
+            bucket = self._buckets[category] = TokenBucket(self.rate, self.burst, now)
+        return bucket.take(now)
+
+
+def _counts(repeats: _Repeats) -> tuple[int, float, float]:
+    return repeats.count, repeats.first, repeats.last
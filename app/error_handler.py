@@ -1,16 +1,24 @@
 """Error handler module.
 
+With `error_window` set, repeats of an error are counted and reported in one summary per
+window, and with `error_rate` set, each category is reported at most that many times a
+second. See the `error_aggregator` module.
 
 """
 
+import threading
 import time
 import logging
 
 from app.configuration import Configuration
+from app.error_aggregator import ErrorAggregator, ErrorReport
 from app.mqtt_writer import MqttWriter
 from app.message import ErrorMessage
 import paho.mqtt.client as mqtt
 
+# The longest wait in seconds between checks for windows that have ended
+_FLUSH_INTERVAL = 1.0
+
 
 class ErrorHandler:
     _client: mqtt.Client
@@ -20,10 +28,21 @@ class ErrorHandler:
         MQTT_ERROR = "MQTTError"
         INVALID_MESSAGE = "InvalidMessage"
         UNKNOWN_COMMAND = "UnknownCommand"
+        QUEUE_OVERFLOW = "QueueOverflow"
         UNHANDLED = "UnhandledException"
 
     def __init__(self, config: Configuration, mqtt_client: mqtt.Client):
         mqtt_settings = config.get_mqtt_settings()
+        self._aggregator = None
+        if mqtt_settings.error_window or mqtt_settings.error_rate:
+            self._aggregator = ErrorAggregator(
+                mqtt_settings.error_window,
+                mqtt_settings.error_rate,
+                mqtt_settings.error_burst,
+            )
+        self._flusher = None
+        self._stopped = threading.Event()
+        self._shared = mqtt_settings.shared_connection
         if not mqtt_settings.pub_errors:
             self.active = False
             self.host = None
@@ -38,15 +57,75 @@ class ErrorHandler:
         self.topic = mqtt_settings.error_topic
         if self.active:
             logging.info(f"Configured to publish errors via MQTT under {self.topic}")
-        self._client = MqttWriter(self.host, self.port, mqtt_client)
+        self._client = MqttWriter(
+            self.host, self.port, mqtt_client, mqtt_settings.error_queue_size
+        )
+
+    @property
+    def dropped(self) -> int:
+        """The number of errors not published because the outbound queue was full."""
+        return self._client.dropped if self.active else 0
+
+    @property
+    def suppressed(self) -> int:
+        """The number of errors not reported because their category was over its rate."""
+        return self._aggregator.suppressed if self._aggregator else 0
+
+    def start(self) -> None:
+        """Publish errors in the background over one lasting connection.
+
+        With `shared_connection`, the MQTT client is the reader's, which connects it.
+        """
+        if self.active:
+            self._client.start(self._shared)
+        if self._aggregator and self._aggregator.window:
+            # Summaries are reported when their window ends, even if no other error follows
+            self._stopped.clear()
+            self._flusher = threading.Thread(
+                target=self._flush, name="error-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def stop(self) -> None:
+        """Report the repeats not yet summarised, and stop publishing."""
+        if self._flusher:
+            self._stopped.set()
+            self._flusher.join()
+            self._flusher = None
+        if self._aggregator:
+            for report in self._aggregator.flush(force=True):
+                self._report(report)
+        if self.active:
+            self._client.stop()
 
     def publish(self, category: Category, message: str):
-        logging.error(f"{category}: {message}")
+        if not self._aggregator:
+            self._report(ErrorReport(category, message, 1, time.time(), time.time()))
+            return
+        for report in self._aggregator.add(category, message):
+            self._report(report)
+
+    def _flush(self) -> None:
+        interval = min(self._aggregator.window, _FLUSH_INTERVAL)
+        while not self._stopped.wait(interval):
+            for report in self._aggregator.flush():
+                self._report(report)
+
+    def _report(self, report: ErrorReport) -> None:
+        category, message = report.category, report.message
+        error = {"category": category, "message": message, "timestamp": report.last}
+        if report.summary:
+            logging.error(f"{category}: {message} (repeated {report.count} times)")
+            error.update(
+                count=report.count,
+                first_timestamp=report.first,
+                last_timestamp=report.last,
+            )
+        else:
+            logging.error(f"{category}: {message}")
         if not self.active:
             return
-        payload = ErrorMessage.write(
-            {"category": category, "message": message, "timestamp": time.time()}
-        )
+        payload = ErrorMessage.write(error)
         topic = f"{self.topic}/{category}"
         logging.info(f"Publishing a {category} error to topic {topic}: {message}")
         self._client.publish(topic, payload)
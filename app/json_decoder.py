@@ -0,0 +1,124 @@
+"""JSON decoder module.
+
+This module provides a fast path for parsing command messages. The MQTT payload bytes are parsed
+directly, without first being decoded to a `str`, and checked against the command schema in the
+same step. The fastest installed backend is used:
+
+- `msgspec`, which parses and validates the command list in a single call,
+- `orjson`, which parses, leaving a short check of each command in Python,
+- otherwise none, in which case messages are parsed by the standard library as before.
+
+A message the fast path rejects is parsed again by the standard library, so that invalid
+messages are reported with exactly the same errors whichever backend is installed.
+
+msgspec reads MessagePack command messages against the same schema, see `get_msgpack_decoder`.
+
+Example:
+    Parse a command list with the fast path:
+
+    ```
+    decode = get_decoder()
+    if decode:
+        commands = decode(b'[{"action": "setpoint", "value": 10}]')
+    ```
+
+"""
+
+import json
+import logging
+from typing import Any, Callable, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ("msgspec", "orjson", "json")
+
+Decoder = Callable[[bytes], list[dict]]
+
+
+class _Command(TypedDict):
+    action: Any
+    value: Any
+
+
+def get_decoder(backend: str = "auto") -> Decoder:
+    """Return the fast decoder for `backend`, or None if messages should go to the standard library.
+
+    With "auto", the first installed backend in `BACKENDS` is used. The decoder raises
+    `ValueError` for any message that is not a valid list of commands.
+    """
+    if backend == "auto":
+        backend = next(name for name in BACKENDS if is_installed(name))
+    elif not is_installed(backend):
+        logging.warning(f"JSON backend {backend!r} is not installed, using 'json'")
+        backend = "json"
+    logging.debug(f"Using {backend!r} to parse command messages")
+
+    if backend == "msgspec":
+        return _msgspec_decoder()
+    if backend == "orjson":
+        return _orjson_decode
+    return None
+
+
+def get_scalar_decoder(backend: str = "auto") -> Callable[[bytes], Any]:
+    """Return a function parsing any JSON value with `backend`, raising `ValueError` if invalid."""
+    if backend == "auto":
+        backend = next(name for name in BACKENDS if is_installed(name))
+    elif not is_installed(backend):
+        backend = "json"
+
+    if backend == "msgspec":
+        return msgspec.json.decode
+    if backend == "orjson":
+        return orjson.loads
+    return json.loads
+
+
+def get_msgpack_decoder() -> Decoder:
+    """Return a decoder for MessagePack command lists, or None if msgspec is not installed.
+
+    As with JSON, the decoder raises `ValueError` for any message that is not a valid list of
+    commands.
+    """
+    if msgspec is None:
+        return None
+    return _msgspec_decoder(msgspec.msgpack)
+
+
+def is_installed(backend: str) -> bool:
+    return {"msgspec": msgspec, "orjson": orjson}.get(backend, True) is not None
+
+
+def _msgspec_decoder(codec=None) -> Decoder:
+    decode = (codec or msgspec.json).Decoder(list[_Command]).decode
+
+    def decoder(payload):
+        commands = decode(payload)
+        _check_actions(commands)
+        return commands
+
+    return decoder
+
+
+def _orjson_decode(payload) -> list[dict]:
+    commands = orjson.loads(payload)
+    if type(commands) is not list:
+        raise ValueError("Message is not a list")
+    for command in commands:
+        if type(command) is not dict or "value" not in command:
+            raise ValueError("Message object is not a command")
+    _check_actions(commands)
+    return commands
+
+
+def _check_actions(commands: list[dict]) -> None:
+    if not all(command.get("action") for command in commands):
+        raise ValueError("Message object has an empty action")
@@ -6,43 +6,170 @@ This module encapsulates the functionality required to read and validate an inco
 import json
 from json import JSONDecodeError
 import logging
-from pydantic import validate_call, ValidationError
+import re
+from typing import Iterator
 
 from app.exceptions import InvalidMessageError, UnknownCommandError
 from app.configuration import Configuration, InputTypes
+from app.json_decoder import get_decoder, get_msgpack_decoder, get_scalar_decoder
+from app.payload_format import JSON, MSGPACK, decode_binary
+from app.validation import is_bool
 
 
 class CommandMessageList:
     """Create a CommandMessage object and retrieve its configuration."""
 
+    _decode = staticmethod(get_decoder())
+    _decode_scalar = staticmethod(get_scalar_decoder())
+    _decode_msgpack = staticmethod(get_msgpack_decoder())
+
+    @classmethod
+    def use_backend(cls, backend: str):
+        """Parse messages with the given JSON backend: 'auto', 'msgspec', 'orjson' or 'json'."""
+        cls._decode = staticmethod(get_decoder(backend))
+        cls._decode_scalar = staticmethod(get_scalar_decoder(backend))
+
     @classmethod
-    def read(cls, message_str: str):
+    def read(cls, message, payload_format: str = JSON):
+        """Parse a list of commands from the payload bytes of an MQTT message, or a `str`.
+
+        The payload is JSON, unless `payload_format` names a binary format.
+        """
+        if payload_format == MSGPACK and cls._decode_msgpack:
+            try:
+                return cls._decode_msgpack(message)
+            except ValueError:
+                # Decode the message again below, to report the usual error
+                pass
+        if payload_format != JSON:
+            message_list = decode_binary(message, payload_format)
+            if not isinstance(message_list, list):
+                raise InvalidMessageError("Message must be a list of commands")
+            return cls._check(message_list)
+
+        if cls._decode:
+            try:
+                return cls._decode(message)
+            except ValueError:
+                # Parse the message again below, to report the usual error
+                pass
+
+        if isinstance(message, (bytes, bytearray)):
+            message = message.decode()
         try:
-            message_list = json.loads(message_str)
+            message_list = json.loads(message)
         except JSONDecodeError as ex:
             raise InvalidMessageError(f"Message is invalid JSON syntax: {ex}")
+        return cls._check(message_list)
 
-        for message_obj in message_list:
-            if not isinstance(message_obj, dict):
-                raise InvalidMessageError("Message object must be a dict")
-            if not message_obj.get("action") or "value" not in message_obj:
+    @classmethod
+    def read_scalar(cls, action: str, message):
+        """Make a list of one command from an action and a payload holding only its value.
+
+        The value is read as a JSON value, such as `true`, `42` or `"on"`, and a payload that
+        is not JSON is kept as a string, so that `on` may be sent without quotes.
+        """
+        try:
+            value = cls._decode_scalar(message)
+        except ValueError:
+            value = _read_text(action, message)
+        if isinstance(value, (list, dict)):
+            raise InvalidMessageError(
+                "Message must be a single value, not a list of commands"
+            )
+        return [{"action": action, "value": value}]
+
+    @classmethod
+    def stream(cls, message) -> Iterator:
+        """Parse the elements of a JSON list of commands one at a time.
+
+        Each element is yielded as soon as it is parsed, without checking that it is a command,
+        so that the commands before a bad element can still be written. A syntax error raises
+        `InvalidMessageError` when it is reached.
+        """
+        if isinstance(message, (bytes, bytearray)):
+            message = message.decode()
+        index = _skip_whitespace(message, 0).end()
+        if not message.startswith("[", index):
+            raise InvalidMessageError("Message must be a list of commands")
+        index = _skip_whitespace(message, index + 1).end()
+        if message.startswith("]", index):
+            return _check_end(message, index + 1)
+
+        while True:
+            try:
+                message_obj, index = _json_decoder.raw_decode(message, index)
+            except JSONDecodeError as ex:
+                raise InvalidMessageError(f"Message is invalid JSON syntax: {ex}")
+            yield message_obj
+
+            index = _skip_whitespace(message, index).end()
+            if message.startswith("]", index):
+                return _check_end(message, index + 1)
+            if not message.startswith(",", index):
                 raise InvalidMessageError(
-                    "Message is missing required components 'action' and/or 'value'"
+                    f"Message is invalid JSON syntax: Expecting ',' delimiter (char {index})"
                 )
+            index = _skip_whitespace(message, index + 1).end()
+
+    @classmethod
+    def check(cls, message_obj) -> dict:
+        """Check that one element of a list of commands is a command."""
+        if not isinstance(message_obj, dict):
+            raise InvalidMessageError("Message object must be a dict")
+        if not message_obj.get("action") or "value" not in message_obj:
+            raise InvalidMessageError(
+                "Message is missing required components 'action' and/or 'value'"
+            )
+        return message_obj
+
+    @classmethod
+    def _check(cls, message_list):
+        for message_obj in message_list:
+            cls.check(message_obj)
         return message_list
 
 
+_json_decoder = json.JSONDecoder()
+_skip_whitespace = re.compile(r"[ \t\n\r]*").match
+
+
+def _check_end(message: str, index: int) -> None:
+    index = _skip_whitespace(message, index).end()
+    if index != len(message):
+        raise InvalidMessageError(
+            f"Message is invalid JSON syntax: Extra data (char {index})"
+        )
+
+
+def _read_text(action: str, message) -> str:
+    if isinstance(message, (bytes, bytearray)):
+        try:
+            message = message.decode()
+        except UnicodeDecodeError as ex:
+            raise InvalidMessageError(f"Message is not valid UTF-8: {ex}")
+    text = message.strip()
+    if not text:
+        raise InvalidMessageError(f"Message for {action!r} has no value")
+    if text[0] in "[{":
+        raise InvalidMessageError(
+            "Message must be a single value, not a list of commands"
+        )
+    if text[0] == '"':
+        raise InvalidMessageError("Message is invalid JSON syntax: unterminated string")
+    return text
+
+
 class CommandMessage:
     """Create a CommandMessage object and retrieve its configuration."""
 
     def __init__(self, name: str, value, configuration: Configuration) -> None:
         self.name = name
         self.value = value
-        self.configuration = configuration.get_coil(
-            self.name
-        ) or configuration.get_holding_register(self.name)
-        if self.configuration:
-            self.input_type = self.configuration.input_type
+        self.entry = configuration.get_command(self.name)
+        if self.entry:
+            self.configuration = self.entry.configuration
+            self.input_type = self.entry.input_type
         else:
             raise UnknownCommandError(self.name)
 
@@ -51,22 +178,23 @@ class CommandMessage:
 
     def transform(self):
         if self.input_type == InputTypes.REGISTER:
-            self.value = MessageTransformer.transform(self.configuration, self.value)
+            if type(self.value) is list:
+                # A list of values is written to consecutive registers
+                self.value = self.configuration.transform_many(self.value)
+            else:
+                self.value = self.entry.transform(self.value)
             MessageValidator.validate(self.input_type, self.value)
 
 
 class MessageValidator:
     @classmethod
-    @validate_call
-    def is_bool(cls, value: bool) -> bool:
-        return True
+    def is_bool(cls, value) -> bool:
+        return is_bool(value)
 
     @classmethod
     def validate(cls, input_type, value):
         if input_type == InputTypes.COIL:
-            try:
-                cls.is_bool(value)
-            except ValidationError:
+            if not cls.is_bool(value):
                 raise InvalidMessageError(
                     f"The {input_type.lower()} value {value!r} is invalid."
                 )
@@ -77,17 +205,12 @@ class MessageValidator:
 class MessageTransformer:
     @classmethod
     def transform(cls, configuration, value):
-        tvalue = value
-        if configuration.scale:
-            value = configuration.scale * value
-            if "INT" in configuration.data_type:
-                value = int(value)
-        if configuration.invert_sign:
-            value = -1 * value
-        logging.debug(
-            f"transformed value {value} with config {configuration} to {tvalue}"
-        )
-        return value
+        return configuration.transform(value)
+
+    @classmethod
+    def transform_many(cls, configuration, values: list) -> list:
+        """Transform a list of values for the same holding register in one call."""
+        return configuration.transform_many(values)
 
 
 class ErrorMessage:
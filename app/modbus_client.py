@@ -12,9 +12,10 @@ Example:
     modbus_client = ModbusTcpClient(...)
     client = ModbusClient(configuration, modbus_client)
 
-    client.write_coil("coil_name", True)
-    client.write_coils("coil_name", [True, False, True])
-    client.write_register("register_name", 123)
+    client.write_command(CommandMessage("coil_name", True, configuration))
+    client.write_commands(
+        [CommandMessage(name, value, configuration) for name, value in commands]
+    )
     ```
 
 Note:
@@ -23,13 +24,17 @@ Note:
 """
 
 import logging
-import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 from pymodbus.client import ModbusTcpClient
 from pymodbus.exceptions import ModbusException
-from app.configuration import Configuration, HoldingRegister, InputTypes
-from app.payload_builder import PayloadBuilder
-from app.exceptions import ModbusClientError, InvalidMessageError
+from app.configuration import Configuration, ModbusDevice
+from app.modbus_connection import ModbusConnection
+from app.payload_cache import PayloadCache
+from app.write_planner import WritePlanner, WriteRequest
+from app.exceptions import ModbusClientError
 from app.error_handler import ErrorHandler
 
 
@@ -41,100 +46,147 @@ class ModbusClient:
         configuration: Configuration,
         modbus_client: ModbusTcpClient,
         error_handler: ErrorHandler,
+        client_factory: Callable[[str, int], ModbusTcpClient] = None,
     ) -> None:
+        """Create a client writing to the Modbus devices in the configuration.
+
+        `modbus_client` is used for the default device. Clients for any other devices are
+        created by `client_factory` when they are first needed.
+        """
         self.configuration = configuration
         self._client = modbus_client
         self.error_handler = error_handler
-
-    def _write_coils(self, name: str, value: list[bool]):
-        coil_configuration = self.configuration.get_coil(name)
-        if coil_configuration:
-            try:
-                self._client.connect()
-                response = self._client.write_coils(
-                    coil_configuration.address[0], value
-                )
-                self._client.close()
-                if response.isError():
-                    raise ModbusClientError(response)
-                logging.debug(f"wrote to coil {name}, value: {value!r}")
-                return len(value)
-            except ModbusException as ex:
-                raise ModbusClientError(ex)
-
-    def _write_coil(self, name: str, value: bool):
-        coil_configuration = self.configuration.get_coil(name)
-        if coil_configuration:
-            try:
-                self._client.connect()
-                response = self._client.write_coil(
-                    coil_configuration.address[0], value, 1
+        self._client_factory = client_factory or _create_modbus_tcp_client
+        self._modbus_settings = configuration.get_modbus_settings()
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._connection = self._get_connection(
+            self._modbus_settings.get_device(), modbus_client
+        )
+        self._planner = WritePlanner(
+            configuration,
+            error_handler,
+            self._modbus_settings.max_coils_per_write,
+            self._modbus_settings.write_cache_max_age,
+            self._modbus_settings.payload_cache_size,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self._modbus_settings.devices) + 1,
+            thread_name_prefix="modbus-device",
+        )
+
+    @property
+    def connection_state(self):
+        return self._connection.state
+
+    @property
+    def coalesced(self) -> int:
+        """The number of commands dropped because a newer one for the same action arrived."""
+        return self._planner.coalesced
+
+    @property
+    def skipped(self) -> int:
+        """The number of commands not written because they repeated the last value written."""
+        return self._planner.skipped
+
+    @property
+    def payload_cache(self) -> PayloadCache:
+        """The cache of encoded holding register values, or None if it is disabled."""
+        return self._planner.payload_cache
+
+    def close(self):
+        self._executor.shutdown()
+        for connection in self._pool.values():
+            connection.close()
+
+    def _get_connection(
+        self, device: ModbusDevice, client: ModbusTcpClient = None
+    ) -> ModbusConnection:
+        """Return the pooled connection for a device, creating it if needed."""
+        key = (device.host, device.port, device.unit_id)
+        with self._pool_lock:
+            connection = self._pool.get(key)
+            if connection is None:
+                connection = ModbusConnection(
+                    client or self._client_factory(device.host, device.port),
+                    self._modbus_settings.persistent_connection,
+                    self._modbus_settings.reconnect_delay,
+                    self._modbus_settings.reconnect_delay_max,
                 )
-                self._client.close()
-                if response.isError():
-                    raise ModbusClientError(response)
-                logging.debug(f"wrote to coil {name}, value: {value!r}")
-                return 1
-            except ModbusException as ex:
-                raise ModbusClientError(ex)
-
-    def _write_register(self, name: str, value):
-        holding_register_configuration = self.configuration.get_holding_register(name)
-        if holding_register_configuration:
-            try:
-                payload = _build_register_payload(holding_register_configuration, value)
-            except (AttributeError, RuntimeError, struct.error) as ex:
-                raise InvalidMessageError(ex)
-            try:
-                self._client.connect()
-                response = self._client.write_registers(
-                    holding_register_configuration.address[0], payload, 1
-                )
-                self._client.close()
-                logging.debug(f"wrote to register {name}, value: {value!r}")
-                if response.isError():
-                    raise ModbusClientError(response)
-                return 1
-            except ModbusException as ex:
-                raise ModbusClientError(ex)
-
-    def write_command(self, message):
+                self._pool[key] = connection
+            return connection
+
+    def _write_request(self, request: WriteRequest):
+        connection = self._get_connection(request.device)
+        client = connection.client
+        unit = request.device.unit_id
+        connects = connection.connects
+        try:
+            connection.open()
+            if connection.connects > max(connects, 1):
+                # The device may have been reset while we were away
+                self._planner.invalidate(request.device)
+            values = request.values[0] if request.single_coil else request.values
+            write = getattr(client, request.write_method)
+            response = write(request.address, values, unit)
+            connection.release()
+            if response.isError():
+                raise ModbusClientError(response)
+            logging.debug(
+                f"wrote {len(request.values)} {request.input_type.lower()}(s)"
+                f" at address {request.address} on device {request.device.name!r}"
+            )
+            return request.count
+        except ModbusException as ex:
+            connection.reset()
+            raise ModbusClientError(ex)
+
+    def _write_messages(self, connection: ModbusConnection, messages: list):
         sent = 0
-
-        name = message.name
-        value = message.value
-        if message.input_type == InputTypes.COIL:
-            try:
-                if isinstance(value, list):
-                    sent += self._write_coils(name, value)
-                else:
-                    sent += self._write_coil(name, bool(value))
-            except ModbusClientError as ex:
-                self.error_handler.publish(
-                    self.error_handler.Category.MODBUS_ERROR, str(ex)
-                )
-                return 0
-
-        if message.input_type == InputTypes.REGISTER:
-            try:
-                sent += self._write_register(name, value)
-            except InvalidMessageError as ex:
-                self.error_handler.publish(
-                    self.error_handler.Category.INVALID_MESSAGE, str(ex)
-                )
-                return 0
-            except ModbusClientError as ex:
-                self.error_handler.publish(
-                    self.error_handler.Category.MODBUS_ERROR, str(ex)
+        # The pymodbus client is not thread safe, and requests must keep their order.
+        # Planning waits for the lock too, so that commands superseded meanwhile are dropped.
+        with connection.lock:
+            # Checked before planning, so that no command is skipped as unchanged on a device
+            # that may have been reset while the connection was down
+            if connection.persistent and not connection.is_live():
+                self._planner.invalidate(
+                    self._planner.get_device(messages[0].entry.device)
                 )
-                return 0
-
+            for request in self._planner.plan(messages):
+                try:
+                    sent += self._write_request(request)
+                    self._planner.written(request)
+                except ModbusClientError as ex:
+                    self._planner.report_failure(ex, request)
         return sent
 
-
-def _build_register_payload(holding_register: HoldingRegister, value):
-    payload_builder = PayloadBuilder()
-    payload_builder.set_data_type(holding_register.data_type)
-    payload_builder.set_value(value)
-    payload_builder.set_memory_order(holding_register.memory_order)
-    return payload_builder.build()
+    def write_command(self, message):
+        return self.write_commands([message])
+
+    def write_commands(self, messages: list):
+        """Write all the commands from one MQTT message, merging adjacent writes.
+
+        Requests for different devices are written in parallel, while requests for the same
+        device are written in order.
+        """
+        self._planner.track(messages)
+        by_connection = {}
+        for message in messages:
+            device = self._planner.get_device(message.entry.device)
+            connection = self._get_connection(device)
+            by_connection.setdefault(connection, []).append(message)
+
+        if len(by_connection) <= 1:
+            return sum(
+                self._write_messages(connection, messages)
+                for connection, messages in by_connection.items()
+            )
+        futures = [
+            self._executor.submit(self._write_messages, connection, messages)
+            for connection, messages in by_connection.items()
+        ]
+        return sum(future.result() for future in futures)
+
+
+def _create_modbus_tcp_client(host: str, port: int) -> ModbusTcpClient:
+    return ModbusTcpClient(host, port=port)
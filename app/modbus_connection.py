@@ -0,0 +1,151 @@
+"""Modbus Connection module.
+
+This module manages the TCP connection used by the `ModbusClient`. By default a connection is
+opened and closed around every request. When configured as persistent, the socket is kept open
+between requests, checked for liveness before use, and re-established with exponential backoff
+and jitter after a failure.
+
+Example:
+    Wrap a Modbus TCP client in a persistent connection:
+
+    ```
+    connection = ModbusConnection(ModbusTcpClient(...), persistent=True)
+    connection.open()
+    connection.client.write_coil(1, True, 1)
+    connection.release()
+    ```
+
+"""
+
+import logging
+import random
+import socket
+import threading
+import time
+from enum import Enum
+
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
+
+from app.exceptions import ModbusClientError
+
+# MSG_DONTWAIT is not available on every platform, in which case the liveness probe is skipped.
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class ConnectionState(str, Enum):
+    DISCONNECTED = "Disconnected"
+    CONNECTED = "Connected"
+    BACKOFF = "Backoff"
+
+
+class ModbusConnection:
+    _client: ModbusTcpClient
+
+    def __init__(
+        self,
+        client: ModbusTcpClient,
+        persistent: bool = False,
+        reconnect_delay: float = 0.5,
+        reconnect_delay_max: float = 30.0,
+    ) -> None:
+        self._client = client
+        self.persistent = persistent
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_delay_max = reconnect_delay_max
+        self.state = ConnectionState.DISCONNECTED
+        self.failures = 0
+        self.connects = 0
+        self._retry_at = 0.0
+        # Held by whoever is sending requests over this connection
+        self.lock = threading.Lock()
+
+    @property
+    def client(self) -> ModbusTcpClient:
+        return self._client
+
+    def open(self) -> None:
+        """Make sure the underlying client is connected before a request is sent.
+
+        In non-persistent mode this simply connects, as every request pays for its own connection.
+        In persistent mode an open, live socket is reused. Otherwise a reconnect is attempted,
+        unless we are still backing off from a previous failure, in which case a
+        `ModbusClientError` is raised without touching the network.
+        """
+        if not self.persistent:
+            self._client.connect()
+            return
+
+        if self.state == ConnectionState.CONNECTED and self._is_alive():
+            return
+
+        now = time.monotonic()
+        # The messages stay the same throughout an outage, so that repeats are summarised
+        if now < self._retry_at:
+            raise ModbusClientError(
+                "Modbus connection unavailable, waiting to reconnect"
+            )
+
+        self._client.close()
+        try:
+            connected = self._client.connect()
+        except ModbusException as ex:
+            self._schedule_retry(now)
+            raise ModbusClientError(ex)
+        if not connected:
+            self._schedule_retry(now)
+            raise ModbusClientError("Unable to connect to Modbus server")
+
+        if self.failures:
+            logging.info(
+                f"Reconnected to Modbus server after {self.failures} failure(s)"
+            )
+        self.failures = 0
+        self.connects += 1
+        self.state = ConnectionState.CONNECTED
+
+    def is_live(self) -> bool:
+        """Whether a persistent connection is still connected, so that no reconnect is due."""
+        return self.state == ConnectionState.CONNECTED and self._is_alive()
+
+    def release(self) -> None:
+        """Hand the connection back after a successful request."""
+        if not self.persistent:
+            self._client.close()
+
+    def reset(self) -> None:
+        """Drop the connection after a failed request, so the next request reconnects."""
+        self._client.close()
+        if self.persistent and self.state == ConnectionState.CONNECTED:
+            logging.warning("Modbus connection lost, will reconnect on next request")
+            self.state = ConnectionState.DISCONNECTED
+
+    def close(self) -> None:
+        self._client.close()
+        self.state = ConnectionState.DISCONNECTED
+
+    def _schedule_retry(self, now: float) -> None:
+        self.failures += 1
+        delay = min(
+            self.reconnect_delay_max, self.reconnect_delay * 2 ** (self.failures - 1)
+        )
+        # Jitter keeps a fleet of handlers from reconnecting to a device in lockstep
+        delay = random.uniform(delay / 2, delay)
+        self._retry_at = now + delay
+        self.state = ConnectionState.BACKOFF
+        logging.warning(
+            f"Failed to connect to Modbus server after {self.failures} attempt(s), "
+            f"next attempt in {delay:.1f}s"
+        )
+
+    def _is_alive(self) -> bool:
+        sock = getattr(self._client, "socket", None)
+        if not isinstance(sock, socket.socket) or not _PEEK_FLAGS & ~socket.MSG_PEEK:
+            return bool(self._client.connected)
+        try:
+            # An orderly shutdown by the server shows up as a zero-length read
+            return sock.recv(1, _PEEK_FLAGS) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
@@ -2,21 +2,38 @@
 
 This module provides a client class for subscribing to topics and receiving messages from MQTT brokers.
 
+Several handler instances can share the load of one command topic. With `share_group` set,
+they subscribe through an MQTT v5 shared subscription, and the broker passes each message to
+only one of them. With `partition_count` set, each instance only writes the commands for the
+Modbus devices in its partition, so that all the commands for a device are written in order
+by the same instance.
+
+With `manual_ack` set, a QoS 1 or 2 message is only acknowledged once all its commands have
+been written to Modbus, or have definitively failed. If the handler stops before then, the
+broker delivers the message again. Under MQTT v5, the broker is asked to send at most
+`max_inflight` messages that are waiting to be acknowledged; under 3.1.1, which has no way to
+ask, the broker's own in-flight limit applies.
+
 """
 
 import logging
+import threading
+import zlib
 from typing import Callable
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from app.message import CommandMessage, CommandMessageList
+from app.payload_format import JSON, PayloadFormatSelector
 from app.configuration import Configuration
 from app.exceptions import InvalidMessageError, UnknownCommandError
 from app.error_handler import ErrorHandler
 
-
-def _decode_message(message):
-    return message.payload.decode()
+# How long in seconds an MQTT v5 broker keeps the session of a handler with a client id while
+# it is disconnected
+_SESSION_EXPIRY = 24 * 60 * 60
 
 
 class MqttReader:
@@ -29,18 +46,96 @@ class MqttReader:
         self.configuration = configuration
         self.error_handler = error_handler
         self._on_message_callbacks = []
+        self._on_batch_callbacks = []
         self._client = client
 
         self._host = configuration.get_mqtt_settings().host
         self._port = configuration.get_mqtt_settings().port
         self._topics = [configuration.mqtt_settings.command_topic]
+        self._stream_threshold = configuration.get_mqtt_settings().stream_threshold
+        self._stream_batch_size = configuration.get_mqtt_settings().stream_batch_size
+        self._payload_formats = PayloadFormatSelector(
+            configuration.get_mqtt_settings().payload_formats
+        )
+
+        # The action of a scalar message is looked up from its full topic, which is worked
+        # out here for every known action
+        self._scalar_prefix = None
+        self._scalar_actions = {}
+        scalar_topic = configuration.get_mqtt_settings().scalar_topic
+        if scalar_topic:
+            self._scalar_prefix = f"{scalar_topic}/"
+            self._scalar_actions = {
+                f"{self._scalar_prefix}{name}": name
+                for name in configuration.command_table
+            }
+            subscription = f"{self._scalar_prefix}+"
+            if not mqtt.topic_matches_sub(self._topics[0], subscription):
+                self._topics.append(subscription)
+
+        # With partitions, every partition receives every message, and keeps the commands
+        # for the devices in it
+        mqtt_settings = configuration.get_mqtt_settings()
+        index = self._partition_index = mqtt_settings.partition_index
+        count = mqtt_settings.partition_count
+        self._owned_actions = None
+        if count > 1:
+            self._owned_actions = frozenset(
+                name
+                for name, entry in configuration.command_table.items()
+                if device_partition(entry.device, count) == index
+            )
+
+        share_group = mqtt_settings.share_group
+        if share_group:
+            if self._owned_actions is not None:
+                # The instances of each partition share its messages between them
+                share_group = f"{share_group}-{self._partition_index}"
+            self._topics = [f"$share/{share_group}/{topic}" for topic in self._topics]
+
+        self._qos = mqtt_settings.qos
+        self._manual_ack = mqtt_settings.manual_ack
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+        self._connect_options = {}
+        if mqtt_settings.protocol_version == "5" and (
+            self._manual_ack or mqtt_settings.client_id
+        ):
+            properties = Properties(PacketTypes.CONNECT)
+            if self._manual_ack:
+                # The broker sends no more than this many messages awaiting acknowledgement
+                properties.ReceiveMaximum = mqtt_settings.max_inflight
+            if mqtt_settings.client_id:
+                properties.SessionExpiryInterval = _SESSION_EXPIRY
+                self._connect_options["clean_start"] = False
+            self._connect_options["properties"] = properties
+
+    @property
+    def client(self) -> mqtt.Client:
+        return self._client
 
-    def add_message_callback(self, f: Callable[[str], None]):
+    def add_message_callback(self, f: Callable[[CommandMessage], None]):
         self._on_message_callbacks.append(f)
 
+    @property
+    def inflight(self) -> int:
+        """The number of messages received and not yet acknowledged."""
+        with self._inflight_lock:
+            return self._inflight
+
+    def add_batch_callback(
+        self, f: Callable[[list[CommandMessage]], None], deferred: bool = False
+    ):
+        """Register a callback that receives all the commands from one MQTT message at once.
+
+        The commands are taken to be done when `f` returns. If `deferred`, `f` is also passed
+        a function to call once they have been written, or have definitively failed.
+        """
+        self._on_batch_callbacks.append((f, deferred))
+
     def connect(self) -> None:
         try:
-            self._client.connect(self._host, self._port)
+            self._client.connect(self._host, self._port, **self._connect_options)
             return True
         except OSError as e:
             ex = OSError(f"Cannot connect to MQTT broker at {self._host}:{self._port}")
@@ -54,56 +149,180 @@ class MqttReader:
 
         This method blocks the execution and keeps the client connected to the MQTT broker.
         """
-        self._client.on_connect = self._on_connect()
-        self._client.on_disconnect = self._on_disconnect()
-        self._client.on_message = self._on_message()
+        self.register_callbacks()
 
         self.connect()
 
         logging.info("Service started")
         self._client.loop_forever()
 
+    def register_callbacks(self) -> None:
+        self._client.on_connect = self._on_connect()
+        self._client.on_disconnect = self._on_disconnect()
+        self._client.on_message = self._on_message()
+
     def _on_message(self):
         def inner(_client, _userdata, message):
-            msg_topic = message.topic
-            msg_str = ""
-            msg_obj_list = []
+            ack = None
+            if self._manual_ack and message.qos > 0:
+                ack = _Acknowledgement(self, message)
             try:
-                try:
-                    msg_str = _decode_message(message)
-                    msg_list = CommandMessageList.read(msg_str)
-                    for msg_dict in msg_list:
-                        msg_obj = CommandMessage(
-                            msg_dict["action"], msg_dict["value"], self.configuration
-                        )
-                        msg_obj.validate()
-                        msg_obj.transform()
-                        msg_obj_list.append(msg_obj)
-                except InvalidMessageError as ex:
+                self._read_message(message, ack)
+            finally:
+                if ack:
+                    ack.release()
+
+        return inner
+
+    def _read_message(self, message: mqtt.MQTTMessage, ack) -> None:
+        msg_topic = message.topic
+        msg_obj_list = []
+        try:
+            try:
+                action = self._scalar_action(msg_topic)
+                if self._is_streamed(message, action):
+                    self._stream(message.payload, ack)
+                    return
+                if action:
+                    msg_list = CommandMessageList.read_scalar(action, message.payload)
+                else:
+                    msg_list = CommandMessageList.read(
+                        message.payload, self._payload_formats.select(message)
+                    )
+            except InvalidMessageError as ex:
+                self._publish_message_error(str(ex))
+                return
+            try:
+                # Every command is checked, so that partitions reject a message together
+                for msg_dict in msg_list:
+                    msg_obj = CommandMessage(
+                        msg_dict["action"], msg_dict["value"], self.configuration
+                    )
+                    msg_obj.validate()
+                    msg_obj.transform()
+                    msg_obj_list.append(msg_obj)
+            except InvalidMessageError as ex:
+                if self._owns(msg_dict["action"]):
                     self.error_handler.publish(
                         self.error_handler.Category.INVALID_MESSAGE, str(ex)
                     )
-                    return
-                except UnknownCommandError as ex:
+                return
+            except UnknownCommandError as ex:
+                if self._owns(msg_dict["action"]):
                     self.error_handler.publish(
                         self.error_handler.Category.UNKNOWN_COMMAND, str(ex)
                     )
+                return
+            if self._owned_actions is not None:
+                msg_obj_list = [
+                    msg_obj
+                    for msg_obj in msg_obj_list
+                    if msg_obj.name in self._owned_actions
+                ]
+                if not msg_obj_list:
                     return
-                for msg_obj in msg_obj_list:
-                    for callback in self._on_message_callbacks:
-                        callback(msg_obj)
-            # In general it's not good practice to catch Exception, but we're doing so here
-            # in order to trap unhandled exceptions occurring within message processing,
-            # and prevent them rising up to the main loop.
-            # If these occur, the cause should be identified and code changed to catch them.
-            except Exception as ex:
-                logging.error(f"Encountered error {ex} on topic {msg_topic}")
-                logging.info(msg_str)
-                self.error_handler.publish(
-                    self.error_handler.Category.UNHANDLED, str(ex)
-                )
+            self._dispatch(msg_obj_list, ack)
+        # In general it's not good practice to catch Exception, but we're doing so here
+        # in order to trap unhandled exceptions occurring within message processing,
+        # and prevent them rising up to the main loop.
+        # If these occur, the cause should be identified and code changed to catch them.
+        except Exception as ex:
+            logging.error(f"Encountered error {ex} on topic {msg_topic}")
+            logging.info(message.payload)
+            self.error_handler.publish(self.error_handler.Category.UNHANDLED, str(ex))
 
-        return inner
+    def _dispatch(self, msg_obj_list: list[CommandMessage], ack=None) -> None:
+        for msg_obj in msg_obj_list:
+            for callback in self._on_message_callbacks:
+                callback(msg_obj)
+        for callback, deferred in self._on_batch_callbacks:
+            if not deferred:
+                callback(msg_obj_list)
+            elif ack:
+                ack.hold()
+                callback(msg_obj_list, ack.release)
+            else:
+                callback(msg_obj_list, _done)
+
+    def _is_streamed(self, message: mqtt.MQTTMessage, action: str) -> bool:
+        if action or not 0 < self._stream_threshold <= len(message.payload):
+            return False
+        return self._payload_formats.select(message) == JSON
+
+    def _stream(self, payload: bytes, ack=None) -> None:
+        """Pass on the commands of a large message in batches, as they are read.
+
+        A command that is invalid or unknown is reported on its own, and the other commands
+        are still written.
+        """
+        msg_obj_list = []
+        try:
+            for index, msg_dict in enumerate(CommandMessageList.stream(payload)):
+                try:
+                    CommandMessageList.check(msg_dict)
+                except InvalidMessageError as ex:
+                    self._publish_message_error(f"Command #{index}: {ex}")
+                    continue
+                if not self._owns(msg_dict["action"]):
+                    continue
+                try:
+                    msg_obj = CommandMessage(
+                        msg_dict["action"], msg_dict["value"], self.configuration
+                    )
+                    msg_obj.validate()
+                    msg_obj.transform()
+                except InvalidMessageError as ex:
+                    self.error_handler.publish(
+                        self.error_handler.Category.INVALID_MESSAGE,
+                        f"Command #{index}: {ex}",
+                    )
+                    continue
+                except UnknownCommandError as ex:
+                    self.error_handler.publish(
+                        self.error_handler.Category.UNKNOWN_COMMAND,
+                        f"Command #{index}: {ex}",
+                    )
+                    continue
+                msg_obj_list.append(msg_obj)
+                if len(msg_obj_list) >= self._stream_batch_size:
+                    self._dispatch(msg_obj_list, ack)
+                    msg_obj_list = []
+        except InvalidMessageError as ex:
+            # The commands read before the syntax error are still written
+            self._publish_message_error(str(ex))
+        if msg_obj_list:
+            self._dispatch(msg_obj_list, ack)
+
+    def _acknowledge(self, message: mqtt.MQTTMessage) -> None:
+        self._client.ack(message.mid, message.qos)
+        with self._inflight_lock:
+            self._inflight -= 1
+
+    def _owns(self, action: str) -> bool:
+        """Whether this instance writes the commands for `action`."""
+        if self._owned_actions is None or action in self._owned_actions:
+            return True
+        # Unknown actions are reported by the first partition only
+        if self._partition_index != 0:
+            return False
+        return self.configuration.get_command(action) is None
+
+    def _publish_message_error(self, message: str) -> None:
+        # A message that cannot be read reaches every partition, and the first reports it
+        if self._partition_index == 0:
+            self.error_handler.publish(
+                self.error_handler.Category.INVALID_MESSAGE, message
+            )
+
+    def _scalar_action(self, topic: str) -> str:
+        """Return the action of a scalar message on `topic`, or None for a list of commands."""
+        action = self._scalar_actions.get(topic)
+        if action is None and self._scalar_prefix:
+            # Not a known action, which is reported as an unknown command
+            prefix, _, action = topic.partition(self._scalar_prefix)
+            if prefix or not action:
+                return None
+        return action
 
     def _on_connect(self):
         def inner(client, _userdata, _flags, reason_code, _properties):
@@ -111,7 +330,7 @@ class MqttReader:
                 logging.info("Connected to MQTT broker")
                 for topic in self._topics:
                     logging.info("Subscribing to topic: %s", topic)
-                    client.subscribe(topic)
+                    client.subscribe(topic, self._qos)
             else:
                 logging.error(f"Problem connecting to MQTT broker: {reason_code}")
 
@@ -123,3 +342,35 @@ class MqttReader:
                 logging.error(f"MQTT client has disconnected: {reason_code}")
 
         return inner
+
+
+class _Acknowledgement:
+    """Acknowledges a message once it has been read and every batch of its commands is done."""
+
+    def __init__(self, reader: MqttReader, message: mqtt.MQTTMessage) -> None:
+        self._reader = reader
+        self._message = message
+        self._pending = 1
+        self._lock = threading.Lock()
+        with reader._inflight_lock:
+            reader._inflight += 1
+
+    def hold(self) -> None:
+        with self._lock:
+            self._pending += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._reader._acknowledge(self._message)
+
+
+def _done() -> None:
+    pass
+
+
+def device_partition(device: str, partition_count: int) -> int:
+    """Return the partition a Modbus device belongs to, the same in every process."""
+    return zlib.crc32(device.encode()) % partition_count
@@ -2,9 +2,28 @@
 
 This module provides a client class for publishing messages to MQTT brokers.
 
+By default each message is published on a new connection, made while the caller waits. Once
+`start` is called, the writer keeps one connection open instead, with paho's network loop
+running on a background thread. `publish` then only queues the message and returns at once.
+At most `queue_size` messages are queued while the broker is slow or unreachable; a message
+published to a full queue is dropped and counted in `dropped`.
+
+With `start(shared=True)`, the client is one that something else, such as the `MqttReader`,
+connects and runs the network loop of. The writer then only queues messages on it.
+
+Example:
+    Publish without waiting for the broker:
+
+    ```
+    writer = MqttWriter("localhost", 1883, client, queue_size=1000)
+    writer.start()
+    writer.publish("errors/ModbusError", payload)
+    ```
+
 """
 
 import logging
+import threading
 
 import paho.mqtt.client as mqtt
 
@@ -12,10 +31,23 @@ import paho.mqtt.client as mqtt
 class MqttWriter:
     _client: mqtt.Client
 
-    def __init__(self, host: str, port: int, client: mqtt.Client) -> None:
+    def __init__(
+        self, host: str, port: int, client: mqtt.Client, queue_size: int = 1000
+    ) -> None:
         self.host = host
         self.port = port
+        self.queue_size = queue_size
         self._client = client
+        self._started = False
+        self._shared = False
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def dropped(self) -> int:
+        """The number of messages dropped because the queue was full."""
+        with self._lock:
+            return self._dropped
 
     def connect(self) -> None:
         try:
@@ -25,10 +57,42 @@ class MqttWriter:
             ex = OSError(f"Cannot connect to MQTT broker at {self.host}:{self.port}")
             raise ex from e
 
+    def start(self, shared: bool = False) -> None:
+        """Connect in the background, and keep the connection open until `stop` is called.
+
+        If `shared`, the client is left to be connected and looped by its owner.
+        """
+        # Unacknowledged messages count towards paho's limit, as well as unsent ones
+        self._client.max_queued_messages_set(self.queue_size)
+        self._shared = shared
+        if not shared:
+            self._client.connect_async(self.host, self.port)
+            self._client.loop_start()
+        self._started = True
+
+    def stop(self) -> None:
+        if not self._started:
+            return
+        self._started = False
+        if not self._shared:
+            self._client.disconnect()
+            self._client.loop_stop()
+
     def publish(self, topic: str, payload: str):
+        if self._started:
+            self._queue(topic, payload)
+            return
         if self.connect():
             response = self._client.publish(topic, payload, qos=1)
             if response[0] == 0:
                 logging.debug(f"Published message successfully with id {response[1]}")
                 return
         logging.error(f"Failed to publish to {topic}: {payload}")
+
+    def _queue(self, topic: str, payload: str) -> None:
+        # Sent by the network loop, or once reconnected if the broker is unreachable
+        info = self._client.publish(topic, payload, qos=1)
+        if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            with self._lock:
+                self._dropped += 1
+            logging.debug(f"Dropped message to {topic}, the queue is full")
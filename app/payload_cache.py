@@ -0,0 +1,75 @@
+"""Payload cache module.
+
+This module remembers the registers that recent holding register values were encoded into, so
+that a value seen again is not encoded again. Control loops tend to cycle through a few
+setpoints, which makes most lookups hits. The cache holds at most `max_size` payloads, and
+evicts the least recently used one when full.
+
+Payloads are keyed by the register's compiled encoder and the transformed value, including its
+type, as `1` and `1.0` encode differently. Only single `int`, `float`, `bool` and `str` values
+are cached; lists of values and values that fail to encode are always encoded afresh. Cached
+payloads are shared, so they must not be modified.
+
+Example:
+    Encode a value through the cache:
+
+    ```
+    cache = PayloadCache(max_size=1024)
+    cache.encode(entry, 5000)  # encoded, a miss
+    cache.encode(entry, 5000)  # the same list, a hit
+    ```
+
+"""
+
+from dataclasses import dataclass
+import functools
+import threading
+
+_CACHED_TYPES = frozenset([int, float, bool, str])
+
+
+@dataclass
+class CacheMetrics:
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class PayloadCache:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        # Keyed by the register's compiled encoder and the value, with its type. The C
+        # implementation of lru_cache is thread safe, and much faster than locking in Python.
+        self._cached_encode = functools.lru_cache(maxsize=max_size, typed=True)(_encode)
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def encode(self, entry, value) -> list[int]:
+        """Return the registers for `value`, encoding it with `entry.encoder` if not cached."""
+        # NaN is never equal to itself, so it could never be found again
+        if type(value) not in _CACHED_TYPES or value != value:
+            return entry.encoder(value)
+        try:
+            return self._cached_encode(entry.encoder, value)
+        except Exception:
+            # Counted as a miss, but never stored
+            with self._lock:
+                self._failures += 1
+            raise
+
+    def metrics(self) -> CacheMetrics:
+        info = self._cached_encode.cache_info()
+        with self._lock:
+            failures = self._failures
+        return CacheMetrics(
+            info.currsize,
+            info.hits,
+            info.misses - failures,
+            # Every stored payload stays until it is evicted
+            info.misses - failures - info.currsize,
+        )
+
+
+def _encode(encoder, value) -> list[int]:
+    return encoder(value)
@@ -0,0 +1,126 @@
+"""Payload format module.
+
+This module lets command messages be sent in a compact binary encoding instead of JSON. The
+payload holds the same list of `{"action": ..., "value": ...}` commands, encoded as
+MessagePack or CBOR. The format of a message is taken from its MQTT v5 content type when it
+has one, and otherwise from the first `payload_formats` topic filter its topic matches,
+defaulting to JSON.
+
+Note:
+    MessagePack requires the `msgspec` or `msgpack` package, and CBOR the `cbor2` package.
+    None is needed unless a topic or content type uses it. With msgspec, MessagePack command
+    lists are decoded and checked in one step by `CommandMessageList.read`, and this module is
+    only used for messages it rejects.
+
+Example:
+    Choose the format of messages on `commands/packed/#`:
+
+    ```
+    selector = PayloadFormatSelector({"commands/packed/#": MSGPACK})
+    payload_format = selector.select(message)
+    commands = decode_binary(message.payload, payload_format)
+    ```
+
+"""
+
+import logging
+
+import paho.mqtt.client as mqtt
+
+from app.exceptions import InvalidMessageError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Errors raised for a malformed payload. Not every cbor2 release derives its errors from
+# ValueError, so its own error is added.
+_DECODE_ERRORS = (ValueError, TypeError) + ((cbor2.CBORDecodeError,) if cbor2 else ())
+
+JSON = "json"
+MSGPACK = "msgpack"
+CBOR = "cbor"
+PAYLOAD_FORMATS = (JSON, MSGPACK, CBOR)
+
+CONTENT_TYPES = {
+    "application/json": JSON,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    "application/cbor": CBOR,
+}
+_PACKAGES = {MSGPACK: "msgpack", CBOR: "cbor2"}
+# Topics seen are remembered up to this many, so a format is not looked up for every message
+_MAX_CACHED_TOPICS = 10000
+
+
+class PayloadFormatSelector:
+    def __init__(self, payload_formats: dict = None, default: str = JSON) -> None:
+        self.payload_formats = dict(payload_formats or {})
+        self.default = default
+        self._by_topic = {}
+        for payload_format in set(self.payload_formats.values()):
+            if not is_available(payload_format):
+                logging.warning(
+                    f"Install the {_PACKAGES[payload_format]!r} package to accept "
+                    f"{payload_format} command messages"
+                )
+
+    def select(self, message: mqtt.MQTTMessage) -> str:
+        properties = getattr(message, "properties", None)
+        content_type = getattr(properties, "ContentType", None)
+        if content_type:
+            payload_format = CONTENT_TYPES.get(content_type.split(";")[0].strip())
+            if payload_format:
+                return payload_format
+        if not self.payload_formats:
+            return self.default
+
+        topic = message.topic
+        payload_format = self._by_topic.get(topic)
+        if payload_format is None:
+            payload_format = next(
+                (
+                    payload_format
+                    for topic_filter, payload_format in self.payload_formats.items()
+                    if mqtt.topic_matches_sub(topic_filter, topic)
+                ),
+                self.default,
+            )
+            if len(self._by_topic) < _MAX_CACHED_TOPICS:
+                self._by_topic[topic] = payload_format
+        return payload_format
+
+
+def is_available(payload_format: str) -> bool:
+    return {MSGPACK: msgpack or msgspec, CBOR: cbor2}.get(
+        payload_format, True
+    ) is not None
+
+
+def decode_binary(payload: bytes, payload_format: str):
+    """Decode a MessagePack or CBOR payload into Python objects."""
+    if not is_available(payload_format):
+        raise InvalidMessageError(
+            f"Cannot read {payload_format} message, "
+            f"the {_PACKAGES[payload_format]!r} package is not installed"
+        )
+    try:
+        if payload_format == MSGPACK:
+            if msgpack is None:
+                return msgspec.msgpack.decode(payload)
+            return msgpack.unpackb(payload)
+        return cbor2.loads(payload)
+    except _DECODE_ERRORS as ex:
+        raise InvalidMessageError(f"Message is invalid {payload_format} data: {ex}")
@@ -0,0 +1,225 @@
+"""Register encoder module.
+
+This module compiles the encoding of a holding register value into Modbus registers. The data
+type and memory order of a register never change, so the `struct` formats that encode it are
+worked out once, when the configuration is loaded, rather than on every write. Encoding a
+value is then a single pack into bytes, read back as registers in the configured order.
+
+The registers produced are exactly those of `PayloadBuilder`, including its errors: an unknown
+data type raises `RuntimeError` when a value is encoded, and a value that does not fit the data
+type raises `struct.error`.
+
+A list of values is encoded into consecutive registers, one value after another. For numeric
+data types, the list is cast, range checked and put into the register order as NumPy array
+operations when NumPy is installed. A list that fails the range check is encoded one value at
+a time instead, so that the error is exactly the one a single value would raise.
+
+Example:
+    Encode a value, or a list of values, for a holding register:
+
+    ```
+    encoder = compile_encoder("INT32", MemoryOrder("CDAB"))
+    encoder(10)  # [10, 0]
+    encoder([10, 11])  # [10, 0, 11, 0]
+    ```
+
+"""
+
+import functools
+import struct
+from typing import Callable
+
+from pymodbus.constants import Endian
+from app.memory_order import MemoryOrder
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The struct format character of each multi-word data type, and the number of words it fills.
+# FLOAT16 is included, as pymodbus packs it like the wider types.
+_WORD_FORMATS = {
+    "FLOAT64-IEEE": ("d", 4),
+    "FLOAT32-IEEE": ("f", 2),
+    "FLOAT32": ("f", 2),
+    "FLOAT16-IEEE": ("e", 1),
+    "INT32": ("i", 2),
+    "UINT32": ("I", 2),
+    "INT64": ("q", 4),
+    "UINT64": ("Q", 4),
+}
+# Single-register integers are packed straight in the register's byte order
+_16BIT_FORMATS = {
+    "INT16": "h",
+    "UINT16": "H",
+}
+# 8-bit values fill the high byte of a register, as the payload is padded to a whole register
+_8BIT_FORMATS = {
+    "INT8": "b",
+    "UINT8": "B",
+}
+# The data types that can be encoded, checked when the configuration is loaded
+DATA_TYPES = frozenset([*_WORD_FORMATS, *_16BIT_FORMATS, *_8BIT_FORMATS, "STRING"])
+
+Encoder = Callable[[object], list[int]]
+
+
+def compile_encoder(data_type: str, memory_order: MemoryOrder) -> Encoder:
+    """Return a function encoding a value of `data_type` into a list of registers.
+
+    As with `PayloadBuilder`, a register that cannot be encoded is only reported when a value
+    is written to it.
+    """
+    if memory_order is None:
+        return _raising(AttributeError, "set memory order")
+    try:
+        byte_order, word_order = memory_order.order()
+    except AttributeError as ex:
+        return _raising(AttributeError, *ex.args)
+    if isinstance(data_type, str):
+        return _shared_encoder(data_type, byte_order, word_order)
+    return _compile(data_type, byte_order, word_order)
+
+
+# Registers with the same data type and memory order share one encoder, as it holds no state
+@functools.cache
+def _shared_encoder(data_type: str, byte_order: Endian, word_order: Endian) -> Encoder:
+    return _compile(data_type, byte_order, word_order)
+
+
+def _compile(data_type: str, byte_order: Endian, word_order: Endian) -> Encoder:
+    # Values are packed with the same formats as pymodbus, so that a value out of range for
+    # its data type fails with the same error
+    if data_type in _WORD_FORMATS:
+        format_char, words = _WORD_FORMATS[data_type]
+        pack = struct.Struct(f">{format_char}").pack
+        unpack = struct.Struct(f"{byte_order.value}{words}H").unpack
+        if word_order == Endian.LITTLE:
+            encode = _checked(lambda value: list(unpack(pack(value)))[::-1])
+        else:
+            encode = _checked(lambda value: list(unpack(pack(value))))
+        return _with_lists(
+            encode, format_char, words, byte_order, word_order == Endian.LITTLE
+        )
+    if data_type in _16BIT_FORMATS:
+        format_char = _16BIT_FORMATS[data_type]
+        pack = struct.Struct(f"{byte_order.value}{format_char}").pack
+        unpack = struct.Struct(">H").unpack
+        encode = _checked(lambda value: list(unpack(pack(value))))
+        return _with_lists(encode, format_char, 1, byte_order)
+    if data_type in _8BIT_FORMATS:
+        format_char = _8BIT_FORMATS[data_type]
+        pack = struct.Struct(f">{format_char}x").pack
+        unpack = struct.Struct(">H").unpack
+        encode = _checked(lambda value: list(unpack(pack(value))))
+        return _with_lists(encode, format_char, 1)
+    if data_type == "STRING":
+        return _with_lists(_checked(_encode_string))
+    if data_type is None:
+        return _raising(AttributeError, "set data type")
+    return _checked(_raising(RuntimeError, f"unknown data type {data_type}"))
+
+
+def _checked(encode: Encoder) -> Encoder:
+    def encoder(value):
+        if value is None:
+            raise AttributeError("set value")
+        return encode(value)
+
+    return encoder
+
+
+def _with_lists(
+    encode: Encoder,
+    format_char: str = None,
+    words: int = 1,
+    byte_order: Endian = Endian.BIG,
+    reverse_words: bool = False,
+) -> Encoder:
+    """Extend an encoder to encode a list of values into consecutive registers."""
+    if np is not None and format_char:
+        encode_array = _array_encoder(format_char, words, byte_order, reverse_words)
+    else:
+        encode_array = None
+
+    def encode_list(values):
+        if not values:
+            raise AttributeError("set value")
+        if encode_array is not None:
+            registers = encode_array(values)
+            if registers is not None:
+                return registers
+        return [register for value in values for register in encode(value)]
+
+    def encoder(value):
+        if type(value) is list:
+            return encode_list(value)
+        return encode(value)
+
+    return encoder
+
+
+def _array_encoder(
+    format_char: str, words: int, byte_order: Endian, reverse_words: bool
+) -> Callable[[list], list[int]]:
+    """Return a NumPy encoder for a list of values, which returns None if any value would fail.
+
+    Values are packed as with `struct`: integers must be whole numbers within the range of the
+    data type, and floats must not overflow to infinity when narrowed.
+    """
+    big_endian = np.dtype(f">{format_char}")
+    is_float = big_endian.kind == "f"
+    limits = None if is_float else np.iinfo(big_endian)
+
+    def encode_array(values):
+        try:
+            array = np.asarray(values)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        if array.ndim != 1:
+            return None
+        if is_float:
+            if array.dtype.kind not in "biuf":
+                return None
+            with np.errstate(over="ignore"):
+                packed = array.astype(big_endian)
+            # struct refuses to narrow a finite value to infinity
+            if np.any(np.isinf(packed) & np.isfinite(array)):
+                return None
+        else:
+            # Floats, strings and integers too large for NumPy are not packed by struct
+            if array.dtype.kind not in "biu":
+                return None
+            if int(array.min()) < limits.min or int(array.max()) > limits.max:
+                return None
+            packed = array.astype(big_endian)
+        octets = packed.view(np.uint8).reshape(len(values), -1)
+        if format_char in "bB":
+            # 8-bit values fill the high byte of the register
+            return (octets[:, 0].astype(np.uint16) << 8).tolist()
+        octets = octets.reshape(len(values), words, 2)
+        if byte_order == Endian.LITTLE:
+            octets = octets[:, :, ::-1]
+        if reverse_words:
+            octets = octets[:, ::-1, :]
+        registers = octets[:, :, 0].astype(np.uint16) << 8 | octets[:, :, 1]
+        return registers.ravel().tolist()
+
+    return encode_array
+
+
+def _encode_string(value: str) -> list[int]:
+    # As with struct's "s" format, the encoded string is cut to the length of the string
+    length = len(value)
+    payload = value.encode()[:length]
+    payload += b"\x00" * (len(payload) % 2)
+    return list(struct.unpack(f">{len(payload) // 2}H", payload))
+
+
+def _raising(error_type: type[Exception], *args) -> Encoder:
+    # A new exception each time, as one raised again would keep growing its traceback
+    def encoder(value):
+        raise error_type(*args)
+
+    return encoder
@@ -1,4 +1,6 @@
-from app.configuration import Configuration, MqttSettings, ModbusSettings
+from dataclasses import replace
+from app import config_snapshot
+from app.configuration import Configuration
 import argparse
 
 
@@ -17,6 +19,14 @@ class RemoteCommandHandler:
             help='Path to the configuration file. By default, this is "config/configuration.yaml".',
             default="config/configuration.yaml",
         )
+        parser.add_argument(
+            "--snapshot",
+            nargs="?",
+            const="",
+            help="Load the configuration from a snapshot, written on the first start, while the "
+            "configuration file is unchanged. Optionally the path of the snapshot, by default "
+            "the configuration path followed by '.snapshot'.",
+        )
         parser.add_argument(
             "--modbus_port",
             type=int,
@@ -40,25 +50,39 @@ class RemoteCommandHandler:
             help="The MQTT topic to subscribe to. Expected to be a string.",
         )
 
+        parser.add_argument(
+            "--runtime",
+            choices=["threaded", "asyncio"],
+            default="threaded",
+            help="Run the handler on paho's network thread, or on an asyncio event loop.",
+        )
+
         return parser.parse_args(args)
 
     def get_configuration_with_overrides(self, args: argparse.Namespace):
         args_as_dict = vars(args)
-        configuration = Configuration.from_file(args.configuration_path)
+        if args_as_dict.get("snapshot") is None:
+            configuration = Configuration.from_file(args.configuration_path)
+        else:
+            configuration = config_snapshot.load(
+                args.configuration_path, args.snapshot or None
+            )
 
         mqtt_settings = configuration.get_mqtt_settings()
         modbus_settings = configuration.get_modbus_settings()
 
-        mqtt_settings_with_override = MqttSettings(
-            args_as_dict.get("mqtt_host") or mqtt_settings.host,
-            args_as_dict.get("mqtt_port") or mqtt_settings.port,
-            args_as_dict.get("mqtt_command_topic") or mqtt_settings.command_topic,
-            mqtt_settings.error_topic,
+        command_topic = args_as_dict.get("mqtt_command_topic")
+        mqtt_settings_with_override = replace(
+            mqtt_settings,
+            host=args_as_dict.get("mqtt_host") or mqtt_settings.host,
+            port=args_as_dict.get("mqtt_port") or mqtt_settings.port,
+            command_topic=command_topic or mqtt_settings.command_topic,
         )
 
-        modbus_settings_with_override = ModbusSettings(
-            args_as_dict.get("modbus_host") or modbus_settings.host,
-            args_as_dict.get("modbus_port") or modbus_settings.port,
+        modbus_settings_with_override = replace(
+            modbus_settings,
+            host=args_as_dict.get("modbus_host") or modbus_settings.host,
+            port=args_as_dict.get("modbus_port") or modbus_settings.port,
         )
 
         return Configuration(
@@ -67,4 +91,5 @@ class RemoteCommandHandler:
             mqtt_settings_with_override,
             modbus_settings_with_override,
             configuration.get_site_settings(),
+            configuration.get_queue_settings(),
         )
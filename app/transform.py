@@ -0,0 +1,101 @@
+"""Transform module.
+
+This module compiles the transformation applied to a holding register value before it is
+encoded. Scaling, truncation to an integer for integer data types and sign inversion depend
+only on the register's configuration, so they are fused into one function when the
+configuration is loaded, rather than being worked out again for every message.
+
+A batch of values for the same register can be transformed in one call, which runs the fused
+expression in a single list comprehension.
+
+Example:
+    Scale values for an integer register:
+
+    ```
+    transform = compile_transform(holding_register)  # scale 10.0, INT32, invert_sign
+    transform(1.57)  # -15
+    transform_many = compile_transform_many(holding_register)
+    transform_many([1.57, 2])  # [-15, -20]
+    ```
+
+"""
+
+import logging
+from typing import Callable
+
+Transform = Callable[[object], object]
+TransformMany = Callable[[list], list]
+
+_root = logging.getLogger()
+
+
+def compile_transform(holding_register) -> Transform:
+    """Return a function applying a register's scale factor and sign inversion to a value."""
+    fused = _fuse(holding_register)[0]
+
+    def transform(value):
+        tvalue = fused(value)
+        # Checked first, so nothing is formatted unless debug logging is enabled
+        if _root.isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "transformed value %s with config %s to %s",
+                tvalue,
+                holding_register,
+                value,
+            )
+        return tvalue
+
+    return transform
+
+
+def compile_transform_many(holding_register) -> TransformMany:
+    """Return a function transforming a list of values for a register, as `compile_transform`."""
+    fused_many = _fuse(holding_register)[1]
+
+    def transform_many(values):
+        tvalues = fused_many(values)
+        if _root.isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "transformed values %s with config %s to %s",
+                tvalues,
+                holding_register,
+                values,
+            )
+        return tvalues
+
+    return transform_many
+
+
+def _fuse(holding_register) -> tuple[Transform, TransformMany]:
+    scale = holding_register.scale
+    invert_sign = holding_register.invert_sign
+    # Integer data types truncate the scaled value, as they cannot hold a fraction
+    data_type = holding_register.data_type
+    truncate = bool(scale) and isinstance(data_type, str) and "INT" in data_type
+
+    if scale and truncate and invert_sign:
+        return (
+            lambda value: -1 * int(scale * value),
+            lambda values: [-1 * int(scale * value) for value in values],
+        )
+    if scale and truncate:
+        return (
+            lambda value: int(scale * value),
+            lambda values: [int(scale * value) for value in values],
+        )
+    if scale and invert_sign:
+        return (
+            lambda value: -1 * (scale * value),
+            lambda values: [-1 * (scale * value) for value in values],
+        )
+    if scale:
+        return (
+            lambda value: scale * value,
+            lambda values: [scale * value for value in values],
+        )
+    if invert_sign:
+        return (
+            lambda value: -1 * value,
+            lambda values: [-1 * value for value in values],
+        )
+    return (lambda value: value, list)
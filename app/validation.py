@@ -0,0 +1,73 @@
+"""Value validation module.
+
+This module checks command values before they are written. Coil values are accepted exactly
+when pydantic would accept them as a `bool` in lax mode, but the checks run in plain Python:
+
+- `True` and `False`,
+- the numbers 0 and 1, as `int` or `float`,
+- the strings '0', 'off', 'f', 'false', 'n', 'no', '1', 'on', 't', 'true', 'y' and 'yes', in
+  any case.
+
+Values parsed from JSON never need more than this. Any other type of value is handed to
+pydantic, which is only imported the first time that happens. `to_bool` converts an accepted
+value to the `bool` pydantic would make of it, so that 'off' is written as `False`.
+
+Example:
+    Check a coil value:
+
+    ```
+    is_bool("on")  # True
+    is_bool(23)  # False
+    ```
+
+"""
+
+import functools
+
+_BOOL_STRINGS = frozenset(
+    ["0", "off", "f", "false", "n", "no", "1", "on", "t", "true", "y", "yes"]
+)
+_TRUE_STRINGS = frozenset(["1", "on", "t", "true", "y", "yes"])
+# JSON types that can never be a bool
+_NOT_BOOL_TYPES = (type(None), list, dict)
+
+
+def is_bool(value) -> bool:
+    value_type = type(value)
+    if value_type is bool:
+        return True
+    if value_type is int or value_type is float:
+        return value == 0 or value == 1
+    if value_type is str:
+        return value.lower() in _BOOL_STRINGS
+    if value_type in _NOT_BOOL_TYPES:
+        return False
+    return _pydantic_is_bool(value)
+
+
+def to_bool(value) -> bool:
+    """Convert a value that `is_bool` accepts to a `bool`."""
+    value_type = type(value)
+    if value_type is bool or value_type is int or value_type is float:
+        return bool(value)
+    if value_type is str:
+        return value.lower() in _TRUE_STRINGS
+    return _bool_adapter().validate_python(value)
+
+
+def _pydantic_is_bool(value) -> bool:
+    # Imported here, as pydantic is slow to import and rarely needed
+    from pydantic import ValidationError
+
+    try:
+        _bool_adapter().validate_python(value)
+        return True
+    except ValidationError:
+        return False
+
+
+@functools.cache
+def _bool_adapter():
+    from pydantic import TypeAdapter
+
+    return TypeAdapter(bool)
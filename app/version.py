@@ -0,0 +1,7 @@
+"""Version module.
+
+The version of the remote commands handler, kept the same as in `pyproject.toml`.
+
+"""
+
+VERSION = "0.1.0"
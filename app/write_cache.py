@@ -0,0 +1,54 @@
+"""Write cache module.
+
+This module remembers the last value successfully written to each coil and holding register,
+so that a command repeating it can be skipped instead of being sent to the Modbus server again.
+Values are compared after encoding, so two commands that encode to the same registers are
+treated as identical. A cached value is trusted for at most `max_age` seconds, after which it
+is written again. The values cached for a device are forgotten when a write to it fails or
+its connection is re-established, as the device may have been reset in the meantime.
+
+Example:
+    Skip a write that repeats the last value:
+
+    ```
+    cache = WriteCache(max_age=60)
+    cache.store("default", "setpoint", [100])
+    cache.is_unchanged("default", "setpoint", [100])  # True
+    ```
+
+"""
+
+import threading
+import time
+
+
+class WriteCache:
+    def __init__(self, max_age: float) -> None:
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def is_unchanged(self, device: str, name: str, payload: list) -> bool:
+        with self._lock:
+            entry = self._entries.get(device, {}).get(name)
+        if entry is None:
+            return False
+        cached_payload, written_at = entry
+        return (
+            cached_payload == payload and time.monotonic() - written_at < self.max_age
+        )
+
+    def store(self, device: str, name: str, payload: list) -> None:
+        with self._lock:
+            self._entries.setdefault(device, {})[name] = (
+                list(payload),
+                time.monotonic(),
+            )
+
+    def invalidate(self, device: str = None) -> None:
+        """Forget the values cached for a device, or for every device if none is given."""
+        with self._lock:
+            if device is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(device, None)
@@ -0,0 +1,307 @@
+"""Write planner module.
+
+This module groups the Modbus writes produced by a single MQTT message into as few requests
+as possible. Holding register writes whose address ranges are adjacent or overlap are merged
+into a single write-multiple-registers (FC16) request, up to the protocol limit of 123 registers.
+Coil writes are merged the same way into write-multiple-coils (FC15) requests. A single write
+that is longer than the limit, such as a long list of register values, is split into
+consecutive requests. Writes are planned separately for each Modbus device.
+
+Example:
+    Plan the writes for two adjacent registers:
+
+    ```
+    planned = plan_register_writes(
+        [PendingWrite(0, [1], command_a), PendingWrite(1, [2, 3], command_b)]
+    )
+    # planned == [WriteRequest(0, [1, 2, 3], [command_a, command_b])]
+    ```
+
+"""
+
+import itertools
+import struct
+import threading
+from dataclasses import dataclass, field
+
+from app.configuration import (
+    DEFAULT_DEVICE,
+    WRITE_METHODS,
+    Configuration,
+    InputTypes,
+    ModbusDevice,
+)
+from app.error_handler import ErrorHandler
+from app.payload_cache import PayloadCache
+from app.write_cache import WriteCache
+
+# The largest number of registers a single FC16 request can carry
+MAX_REGISTERS_PER_WRITE = 123
+# The largest number of coils a single FC15 request can carry
+MAX_COILS_PER_WRITE = 1968
+
+
+@dataclass
+class PendingWrite:
+    address: int
+    values: list
+    command: object
+
+
+@dataclass
+class WriteRequest:
+    address: int
+    values: list
+    commands: list = field(default_factory=list)
+    input_type: str = InputTypes.REGISTER
+    device: ModbusDevice = None
+    # Set when the request came from one scalar coil command, and so suits FC05
+    single_coil: bool = False
+    # The encoded values of each command, in the same order as `commands`
+    payloads: list = field(default_factory=list, compare=False)
+    # For a write split over several requests, all of its requests, in order
+    parts: list = field(default=None, compare=False, repr=False)
+    failed: bool = field(default=False, compare=False)
+
+    @property
+    def write_method(self) -> str:
+        """The name of the pymodbus client method sending this request."""
+        if self.single_coil:
+            return "write_coil"
+        return WRITE_METHODS[self.input_type]
+
+    @property
+    def count(self) -> int:
+        """The number of writes this request accounts for, as reported by the client."""
+        if self.input_type == InputTypes.COIL:
+            return len(self.values)
+        if not self.completes_write:
+            return 0
+        return len(self.commands)
+
+    @property
+    def completes_write(self) -> bool:
+        """Whether the command is now written, rather than only part of it, or failed in part."""
+        if not self.parts:
+            return True
+        return self is self.parts[-1] and not any(part.failed for part in self.parts)
+
+
+class WritePlanner:
+    """Turn the commands from one MQTT message into a list of Modbus write requests.
+
+    Consecutive commands of the same input type are planned together, so that adjacent
+    coils or registers are written in a single request. Runs of coil commands and runs of
+    register commands keep their relative order.
+
+    Commands for coils and registers configured with `coalesce` are passed to `track` when
+    they are received. If a newer command for the same action has been tracked by the time
+    an older one is planned, the older one is dropped and counted in `coalesced`.
+
+    If `write_cache_max_age` is positive, a command that would write the same encoded value
+    as the last successful write to its coil or register, no more than that many seconds ago,
+    is skipped and counted in `skipped`. Clients report successful writes with `written`.
+
+    If `payload_cache_size` is positive, the registers of that many recent holding register
+    values are kept in `payload_cache`, so that a repeated value is not encoded again.
+    """
+
+    def __init__(
+        self,
+        configuration: Configuration,
+        error_handler: ErrorHandler,
+        max_coils_per_write: int = MAX_COILS_PER_WRITE,
+        write_cache_max_age: float = 0,
+        payload_cache_size: int = 0,
+    ) -> None:
+        self.configuration = configuration
+        self.error_handler = error_handler
+        self.max_coils_per_write = max_coils_per_write
+        self._devices = {
+            device.name: device
+            for device in configuration.get_modbus_settings().get_devices()
+        }
+        self.coalesced = 0
+        self.skipped = 0
+        self.write_cache = None
+        if write_cache_max_age > 0:
+            self.write_cache = WriteCache(write_cache_max_age)
+        self.payload_cache = None
+        if payload_cache_size > 0:
+            self.payload_cache = PayloadCache(payload_cache_size)
+        self._latest = {}
+        self._latest_lock = threading.Lock()
+
+    def get_device(self, name: str) -> ModbusDevice:
+        return self._devices.get(name) or self._devices[DEFAULT_DEVICE]
+
+    def track(self, messages: list) -> None:
+        # The latest command stays tracked once written, so an older one planned late is dropped
+        with self._latest_lock:
+            for message in messages:
+                if message.configuration.coalesce:
+                    self._latest[message.name] = message
+
+    def _coalesce(self, messages: list) -> list:
+        with self._latest_lock:
+            current = []
+            for message in messages:
+                latest = self._latest.get(message.name, message)
+                if latest is not message:
+                    self.coalesced += 1
+                    continue
+                current.append(message)
+            return current
+
+    def plan(self, messages: list) -> list[WriteRequest]:
+        requests = []
+        for input_type, group in itertools.groupby(
+            self._coalesce(messages), key=lambda message: message.input_type
+        ):
+            requests.extend(self._plan_run(input_type, group))
+        return requests
+
+    def written(self, request: WriteRequest) -> None:
+        if self.write_cache and request.completes_write:
+            for command, payload in zip(request.commands, request.payloads):
+                self.write_cache.store(request.device.name, command.name, payload)
+
+    def invalidate(self, device: ModbusDevice) -> None:
+        """Forget the values cached for a device, so that they are written again."""
+        if self.write_cache:
+            self.write_cache.invalidate(device.name)
+
+    def report_failure(self, ex: Exception, request: WriteRequest):
+        request.failed = True
+        self.invalidate(request.device)
+        # Every command in a failed request is reported, so that none go missing silently
+        for command in request.commands:
+            message = str(ex)
+            if request.parts:
+                end = request.address + len(request.values) - 1
+                message = f"{ex} (action {command.name!r}, addresses {request.address} to {end})"
+            elif len(request.commands) > 1:
+                message = f"{ex} (action {command.name!r})"
+            self.error_handler.publish(
+                self.error_handler.Category.MODBUS_ERROR, message
+            )
+
+    def _plan_per_device(self, pending: dict, plan) -> list[WriteRequest]:
+        requests = []
+        for device_name, writes in pending.items():
+            for request in plan(writes):
+                request.device = self._devices[device_name]
+                if request.input_type == InputTypes.COIL and len(request.values) == 1:
+                    request.single_coil = not isinstance(
+                        request.commands[0].value, list
+                    )
+                requests.append(request)
+        return requests
+
+    def _plan_run(self, input_type: str, messages) -> list[WriteRequest]:
+        pending = {}
+        for message in messages:
+            entry = self.configuration.get_command(message.name)
+            if not entry or entry.input_type != input_type:
+                continue
+            try:
+                if self.payload_cache and input_type == InputTypes.REGISTER:
+                    values = self.payload_cache.encode(entry, message.value)
+                else:
+                    values = entry.encoder(message.value)
+            except (AttributeError, RuntimeError, struct.error) as ex:
+                self.error_handler.publish(
+                    self.error_handler.Category.INVALID_MESSAGE, str(ex)
+                )
+                continue
+            if self.write_cache and self.write_cache.is_unchanged(
+                entry.device, message.name, values
+            ):
+                self.skipped += 1
+                continue
+            pending.setdefault(entry.device, []).append(
+                PendingWrite(entry.address, values, message)
+            )
+        if input_type == InputTypes.COIL:
+            return self._plan_per_device(
+                pending,
+                lambda writes: plan_coil_writes(writes, self.max_coils_per_write),
+            )
+        return self._plan_per_device(pending, plan_register_writes)
+
+
+def plan_register_writes(
+    writes: list[PendingWrite], max_span: int = MAX_REGISTERS_PER_WRITE
+) -> list[WriteRequest]:
+    return _plan_writes(
+        writes, min(max_span, MAX_REGISTERS_PER_WRITE), InputTypes.REGISTER
+    )
+
+
+def plan_coil_writes(
+    writes: list[PendingWrite], max_span: int = MAX_COILS_PER_WRITE
+) -> list[WriteRequest]:
+    return _plan_writes(writes, min(max_span, MAX_COILS_PER_WRITE), InputTypes.COIL)
+
+
+def _plan_writes(
+    writes: list[PendingWrite], max_span: int, input_type: str
+) -> list[WriteRequest]:
+    """Merge writes into blocks of contiguous addresses.
+
+    Writes are given in the order they appeared in the message. Where two writes overlap, the
+    later one wins for the overlapping registers, just as if they had been sent one by one.
+    A write that is longer than `max_span` on its own is split into consecutive requests of at
+    most `max_span`, written in order.
+    """
+    blocks = []
+    by_address = sorted(range(len(writes)), key=lambda i: writes[i].address)
+    for index in by_address:
+        write = writes[index]
+        end = write.address + len(write.values)
+        if blocks:
+            start, block_end, members = blocks[-1]
+            if write.address <= block_end and max(end, block_end) - start <= max_span:
+                members.append(index)
+                blocks[-1] = (start, max(end, block_end), members)
+                continue
+        blocks.append((write.address, end, [index]))
+
+    requests = []
+    for start, end, members in blocks:
+        if end - start > max_span:
+            # Only a single write can be this long
+            requests.extend(_split_write(writes[members[0]], max_span, input_type))
+            continue
+        values = [None] * (end - start)
+        members.sort()
+        for index in members:
+            write = writes[index]
+            for position, value in enumerate(write.values, write.address - start):
+                values[position] = value
+        commands = [writes[index].command for index in members]
+        payloads = [writes[index].values for index in members]
+        requests.append(
+            WriteRequest(start, values, commands, input_type, payloads=payloads)
+        )
+    return requests
+
+
+def _split_write(
+    write: PendingWrite, max_span: int, input_type: str
+) -> list[WriteRequest]:
+    parts = []
+    for start in range(0, len(write.values), max_span):
+        end = start + max_span
+        parts.append(
+            WriteRequest(
+                write.address + start,
+                write.values[start:end],
+                [write.command],
+                input_type,
+                payloads=[write.values],
+            )
+        )
+    for part in parts:
+        part.parts = parts
+    return parts
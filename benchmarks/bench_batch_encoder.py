@@ -0,0 +1,40 @@
+"""Compare encoding a list of register values one at a time and as one list.
+
+Reports values per second for a 96-value table, for each numeric data type. "per value" encodes
+each value with the compiled single-value encoder, and "list" passes the whole list, which is
+vectorized with NumPy when it is installed.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_batch_encoder
+"""
+
+import timeit
+
+from app import register_encoder
+from app.memory_order import MemoryOrder
+from app.register_encoder import compile_encoder
+
+DATA_TYPES = ("INT16", "UINT32", "FLOAT32-IEEE", "FLOAT64-IEEE")
+VALUES = list(range(96))
+
+
+def main():
+    backend = "numpy" if register_encoder.np is not None else "python"
+    print(f"list encoding uses {backend}")
+    print(f"{'data type':<14}{'per value/s':>14}{'list/s':>14}")
+    for data_type in DATA_TYPES:
+        encoder = compile_encoder(data_type, MemoryOrder("CDAB"))
+        cases = (
+            lambda: [register for value in VALUES for register in encoder(value)],
+            lambda: encoder(VALUES),
+        )
+        rates = []
+        for case in cases:
+            elapsed = min(timeit.repeat(case, number=2000, repeat=3))
+            rates.append(2000 * len(VALUES) / elapsed)
+        print(f"{data_type:<14}{rates[0]:>14,.0f}{rates[1]:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
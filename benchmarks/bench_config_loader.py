@@ -0,0 +1,76 @@
+"""Measure how long configurations with many coils and holding registers take to load.
+
+Generates configurations of 100, 10,000 and 100,000 entries, half coils and half holding
+registers, with their site settings taken from environment variables, and reports the time
+`Configuration.from_file` takes for each, and the time taken to load it from a snapshot.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_config_loader
+"""
+
+import os
+import tempfile
+import time
+
+from app import config_snapshot
+from app.configuration import Configuration
+
+SIZES = (100, 10_000, 100_000)
+
+_HEADER = """\
+site_settings:
+  site_name: ${BENCH_SITE_NAME}
+  serial_number: ${BENCH_SERIAL_NUMBER}
+mqtt_settings:
+  host: mqtt.host
+  port: 1883
+  command_topic: commands/#
+  error_topic: errors/${BENCH_SITE_NAME}
+modbus_settings:
+  host: modbus.host
+  port: 502
+modbus_mapping:
+"""
+
+
+def write_configuration(file, size: int) -> None:
+    file.write(_HEADER)
+    file.write("  coils:\n")
+    for index in range(size // 2):
+        file.write(f"    - name: coil{index}\n      address: [{index}]\n")
+    file.write("  holding_registers:\n")
+    for index in range(size - size // 2):
+        file.write(
+            f"    - name: register{index}\n"
+            f"      address: [{2 * index}]\n"
+            "      byte_order: CDAB\n"
+            "      data_type: INT32\n"
+            "      scale: 10.0\n"
+        )
+
+
+def main():
+    os.environ["BENCH_SITE_NAME"] = "site"
+    os.environ["BENCH_SERIAL_NUMBER"] = "1234"
+    print(f"{'entries':>10}{'load (s)':>12}{'snapshot (s)':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            path = os.path.join(directory, f"configuration-{size}.yaml")
+            with open(path, "w", encoding="UTF8") as file:
+                write_configuration(file, size)
+            start = time.perf_counter()
+            configuration = Configuration.from_file(path)
+            elapsed = time.perf_counter() - start
+            assert len(configuration.command_table) == size
+
+            config_snapshot.load(path)
+            start = time.perf_counter()
+            configuration = config_snapshot.load(path)
+            snapshot_elapsed = time.perf_counter() - start
+            assert len(configuration.command_table) == size
+            print(f"{size:>10,}{elapsed:>12.3f}{snapshot_elapsed:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Compare parsing command messages with each installed JSON backend.
+
+Reports messages per second for messages of 1, 10 and 1,000 commands. The "json" row is the
+standard library path: the payload is decoded to a `str`, parsed and then checked in Python.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_json_decoder
+"""
+
+import json
+import timeit
+
+from app import json_decoder
+from app.message import CommandMessageList
+
+BATCH_SIZES = (1, 10, 1000)
+BACKENDS = [name for name in json_decoder.BACKENDS if json_decoder.is_installed(name)]
+
+
+def payload(size: int) -> bytes:
+    commands = [
+        {"action": f"register{index}", "value": index * 1.5} for index in range(size)
+    ]
+    return json.dumps(commands).encode()
+
+
+def main():
+    headings = "".join(f"{f'{size} cmd msg/s':>18}" for size in BATCH_SIZES)
+    print(f"{'backend':<10}{headings}")
+    for backend in BACKENDS:
+        CommandMessageList.use_backend(backend)
+        row = f"{backend:<10}"
+        for size in BATCH_SIZES:
+            message = payload(size)
+            number = max(10, 20000 // size)
+            elapsed = min(
+                timeit.repeat(
+                    lambda: CommandMessageList.read(message), number=number, repeat=3
+                )
+            )
+            row += f"{number / elapsed:>18,.0f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Compare the cost per command of validating a coil value with pydantic and in plain Python.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_message_validator
+"""
+
+import timeit
+
+from pydantic import ValidationError, validate_call
+
+from app.validation import is_bool
+
+VALUES = [True, 0, 1.0, "on", "FALSE", "foo", 23, None]
+NUMBER = 100000
+
+
+@validate_call
+def pydantic_is_bool(value: bool) -> bool:
+    return True
+
+
+def pydantic_validate(value):
+    try:
+        return pydantic_is_bool(value)
+    except ValidationError:
+        return False
+
+
+def main():
+    print(f"{'value':<10}{'pydantic ns':>13}{'plain ns':>10}{'speedup':>9}")
+    for value in VALUES:
+        assert pydantic_validate(value) == is_bool(value), value
+        before = min(
+            timeit.repeat(lambda: pydantic_validate(value), number=NUMBER, repeat=3)
+        )
+        after = min(timeit.repeat(lambda: is_bool(value), number=NUMBER, repeat=3))
+        print(
+            f"{value!r:<10}{before / NUMBER * 1e9:>13.0f}"
+            f"{after / NUMBER * 1e9:>10.0f}{before / after:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
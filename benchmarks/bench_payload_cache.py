@@ -0,0 +1,39 @@
+"""Compare encoding repeated setpoints with and without the payload cache.
+
+Reports values per second for a stream cycling through five setpoints, for a FLOAT32 and an
+INT32 holding register.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_payload_cache
+"""
+
+import timeit
+
+from app.configuration import HoldingRegister, _command_entry
+from app.memory_order import MemoryOrder
+from app.payload_cache import PayloadCache
+
+SETPOINTS = [0, 5000, -5000, 10000, -10000] * 200
+
+
+def main():
+    print(f"{'data type':<14}{'encoder/s':>14}{'cached/s':>14}")
+    for data_type in ("FLOAT32-IEEE", "INT32"):
+        entry = _command_entry(
+            HoldingRegister("setpoint", MemoryOrder("CDAB"), data_type, 1.0, [1])
+        )
+        cache = PayloadCache(1024)
+        cases = (
+            lambda: [entry.encoder(value) for value in SETPOINTS],
+            lambda: [cache.encode(entry, value) for value in SETPOINTS],
+        )
+        rates = []
+        for case in cases:
+            elapsed = min(timeit.repeat(case, number=200, repeat=3))
+            rates.append(200 * len(SETPOINTS) / elapsed)
+        print(f"{data_type:<14}{rates[0]:>14,.0f}{rates[1]:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
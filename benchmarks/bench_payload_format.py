@@ -0,0 +1,49 @@
+"""Compare the size and parsing speed of command messages in each payload format.
+
+Reports the payload size in bytes and messages per second for a message of 100 commands. JSON
+is parsed with the fastest installed backend; MessagePack needs `msgspec` or `msgpack`, and CBOR
+`cbor2`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_payload_format
+"""
+
+import json
+import timeit
+
+from app import payload_format
+from app.message import CommandMessageList
+
+SIZE = 100
+
+
+def encoders() -> dict:
+    formats = {payload_format.JSON: lambda commands: json.dumps(commands).encode()}
+    if payload_format.is_available(payload_format.MSGPACK):
+        if payload_format.msgpack:
+            formats[payload_format.MSGPACK] = payload_format.msgpack.packb
+        else:
+            formats[payload_format.MSGPACK] = payload_format.msgspec.msgpack.encode
+    if payload_format.is_available(payload_format.CBOR):
+        formats[payload_format.CBOR] = payload_format.cbor2.dumps
+    return formats
+
+
+def main():
+    commands = [
+        {"action": f"register{index}", "value": index * 1.5} for index in range(SIZE)
+    ]
+    print(f"{'format':<10}{'bytes':>10}{'msg/s':>14}")
+    for fmt, encode in encoders().items():
+        message = encode(commands)
+        elapsed = min(
+            timeit.repeat(
+                lambda: CommandMessageList.read(message, fmt), number=2000, repeat=3
+            )
+        )
+        print(f"{fmt:<10}{len(message):>10,}{2000 / elapsed:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
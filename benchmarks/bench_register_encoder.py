@@ -0,0 +1,59 @@
+"""Compare encoding a register value with `PayloadBuilder` and with a compiled encoder.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_register_encoder
+"""
+
+import timeit
+
+from app.memory_order import MemoryOrder
+from app.register_encoder import compile_encoder
+from app.payload_builder import PayloadBuilder
+
+DATA_TYPES = {
+    "FLOAT64-IEEE": 1234.5678,
+    "FLOAT32-IEEE": 1234.5,
+    "FLOAT32": 1234.5,
+    "FLOAT16-IEEE": 12.5,
+    "INT8": -12,
+    "UINT8": 12,
+    "INT16": -1234,
+    "UINT16": 1234,
+    "INT32": -123456,
+    "UINT32": 123456,
+    "INT64": -1234567890123,
+    "UINT64": 1234567890123,
+    "STRING": "setpoint",
+}
+NUMBER = 20000
+
+
+def payload_builder(data_type, memory_order):
+    def encode(value):
+        builder = PayloadBuilder()
+        builder.set_data_type(data_type)
+        builder.set_value(value)
+        builder.set_memory_order(memory_order)
+        return builder.build()
+
+    return encode
+
+
+def main():
+    memory_order = MemoryOrder("CDAB")
+    print(f"{'data type':<14}{'builder us':>12}{'compiled us':>13}{'speedup':>9}")
+    for data_type, value in DATA_TYPES.items():
+        builder = payload_builder(data_type, memory_order)
+        compiled = compile_encoder(data_type, memory_order)
+        assert builder(value) == compiled(value), data_type
+        before = min(timeit.repeat(lambda: builder(value), number=NUMBER, repeat=3))
+        after = min(timeit.repeat(lambda: compiled(value), number=NUMBER, repeat=3))
+        print(
+            f"{data_type:<14}{before / NUMBER * 1e6:>12.2f}"
+            f"{after / NUMBER * 1e6:>13.2f}{before / after:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
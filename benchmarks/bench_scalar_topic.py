@@ -0,0 +1,47 @@
+"""Compare reading a single setpoint as a JSON command list and as a scalar message.
+
+Reports messages per second through `MqttReader`'s message callback, from payload to validated
+and transformed `CommandMessage`, for the same setpoint sent each way.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scalar_topic
+"""
+
+import json
+import timeit
+from unittest.mock import MagicMock
+
+from paho.mqtt.client import MQTTMessage
+
+from app.configuration import Configuration
+from app.mqtt_reader import MqttReader
+
+NUMBER = 20000
+
+
+def main():
+    configuration = Configuration.from_file("tests/config/example_configuration.yaml")
+    configuration.mqtt_settings.scalar_topic = "setpoints"
+    reader = MqttReader(configuration, MagicMock(), MagicMock())
+    on_message = reader._on_message()
+
+    list_message = MQTTMessage(topic=b"commands/site")
+    list_message.payload = json.dumps(
+        [{"action": "evgBatteryTargetPowerWatts", "value": 2.5}]
+    ).encode()
+    scalar_message = MQTTMessage(topic=b"setpoints/evgBatteryTargetPowerWatts")
+    scalar_message.payload = b"2.5"
+
+    print(f"{'message':<10}{'msg/s':>14}")
+    for name, message in (("list", list_message), ("scalar", scalar_message)):
+        elapsed = min(
+            timeit.repeat(
+                lambda: on_message(None, None, message), number=NUMBER, repeat=3
+            )
+        )
+        print(f"{name:<10}{NUMBER / elapsed:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
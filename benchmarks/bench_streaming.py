@@ -0,0 +1,75 @@
+"""Compare peak memory and time to the first write when reading a large message whole or streamed.
+
+Each mode reads one message of 10,000, 100,000 and 1,000,000 commands in a fresh process, and
+reports the growth in peak resident set size (RSS) while the message is handled, and the time
+until the first batch of commands is passed on for writing. The growth is 0 while it stays
+under the peak reached when the process started.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_streaming
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+from unittest.mock import MagicMock
+
+from paho.mqtt.client import MQTTMessage
+
+SIZES = (10000, 100000, 1000000)
+MODES = ("whole", "streamed")
+
+
+def measure(mode: str, size: int) -> None:
+    from app.configuration import Configuration
+    from app.mqtt_reader import MqttReader
+
+    configuration = Configuration.from_file("tests/config/example_configuration.yaml")
+    if mode == "streamed":
+        configuration.mqtt_settings.stream_threshold = 1
+    reader = MqttReader(configuration, MagicMock(), MagicMock())
+    first_batch = []
+    reader.add_batch_callback(
+        lambda batch: first_batch or first_batch.append(time.perf_counter())
+    )
+    on_message = reader._on_message()
+
+    message = MQTTMessage(topic=b"commands/site")
+    message.payload = json.dumps(
+        [
+            {"action": "evgBatteryTargetPowerWatts", "value": i * 0.5}
+            for i in range(size)
+        ]
+    ).encode()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    on_message(None, None, message)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    print(
+        f"{(rss_after - rss_before) / 1024:.1f} {(first_batch[0] - start) * 1000:.1f}"
+    )
+
+
+def main():
+    print(f"{'commands':>10}{'mode':>10}{'peak RSS MiB':>14}{'first write ms':>16}")
+    for size in SIZES:
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_streaming", mode, str(size)],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.split()
+            print(f"{size:>10,}{mode:>10}{output[0]:>14}{output[1]:>16}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,34 @@
+"""Compare transforming holding register values one at a time and as a batch.
+
+Reports values per second for a scaled, inverted INT32 register, with debug logging disabled.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_transform
+"""
+
+import timeit
+
+from app.configuration import HoldingRegister
+from app.memory_order import MemoryOrder
+
+VALUES = [index * 0.5 for index in range(1000)]
+
+
+def main():
+    register = HoldingRegister(
+        "register", MemoryOrder("CDAB"), "INT32", 10.0, [1], invert_sign=True
+    )
+    transform, transform_many = register.transform, register.transform_many
+    cases = {
+        "one at a time": lambda: [transform(value) for value in VALUES],
+        "batch": lambda: transform_many(VALUES),
+    }
+    print(f"{'transform':<16}{'values/s':>14}")
+    for name, case in cases.items():
+        elapsed = min(timeit.repeat(case, number=200, repeat=3))
+        print(f"{name:<16}{200 * len(VALUES) / elapsed:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,14 +19,18 @@ Note:
 
 """
 
+import asyncio
 import logging
 import os
 
 import signal
 import sys
 import paho.mqtt.client as mqtt
-from pymodbus.client import ModbusTcpClient
+from pymodbus.client import AsyncModbusTcpClient, ModbusTcpClient
 
+from app import async_runtime
+from app.async_modbus_client import AsyncModbusClient
+from app.command_queue import CommandQueue
 from app.error_handler import ErrorHandler
 from app.modbus_client import ModbusClient
 from app.mqtt_reader import MqttReader
@@ -38,8 +42,40 @@ from app.exceptions import (
 from app.remote_command_handler import RemoteCommandHandler
 
 
-def setup_error_handler(configuration: Configuration) -> ErrorHandler:
-    return ErrorHandler(configuration, mqtt.Client(mqtt.CallbackAPIVersion.VERSION2))
+def setup_mqtt_connection(
+    configuration: Configuration, client_id: str = None, manual_ack: bool = False
+) -> mqtt.Client:
+    protocol = (
+        mqtt.MQTTv5
+        if configuration.get_mqtt_settings().protocol_version == "5"
+        else mqtt.MQTTv311
+    )
+    options = {}
+    if client_id and protocol == mqtt.MQTTv311:
+        # The broker keeps the session, and the messages not yet acknowledged
+        options["clean_session"] = False
+    return mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id=client_id or "",
+        protocol=protocol,
+        manual_ack=manual_ack,
+        **options,
+    )
+
+
+def setup_reader_connection(configuration: Configuration) -> mqtt.Client:
+    mqtt_settings = configuration.get_mqtt_settings()
+    return setup_mqtt_connection(
+        configuration, mqtt_settings.client_id, mqtt_settings.manual_ack
+    )
+
+
+def setup_error_handler(
+    configuration: Configuration, mqtt_client: mqtt.Client = None
+) -> ErrorHandler:
+    return ErrorHandler(
+        configuration, mqtt_client or setup_mqtt_connection(configuration)
+    )
 
 
 def setup_modbus_client(
@@ -55,16 +91,59 @@ def setup_modbus_client(
     )
 
 
-def setup_mqtt_client(
+def setup_command_queue(
+    configuration: Configuration,
+    error_handler: ErrorHandler,
+    modbus_client: ModbusClient,
+) -> CommandQueue:
+    queue_settings = configuration.get_queue_settings()
+    if not queue_settings.enabled:
+        return None
+    return CommandQueue(
+        modbus_client.write_commands,
+        error_handler,
+        queue_settings.capacity,
+        queue_settings.overflow_policy,
+        queue_settings.workers,
+    )
+
+
+def setup_async_modbus_client(
     configuration: Configuration, error_handler: ErrorHandler
+) -> AsyncModbusClient:
+    modbus_settings = configuration.get_modbus_settings()
+    return AsyncModbusClient(
+        configuration,
+        AsyncModbusTcpClient(
+            modbus_settings.host,
+            port=modbus_settings.port,
+            reconnect_delay=modbus_settings.reconnect_delay,
+            reconnect_delay_max=modbus_settings.reconnect_delay_max,
+        ),
+        error_handler,
+    )
+
+
+def setup_mqtt_client(
+    configuration: Configuration,
+    error_handler: ErrorHandler,
+    mqtt_client: mqtt.Client = None,
 ) -> MqttReader:
     return MqttReader(
         configuration,
-        mqtt.Client(mqtt.CallbackAPIVersion.VERSION2),
+        mqtt_client or setup_reader_connection(configuration),
         error_handler,
     )
 
 
+async def run_asyncio(
+    configuration: Configuration, error_handler: ErrorHandler, mqtt_reader: MqttReader
+):
+    # pymodbus binds its async client to the running event loop, so it is created here
+    modbus_client = setup_async_modbus_client(configuration, error_handler)
+    await async_runtime.run(mqtt_reader, modbus_client)
+
+
 def main():
     loglevel = os.getenv("LOGLEVEL", "INFO").upper()
     logging.basicConfig(
@@ -87,18 +166,60 @@ def main():
         f"Starting service at {configuration.get_site_settings().site_name}"
         f"/{configuration.get_site_settings().serial_number}"
     )
-    error_handler = setup_error_handler(configuration)
+    shared_client = None
+    if configuration.get_mqtt_settings().shared_connection:
+        # The reader connects the client and runs its network loop
+        shared_client = setup_reader_connection(configuration)
+    error_handler = setup_error_handler(configuration, shared_client)
+    error_handler.start()
+    mqtt_reader = setup_mqtt_client(configuration, error_handler, shared_client)
+
+    def stop_error_handler():
+        error_handler.stop()
+        if error_handler.dropped:
+            logging.warning(
+                f"Dropped {error_handler.dropped} error message(s), "
+                "the error queue was full"
+            )
+        if error_handler.suppressed:
+            logging.warning(
+                f"Suppressed {error_handler.suppressed} error message(s) "
+                "over the error rate"
+            )
+
+    if args.runtime == "asyncio":
+        asyncio.run(run_asyncio(configuration, error_handler, mqtt_reader))
+        stop_error_handler()
+        return
+
     modbus_client = setup_modbus_client(configuration, error_handler)
-    mqtt_reader = setup_mqtt_client(configuration, error_handler)
+    command_queue = setup_command_queue(configuration, error_handler, modbus_client)
 
-    def write_to_modbus(message):
-        modbus_client.write_command(message)
+    def write_to_modbus(messages):
+        modbus_client.write_commands(messages)
 
-    mqtt_reader.add_message_callback(write_to_modbus)
+    if command_queue:
+        mqtt_reader.add_batch_callback(command_queue.put, deferred=True)
+        command_queue.start()
+    else:
+        mqtt_reader.add_batch_callback(write_to_modbus)
 
     def signal_handler(signum, _):
         logging.info(f"Received signal {signum}, shutting down...")
         mqtt_reader.stop()
+        if command_queue:
+            command_queue.stop()
+            logging.info(f"Command queue metrics: {command_queue.metrics()}")
+        logging.info(
+            f"Coalesced {modbus_client.coalesced} superseded command(s), "
+            f"skipped {modbus_client.skipped} unchanged command(s)"
+        )
+        if modbus_client.payload_cache:
+            logging.info(
+                f"Payload cache metrics: {modbus_client.payload_cache.metrics()}"
+            )
+        modbus_client.close()
+        stop_error_handler()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
@@ -0,0 +1,182 @@
+"""Unit tests for the AsyncModbusClient class in the app.async_modbus_client module."""
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from app.memory_order import MemoryOrder
+from app.message import CommandMessage
+from app.async_modbus_client import AsyncModbusClient
+from app.configuration import (
+    Coil,
+    Configuration,
+    ModbusDevice,
+    ModbusSettings,
+    HoldingRegister,
+    SiteSettings,
+)
+from app.error_handler import ErrorHandler
+
+
+class MockGoodModbusResponse:
+    def isError(self):
+        return False
+
+
+class MockBadModbusResponse:
+    def isError(self):
+        return True
+
+    def __str__(self):
+        return "bad response"
+
+
+class TestAsyncModbusClient:
+    def setup_method(self):
+        self.coils = [Coil("coil_a", [1]), Coil("coil_b", [2])]
+        self.holding_registers = [
+            HoldingRegister("reg_a", MemoryOrder("AB"), "INT16", 1.0, [10]),
+            HoldingRegister("reg_b", MemoryOrder("AB"), "INT16", 1.0, [11]),
+        ]
+        self.mock_client = MagicMock(spec=AsyncModbusTcpClient)
+        self.mock_client.connected = True
+        self.mock_client.connect = AsyncMock(return_value=True)
+        for method in ("write_coil", "write_coils", "write_registers"):
+            setattr(
+                self.mock_client,
+                method,
+                AsyncMock(return_value=MockGoodModbusResponse()),
+            )
+        self.mock_error_handler = MagicMock(spec=ErrorHandler)
+        self.configuration = Configuration(
+            self.coils,
+            self.holding_registers,
+            {},
+            ModbusSettings("localhost", 5020),
+            SiteSettings("localhost", "DEV123"),
+        )
+        self.modbus_client = AsyncModbusClient(
+            self.configuration, self.mock_client, self.mock_error_handler
+        )
+
+    def _messages(self, *pairs):
+        return [
+            CommandMessage(name, value, self.configuration) for name, value in pairs
+        ]
+
+    def test_write_commands(self):
+        messages = self._messages(
+            ("reg_a", 1), ("reg_b", 2), ("coil_a", True), ("coil_b", False)
+        )
+        sent = asyncio.run(self.modbus_client.write_commands(messages))
+        assert sent == 4
+        self.mock_client.write_registers.assert_awaited_once_with(10, [1, 2], 1)
+        self.mock_client.write_coils.assert_awaited_once_with(1, [True, False], 1)
+
+        sent = asyncio.run(
+            self.modbus_client.write_command(self._messages(("coil_a", True))[0])
+        )
+        assert sent == 1
+        self.mock_client.write_coil.assert_awaited_once_with(1, True, 1)
+
+    def test_concurrent_writes_keep_order(self):
+        calls = []
+
+        async def write_registers(address, values, _slave):
+            calls.append(values[0])
+            await asyncio.sleep(0.01 if values[0] == 1 else 0)
+            return MockGoodModbusResponse()
+
+        self.mock_client.write_registers = write_registers
+
+        async def write_all():
+            return await asyncio.gather(
+                *[
+                    self.modbus_client.write_commands(self._messages(("reg_a", value)))
+                    for value in (1, 2, 3)
+                ]
+            )
+
+        assert asyncio.run(write_all()) == [1, 1, 1]
+        assert calls == [1, 2, 3]
+
+    def test_coalesces_superseded_writes(self):
+        self.holding_registers[0].coalesce = True
+        calls = []
+
+        async def write_registers(address, values, _slave):
+            calls.append(values[0])
+            await asyncio.sleep(0.01)
+            return MockGoodModbusResponse()
+
+        self.mock_client.write_registers = write_registers
+
+        def write(value):
+            return self.modbus_client.write_commands(self._messages(("reg_a", value)))
+
+        async def write_all():
+            first = asyncio.create_task(write(1))
+            await asyncio.sleep(0.001)
+            return await asyncio.gather(first, write(2), write(3))
+
+        # 2 is superseded by 3 while 1 is being written
+        assert asyncio.run(write_all()) == [1, 0, 1]
+        assert calls == [1, 3]
+        assert self.modbus_client.coalesced == 1
+
+    def test_connects_when_disconnected(self):
+        self.mock_client.connected = False
+        self.mock_client.connect.return_value = False
+        sent = asyncio.run(
+            self.modbus_client.write_commands(self._messages(("coil_a", True)))
+        )
+        assert sent == 0
+        self.mock_client.connect.assert_awaited()
+        self.mock_error_handler.publish.assert_called_with(
+            self.mock_error_handler.Category.MODBUS_ERROR,
+            "Not connected to Modbus server",
+        )
+
+    def test_write_failure(self):
+        self.mock_client.write_registers.return_value = MockBadModbusResponse()
+        asyncio.run(self.modbus_client.write_commands(self._messages(("reg_a", 1))))
+        self.mock_error_handler.publish.assert_called_with(
+            self.mock_error_handler.Category.MODBUS_ERROR, "bad response"
+        )
+
+        self.mock_client.write_coil.side_effect = ModbusException("timed out")
+        asyncio.run(self.modbus_client.write_commands(self._messages(("coil_a", True))))
+        self.mock_error_handler.publish.assert_called_with(
+            self.mock_error_handler.Category.MODBUS_ERROR, "Modbus Error: timed out"
+        )
+
+    def test_multiple_devices(self):
+        meter_client = MagicMock(spec=AsyncModbusTcpClient)
+        meter_client.connected = False
+        meter_client.connect = AsyncMock(return_value=True)
+        meter_client.write_coil = AsyncMock(return_value=MockGoodModbusResponse())
+        configuration = Configuration(
+            [Coil("meter_coil", [1], "meter"), Coil("local_coil", [1])],
+            [],
+            {},
+            ModbusSettings(
+                "localhost", 5020, devices=[ModbusDevice("meter", "10.0.0.5", 502, 3)]
+            ),
+            SiteSettings("localhost", "DEV123"),
+        )
+        modbus_client = AsyncModbusClient(
+            configuration,
+            self.mock_client,
+            self.mock_error_handler,
+            lambda host, port: meter_client,
+        )
+        messages = [
+            CommandMessage("meter_coil", True, configuration),
+            CommandMessage("local_coil", False, configuration),
+        ]
+        assert asyncio.run(modbus_client.write_commands(messages)) == 2
+        meter_client.connect.assert_awaited_once()
+        meter_client.write_coil.assert_awaited_once_with(1, True, 3)
+        self.mock_client.write_coil.assert_awaited_once_with(1, False, 1)
+        modbus_client.close()
+        meter_client.close.assert_called_once()
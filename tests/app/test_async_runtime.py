@@ -0,0 +1,123 @@
+"""Unit tests for the app.async_runtime module."""
+
+import asyncio
+import json
+import socket
+import threading
+from unittest.mock import AsyncMock, MagicMock
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import MQTTMessage
+from app import async_runtime
+from app.async_modbus_client import AsyncModbusClient
+from app.async_runtime import AsyncioMqttAdapter
+from app.configuration import Configuration
+from app.error_handler import ErrorHandler
+from app.mqtt_reader import MqttReader
+
+
+class TestAsyncioMqttAdapter:
+    def test_socket_callbacks(self):
+        async def exercise():
+            loop = asyncio.get_running_loop()
+            client = MagicMock(spec=mqtt.Client)
+            adapter = AsyncioMqttAdapter(loop, client)
+            assert client.on_socket_open == adapter.on_socket_open
+
+            ours, theirs = socket.socketpair()
+            adapter.on_socket_open(client, None, ours)
+            adapter.on_socket_register_write(client, None, ours)
+            theirs.send(b"x")
+            await asyncio.sleep(0.01)
+            client.loop_read.assert_called()
+            client.loop_write.assert_called()
+            adapter.on_socket_unregister_write(client, None, ours)
+            adapter.on_socket_close(client, None, ours)
+            ours.close()
+            theirs.close()
+
+        asyncio.run(exercise())
+
+    def test_register_write_from_another_thread(self):
+        async def exercise():
+            loop = asyncio.get_running_loop()
+            client = MagicMock(spec=mqtt.Client)
+            adapter = AsyncioMqttAdapter(loop, client)
+            # asyncio only allows the loop's own thread to register a writer
+            threads = []
+            add_writer = loop.add_writer
+            loop.add_writer = lambda *args: (
+                threads.append(threading.get_ident()) or add_writer(*args)
+            )
+
+            ours, theirs = socket.socketpair()
+            # As when the error flusher publishes on the reader's client
+            await asyncio.to_thread(
+                adapter.on_socket_register_write, client, None, ours
+            )
+            await asyncio.sleep(0.01)
+            assert threads == [threading.get_ident()]
+            client.loop_write.assert_called()
+            adapter.on_socket_unregister_write(client, None, ours)
+            ours.close()
+            theirs.close()
+
+        asyncio.run(exercise())
+
+    def test_reconnects(self, monkeypatch):
+        monkeypatch.setattr(async_runtime, "_MISC_INTERVAL", 0)
+
+        async def exercise():
+            client = MagicMock(spec=mqtt.Client)
+            client.loop_misc.return_value = mqtt.MQTT_ERR_NO_CONN
+            client.reconnect.side_effect = OSError("refused")
+            adapter = AsyncioMqttAdapter(asyncio.get_running_loop(), client)
+            adapter.start()
+            await asyncio.sleep(0.01)
+            adapter.stop()
+            return client
+
+        client = asyncio.run(exercise())
+        client.reconnect.assert_called()
+
+
+def test_run():
+    configuration = Configuration.from_file("tests/config/example_configuration.yaml")
+    mock_mqtt_client = MagicMock(spec=mqtt.Client)
+    mock_error_handler = MagicMock(spec=ErrorHandler)
+    mqtt_reader = MqttReader(configuration, mock_mqtt_client, mock_error_handler)
+    mock_modbus_client = MagicMock(spec=AsyncModbusClient)
+    mock_modbus_client.connect = AsyncMock(return_value=True)
+    written = []
+
+    async def write_commands(messages):
+        await asyncio.sleep(0)
+        written.append([msg.name for msg in messages])
+        if len(written) > 1:
+            raise RuntimeError("didn't expect that!")
+
+    mock_modbus_client.write_commands = write_commands
+
+    async def exercise():
+        stopped = asyncio.Event()
+        running = asyncio.create_task(
+            async_runtime.run(mqtt_reader, mock_modbus_client, stopped)
+        )
+        await asyncio.sleep(0)
+        mock_mqtt_client.connect.assert_called_with("mqtt.host", 9000)
+
+        for _ in range(2):
+            paho_msg = MQTTMessage()
+            paho_msg.payload = json.dumps(
+                [{"action": "evgBatteryModeCoil", "value": True}]
+            ).encode()
+            mock_mqtt_client.on_message(mock_mqtt_client, None, paho_msg)
+        stopped.set()
+        await running
+
+    asyncio.run(exercise())
+    assert written == [["evgBatteryModeCoil"], ["evgBatteryModeCoil"]]
+    mock_error_handler.publish.assert_called_with(
+        mock_error_handler.Category.UNHANDLED, "didn't expect that!"
+    )
+    mock_mqtt_client.disconnect.assert_called()
+    mock_modbus_client.close.assert_called()
@@ -0,0 +1,176 @@
+"""Unit tests for the CommandQueue class in the app.command_queue module."""
+
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from app.command_queue import CommandQueue, OverflowPolicy
+from app.error_handler import ErrorHandler
+
+
+def _batch(name, coalesce=False, device=None):
+    return [
+        SimpleNamespace(
+            name=name, configuration=SimpleNamespace(coalesce=coalesce, device=device)
+        )
+    ]
+
+
+class TestCommandQueue:
+    def setup_method(self):
+        self.mock_error_handler = MagicMock(spec=ErrorHandler)
+        self.mock_error_handler.Category = ErrorHandler.Category
+        self.written = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def handler(self, messages):
+        self.release.wait(5)
+        self.written.append(messages[0].name)
+
+    def test_writes_in_order(self):
+        queue = CommandQueue(self.handler, self.mock_error_handler, capacity=10)
+        queue.start()
+        for name in ("a", "b", "c"):
+            assert queue.put(_batch(name))
+        queue.stop(timeout=5)
+        assert self.written == ["a", "b", "c"]
+        metrics = queue.metrics()
+        assert metrics.enqueued == 3
+        assert metrics.processed == 3
+        assert metrics.depth == 0
+        assert metrics.dropped == 0
+
+    def test_drop_newest(self):
+        queue = CommandQueue(
+            self.handler, self.mock_error_handler, 2, OverflowPolicy.DROP_NEWEST
+        )
+        for name in ("a", "b", "c"):
+            queue.put(_batch(name))
+        metrics = queue.metrics()
+        assert metrics.depth == 2
+        assert metrics.max_depth == 2
+        assert metrics.dropped == 1
+        self.mock_error_handler.publish.assert_called_with(
+            ErrorHandler.Category.QUEUE_OVERFLOW,
+            "Command queue is full, dropped 1 command(s): c",
+        )
+        queue.start()
+        queue.stop(timeout=5)
+        assert self.written == ["a", "b"]
+
+    def test_drop_oldest(self):
+        queue = CommandQueue(self.handler, self.mock_error_handler, 2, "drop_oldest")
+        for name in ("a", "b", "c"):
+            assert queue.put(_batch(name))
+        assert queue.metrics().dropped == 1
+        self.mock_error_handler.publish.assert_called_with(
+            ErrorHandler.Category.QUEUE_OVERFLOW,
+            "Command queue is full, dropped 1 command(s): a",
+        )
+        queue.start()
+        queue.stop(timeout=5)
+        assert self.written == ["b", "c"]
+
+    def test_block(self):
+        self.release.clear()
+        queue = CommandQueue(self.handler, self.mock_error_handler, capacity=1)
+        queue.start()
+        queue.put(_batch("a"))
+        queue.put(_batch("b"))
+        producer = threading.Thread(target=queue.put, args=(_batch("c"),))
+        producer.start()
+        producer.join(0.1)
+        # The queue is full while "a" is being written, so the producer waits
+        assert producer.is_alive()
+        self.release.set()
+        producer.join(5)
+        assert not producer.is_alive()
+        queue.stop(timeout=5)
+        assert self.written == ["a", "b", "c"]
+        assert queue.metrics().dropped == 0
+
+    def test_handler_failure(self):
+        def failing_handler(messages):
+            raise RuntimeError("didn't expect that!")
+
+        queue = CommandQueue(failing_handler, self.mock_error_handler, workers=2)
+        queue.start()
+        queue.put(_batch("a"))
+        queue.put(_batch("b"))
+        queue.stop(timeout=5)
+        assert queue.metrics().processed == 2
+        self.mock_error_handler.publish.assert_called_with(
+            ErrorHandler.Category.UNHANDLED, "didn't expect that!"
+        )
+
+    def test_coalesce(self):
+        queue = CommandQueue(self.handler, self.mock_error_handler, capacity=2)
+        assert queue.put(_batch("setpoint", coalesce=True))
+        assert queue.put(_batch("other"))
+        # The superseded setpoint makes room, so the queue does not block
+        assert queue.put(_batch("setpoint", coalesce=True))
+        queue.start()
+        queue.stop(timeout=5)
+        assert self.written == ["other", "setpoint"]
+        metrics = queue.metrics()
+        assert metrics.coalesced == 1
+        assert metrics.dropped == 0
+
+    def test_on_done(self):
+        done = []
+        queue = CommandQueue(
+            self.handler,
+            self.mock_error_handler,
+            capacity=2,
+            overflow_policy=OverflowPolicy.DROP_NEWEST,
+        )
+        assert queue.put(_batch("setpoint", coalesce=True), lambda: done.append("a"))
+        assert queue.put(_batch("other"), lambda: done.append("b"))
+        # Entirely superseded, so done at once
+        assert queue.put(_batch("setpoint", coalesce=True), lambda: done.append("c"))
+        assert done == ["a"]
+        assert not queue.put(_batch("dropped"), lambda: done.append("d"))
+        assert done == ["a", "d"]
+        queue.start()
+        queue.stop(timeout=5)
+        assert done == ["a", "d", "b", "c"]
+
+    def test_workers_keep_order_per_device(self):
+        written = {"a": [], "b": []}
+
+        def handler(messages):
+            # Give the other workers a chance to overtake
+            time.sleep(0.0001)
+            written[messages[0].configuration.device].append(messages[0].name)
+
+        queue = CommandQueue(handler, self.mock_error_handler, capacity=10, workers=4)
+        queue.start()
+        for value in range(200):
+            queue.put(_batch(value, device="a"))
+            queue.put(_batch(value, device="b"))
+        queue.stop(timeout=5)
+        assert written == {"a": list(range(200)), "b": list(range(200))}
+
+    def test_workers_write_devices_in_parallel(self):
+        self.release.clear()
+        written_b = threading.Event()
+
+        def handler(messages):
+            if messages[0].configuration.device == "a":
+                self.release.wait(5)
+            self.written.append(messages[0].name)
+            if messages[0].name == "b1":
+                written_b.set()
+
+        queue = CommandQueue(handler, self.mock_error_handler, workers=2)
+        queue.start()
+        queue.put(_batch("a1", device="a"))
+        queue.put(_batch("a2", device="a"))
+        queue.put(_batch("b1", device="b"))
+        # "a2" waits for "a1", while the other worker writes "b1"
+        assert written_b.wait(5)
+        assert self.written == ["b1"]
+        self.release.set()
+        queue.stop(timeout=5)
+        assert self.written == ["b1", "a1", "a2"]
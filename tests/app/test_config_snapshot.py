@@ -0,0 +1,111 @@
+"""Unit tests for the app.config_snapshot module."""
+
+from pathlib import Path
+import shutil
+import tomllib
+
+import pytest
+
+from app import config_snapshot
+from app.configuration import Configuration
+from app.exceptions import ConfigurationFileNotFoundError
+from app.version import VERSION
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "configuration.yaml"
+    shutil.copy("tests/config/good_env_var_configuration.yaml", path)
+    return str(path)
+
+
+@pytest.fixture
+def site_env(monkeypatch):
+    monkeypatch.setenv("SITE_NAME", "site")
+    monkeypatch.setenv("SERIAL_NUMBER", "1234")
+
+
+def _fail_from_file(path):
+    raise AssertionError("loaded from the configuration file")
+
+
+def test_load_from_snapshot(config_path, site_env, monkeypatch):
+    configuration = config_snapshot.load(config_path)
+    snapshot_path = config_snapshot.snapshot_path_for(config_path)
+    assert configuration.get_site_settings().serial_number == 1234
+
+    monkeypatch.setattr(Configuration, "from_file", _fail_from_file)
+    snapshot = config_snapshot.load(config_path)
+    assert snapshot.get_site_settings().site_name == "site"
+    assert snapshot.get_mqtt_settings() == configuration.get_mqtt_settings()
+    assert list(snapshot.command_table) == list(configuration.command_table)
+    key = config_snapshot.snapshot_key(Path(config_path).read_bytes())
+    assert Path(snapshot_path).read_bytes().startswith(key)
+
+
+def test_compiled_functions_restored(tmp_path):
+    path = tmp_path / "configuration.yaml"
+    shutil.copy("tests/config/example_configuration.yaml", path)
+    configuration = config_snapshot.load(str(path))
+    snapshot = config_snapshot.load(str(path))
+    for register in configuration.get_holding_registers():
+        restored = snapshot.get_holding_register(register.name)
+        assert restored.encoder(1) == register.encoder(1)
+        assert restored.transform(2) == register.transform(2)
+        assert snapshot.get_command(register.name).encoder(1) == register.encoder(1)
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda path, monkeypatch: Path(path).write_text(
+            Path(path).read_text() + "# changed\n"
+        ),
+        lambda path, monkeypatch: monkeypatch.setenv("SERIAL_NUMBER", "5678"),
+        lambda path, monkeypatch: monkeypatch.setattr(
+            config_snapshot, "VERSION", "99.0.0"
+        ),
+    ],
+    ids=["file", "environment", "version"],
+)
+def test_stale_snapshot(config_path, site_env, monkeypatch, change):
+    config_snapshot.load(config_path)
+    change(config_path, monkeypatch)
+    loaded = []
+    from_file = Configuration.from_file
+    monkeypatch.setattr(
+        Configuration,
+        "from_file",
+        lambda path: loaded.append(path) or from_file(path),
+    )
+    config_snapshot.load(config_path)
+    assert loaded == [config_path]
+    # Replaced with an up to date snapshot
+    monkeypatch.setattr(Configuration, "from_file", _fail_from_file)
+    config_snapshot.load(config_path)
+
+
+def test_bad_snapshot(config_path, site_env, caplog):
+    snapshot_path = config_snapshot.snapshot_path_for(config_path)
+    key = config_snapshot.snapshot_key(Path(config_path).read_bytes())
+    Path(snapshot_path).write_bytes(key + b"not a pickle")
+    configuration = config_snapshot.load(config_path)
+    assert configuration.get_site_settings().site_name == "site"
+    assert "Cannot read configuration snapshot" in caplog.text
+
+
+def test_snapshot_not_written(config_path, site_env, caplog):
+    snapshot_path = str(config_path) + ".d/missing/configuration.snapshot"
+    configuration = config_snapshot.load(config_path, snapshot_path)
+    assert configuration.get_site_settings().site_name == "site"
+    assert "Cannot write configuration snapshot" in caplog.text
+
+
+def test_missing_file(tmp_path):
+    with pytest.raises(ConfigurationFileNotFoundError):
+        config_snapshot.load(str(tmp_path / "missing.yaml"))
+
+
+def test_version_matches_pyproject():
+    with open("pyproject.toml", "rb") as file:
+        assert tomllib.load(file)["tool"]["poetry"]["version"] == VERSION
@@ -0,0 +1,78 @@
+"""Unit tests for the app.error_aggregator module."""
+
+from freezegun import freeze_time
+
+from app.error_aggregator import ErrorAggregator, ErrorReport, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    # Refilled at two tokens a second
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+    assert [bucket.take(10) for _ in range(4)] == [True, True, True, False]
+
+
+def test_first_occurrence_reported_at_once():
+    aggregator = ErrorAggregator(window=60)
+    with freeze_time("2023-07-01 12:00:00") as frozen:
+        assert aggregator.add("ModbusError", "offline") == [
+            ErrorReport("ModbusError", "offline", 1, 1688212800.0, 1688212800.0)
+        ]
+        # A different message is reported at once too
+        assert len(aggregator.add("ModbusError", "other")) == 1
+        for _ in range(3):
+            frozen.tick(10)
+            assert aggregator.add("ModbusError", "offline") == []
+        assert aggregator.flush() == []
+
+        frozen.tick(31)
+        assert aggregator.flush() == [
+            ErrorReport("ModbusError", "offline", 3, 1688212810.0, 1688212830.0, True)
+        ]
+
+        # Still repeating, so counted for another window
+        assert aggregator.add("ModbusError", "offline") == []
+        frozen.tick(60)
+        (report,) = aggregator.flush()
+        assert report.count == 1
+
+        # A window without repeats ends the storm
+        frozen.tick(60)
+        assert aggregator.flush() == []
+        assert len(aggregator.add("ModbusError", "offline")) == 1
+
+
+def test_rate_limit():
+    aggregator = ErrorAggregator(rate=1, burst=2)
+    with freeze_time("2023-07-01 12:00:00") as frozen:
+        reports = [aggregator.add("ModbusError", f"error {i}") for i in range(4)]
+        assert [len(report) for report in reports] == [1, 1, 0, 0]
+        assert aggregator.suppressed == 2
+        # Each category has its own limit
+        assert len(aggregator.add("InvalidMessage", "bad")) == 1
+        frozen.tick(1)
+        assert len(aggregator.add("ModbusError", "error 5")) == 1
+
+
+def test_rate_limit_with_window():
+    aggregator = ErrorAggregator(window=10, rate=0.1, burst=1)
+    with freeze_time("2023-07-01 12:00:00") as frozen:
+        assert len(aggregator.add("ModbusError", "a")) == 1
+        # Over the limit, so held for the summary
+        assert aggregator.add("ModbusError", "b") == []
+        frozen.tick(10)
+        (report,) = aggregator.flush()
+        assert (report.message, report.count) == ("b", 1)
+        assert aggregator.suppressed == 0
+
+
+def test_flush_all():
+    aggregator = ErrorAggregator(window=60)
+    aggregator.add("ModbusError", "offline")
+    aggregator.add("ModbusError", "offline")
+    aggregator.add("ModbusError", "once")
+    (report,) = aggregator.flush(force=True)
+    assert (report.message, report.count, report.summary) == ("offline", 1, True)
+    assert aggregator.flush(force=True) == []
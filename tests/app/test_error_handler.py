@@ -2,7 +2,12 @@ from app.error_handler import ErrorHandler
 from app.configuration import Configuration, _mqtt_settings_from_yaml_data
 import paho.mqtt.client as mqtt
 from freezegun import freeze_time
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from pymodbus.client import ModbusTcpClient
+from app.exceptions import ModbusClientError
+from app.modbus_connection import ModbusConnection
+import pytest
+import json
 
 
 def example_config_path():
@@ -46,3 +51,86 @@ def test_error_payload():
         payload = call_args[1]
         assert '"timestamp": 1688212800.0' in payload
         assert '"message": "oops"' in payload
+
+
+def test_start_error_handler():
+    mock_mqtt_client = MagicMock(spec=mqtt.Client)
+    config = Configuration.from_file(example_config_path())
+    config.mqtt_settings.error_queue_size = 10
+    error = ErrorHandler(config, mock_mqtt_client)
+    error.start()
+    mock_mqtt_client.max_queued_messages_set.assert_called_with(10)
+    mock_mqtt_client.loop_start.assert_called()
+
+    info = mqtt.MQTTMessageInfo(1)
+    info.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+    mock_mqtt_client.publish.return_value = info
+    error.publish(error.Category.MODBUS_ERROR, "oops")
+    assert error.dropped == 1
+    mock_mqtt_client.connect.assert_not_called()
+    error.stop()
+    mock_mqtt_client.loop_stop.assert_called()
+
+
+def test_error_summary():
+    mock_mqtt_client = MagicMock(spec=mqtt.Client)
+    config = Configuration.from_file(example_config_path())
+    config.mqtt_settings.error_window = 60
+    error = ErrorHandler(config, mock_mqtt_client)
+
+    with freeze_time("2023-07-01 12:00:00") as frozen:
+        for _ in range(3):
+            error.publish(error.Category.MODBUS_ERROR, "offline")
+            frozen.tick(1)
+        # Only the first is published until the window ends
+        assert mock_mqtt_client.publish.call_count == 1
+        error.stop()
+
+    assert mock_mqtt_client.publish.call_count == 2
+    call_args, _ = mock_mqtt_client.publish.call_args
+    assert call_args[0] == "errors/ModbusError"
+    payload = json.loads(call_args[1])
+    assert payload["count"] == 2
+    assert payload["first_timestamp"] == 1688212801.0
+    assert payload["last_timestamp"] == 1688212802.0
+
+
+def test_shared_connection():
+    mock_mqtt_client = MagicMock(spec=mqtt.Client)
+    config = Configuration.from_file(example_config_path())
+    config.mqtt_settings.shared_connection = True
+    error = ErrorHandler(config, mock_mqtt_client)
+    error.start()
+    mock_mqtt_client.loop_start.assert_not_called()
+    error.publish(error.Category.MODBUS_ERROR, "oops")
+    mock_mqtt_client.connect.assert_not_called()
+    mock_mqtt_client.publish.assert_called()
+    error.stop()
+    mock_mqtt_client.disconnect.assert_not_called()
+
+
+def test_backoff_errors_are_summarised():
+    mock_mqtt_client = MagicMock(spec=mqtt.Client)
+    config = Configuration.from_file(example_config_path())
+    config.mqtt_settings.error_window = 60
+    error = ErrorHandler(config, mock_mqtt_client)
+    mock_modbus_client = MagicMock(spec=ModbusTcpClient)
+    mock_modbus_client.connect.return_value = False
+    connection = ModbusConnection(
+        mock_modbus_client, persistent=True, reconnect_delay=10, reconnect_delay_max=10
+    )
+
+    # Every command fails while the connection backs off, each at a different time
+    for now in (100.0, 100.5, 101.0, 101.5, 102.0):
+        with patch("app.modbus_connection.time.monotonic", return_value=now):
+            with pytest.raises(ModbusClientError) as ex:
+                connection.open()
+        error.publish(error.Category.MODBUS_ERROR, str(ex.value))
+
+    # The failed attempt and the first wait are published, and the other waits summarised
+    assert mock_mqtt_client.publish.call_count == 2
+    error.stop()
+    assert mock_mqtt_client.publish.call_count == 3
+    payload = json.loads(mock_mqtt_client.publish.call_args[0][1])
+    assert payload["message"] == "Modbus connection unavailable, waiting to reconnect"
+    assert payload["count"] == 3
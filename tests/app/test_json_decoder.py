@@ -0,0 +1,79 @@
+"""Tests for the json_decoder module."""
+
+import json
+import pytest
+from app import json_decoder
+from app.exceptions import InvalidMessageError
+from app.message import CommandMessageList
+
+VALID = [
+    b'[{"action": "somecoil", "value": true}]',
+    b'[{"action": "someregister", "value": 42.3, "extra": 1}, {"value": null, "action": "b"}]',
+    b"[]",
+]
+INVALID = [
+    b"not a real json string",
+    b"{'action': 'somecoil'}",
+    b'[{"action": "somecoil"}]',
+    b'[{"action": "", "value": 1}]',
+    b'[{"value": 1}]',
+    b"[1]",
+    b'{"action": "somecoil", "value": true}',
+]
+
+
+@pytest.fixture(params=["msgspec", "orjson"])
+def decode(request):
+    pytest.importorskip(request.param)
+    return json_decoder.get_decoder(request.param)
+
+
+@pytest.fixture(params=["msgspec", "orjson", "json"])
+def backend(request):
+    if request.param != "json":
+        pytest.importorskip(request.param)
+    CommandMessageList.use_backend(request.param)
+    yield request.param
+    CommandMessageList.use_backend("auto")
+
+
+@pytest.mark.parametrize("payload", VALID)
+def test_decodes_commands(decode, payload):
+    commands = decode(payload)
+    assert [(c["action"], c["value"]) for c in commands] == [
+        (c["action"], c["value"]) for c in json.loads(payload)
+    ]
+
+
+@pytest.mark.parametrize("payload", INVALID)
+def test_rejects_invalid_commands(decode, payload):
+    with pytest.raises(ValueError):
+        decode(payload)
+
+
+def test_fallback_backend():
+    assert json_decoder.get_decoder("json") is None
+    assert json_decoder.get_decoder("nosuchbackend") is None
+
+
+@pytest.mark.parametrize("payload", VALID)
+def test_read_valid(backend, payload):
+    commands = CommandMessageList.read(payload)
+    assert [(c["action"], c["value"]) for c in commands] == [
+        (c["action"], c["value"]) for c in json.loads(payload)
+    ]
+
+
+@pytest.mark.parametrize("payload", INVALID)
+def test_read_reports_the_same_errors(backend, payload):
+    def error(payload):
+        try:
+            CommandMessageList.read(payload)
+        except InvalidMessageError as ex:
+            return str(ex)
+
+    CommandMessageList.use_backend("json")
+    expected = error(payload.decode())
+    CommandMessageList.use_backend(backend)
+    assert expected is not None
+    assert error(payload) == expected
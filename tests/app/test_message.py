@@ -55,6 +55,64 @@ class TestCommandMessage:
             assert ex.type == InvalidMessageError
             json_obj[key] = json_obj["foo"]
 
+    def test_scalar_cmd_message(self):
+        for payload, value in [
+            (b"true", True),
+            (b"false", False),
+            (b"null", None),
+            (b" 42\n", 42),
+            (b"-1.5", -1.5),
+            (b"on", "on"),
+            (b'"say \\"hi\\""', 'say "hi"'),
+            ("12", 12),
+        ]:
+            read_msg = CommandMessageList.read_scalar("somecoil", payload)
+            assert read_msg == [{"action": "somecoil", "value": value}]
+            assert type(read_msg[0]["value"]) is type(value)
+
+        for payload, error in [
+            (b"", "Message for 'somecoil' has no value"),
+            (b"\xff", "Message is not valid UTF-8"),
+            (b'[{"action": "somecoil", "value": 1}]', "Message must be a single value"),
+            (b'"unterminated', "Message is invalid JSON syntax"),
+        ]:
+            with pytest.raises(InvalidMessageError) as ex:
+                CommandMessageList.read_scalar("somecoil", payload)
+            assert error in str(ex.value)
+
+    def test_stream_cmd_messages(self):
+        json_obj = [
+            {"action": "somecoil", "value": True},
+            "not a command",
+            {"action": "someregister", "value": [1, {"nested": "]"}]},
+        ]
+        assert list(CommandMessageList.stream(json.dumps(json_obj))) == json_obj
+        assert list(CommandMessageList.stream(b" [ ] \n")) == []
+
+        for json_str, parsed, error in [
+            ('{"action": "somecoil"}', [], "Message must be a list of commands"),
+            ("[1, 2", [1, 2], "Expecting ',' delimiter"),
+            ("[1 2]", [1], "Expecting ',' delimiter"),
+            ("[1,]", [1], "Expecting value"),
+            ("[1] x", [1], "Extra data"),
+        ]:
+            stream = CommandMessageList.stream(json_str)
+            with pytest.raises(InvalidMessageError) as ex:
+                for message_obj in parsed:
+                    assert next(stream) == message_obj
+                next(stream)
+            assert "Message" in str(ex.value) and error in str(ex.value)
+
+    def test_check_cmd_message(self):
+        command = {"action": "somecoil", "value": True}
+        assert CommandMessageList.check(command) is command
+        with pytest.raises(InvalidMessageError) as ex:
+            CommandMessageList.check([command])
+        assert "Message object must be a dict" in str(ex.value)
+        with pytest.raises(InvalidMessageError) as ex:
+            CommandMessageList.check({"action": "", "value": True})
+        assert "missing required components" in str(ex.value)
+
     def test_bad_cmd_message_syntax(self):
         json_str = "not a real json string"
         with pytest.raises(InvalidMessageError) as ex:
@@ -1,21 +1,27 @@
 """Unit tests for the ModbusClient class in the app.modbus_client module."""
 
+import json
 from unittest.mock import MagicMock
 from pymodbus.client import ModbusTcpClient
 from pymodbus.exceptions import ModbusException
 from app.memory_order import MemoryOrder
-from app.message import CommandMessage
+from app.message import CommandMessage, CommandMessageList
 from app.modbus_client import ModbusClient
 from app.configuration import (
     Coil,
     Configuration,
+    ModbusDevice,
     ModbusSettings,
     HoldingRegister,
+    InputTypes,
     SiteSettings,
 )
 from app.error_handler import ErrorHandler
 from app.exceptions import ModbusClientError
+from app.modbus_connection import ConnectionState
+from app.write_planner import WriteRequest
 import pytest
+import threading
 
 
 class MockGoodModbusResponse:
@@ -75,7 +81,9 @@ class TestModbusClient:
 
             msg = CommandMessage(coil.name, coil_list, self.configuration)
             sent = self.modbus_client.write_command(msg)
-            self.mock_client.write_coils.assert_called_with(coil.address[0], coil_list)
+            self.mock_client.write_coils.assert_called_with(
+                coil.address[0], coil_list, 1
+            )
             assert sent == 2
 
     def test_registers(self):
@@ -105,29 +113,71 @@ class TestModbusClient:
         )
         self.mock_client.write_coil.assert_called_with(1, True, 1)
 
-    def test_connect_failure(self):
-        self.mock_client.connect.side_effect = ModbusException("could not connect")
+    def test_write_lax_bool_coil_values(self):
         test_coil = self.coils[0]
-        with pytest.raises(ModbusClientError) as ex:
-            self.modbus_client._write_coil(test_coil.name, True)
-        assert "could not connect" in str(ex.value)
+        for commands, value in [
+            (CommandMessageList.read_scalar(test_coil.name, b"off"), False),
+            (CommandMessageList.read_scalar(test_coil.name, b"on"), True),
+            (
+                CommandMessageList.read(
+                    json.dumps([{"action": test_coil.name, "value": "false"}])
+                ),
+                False,
+            ),
+            (
+                CommandMessageList.read(
+                    json.dumps([{"action": test_coil.name, "value": "Yes"}])
+                ),
+                True,
+            ),
+        ]:
+            messages = [
+                CommandMessage(command["action"], command["value"], self.configuration)
+                for command in commands
+            ]
+            for message in messages:
+                message.validate()
+            assert self.modbus_client.write_commands(messages) == 1
+            self.mock_client.write_coil.assert_called_with(1, value, 1)
 
-        with pytest.raises(ModbusClientError) as ex:
-            self.modbus_client._write_coils(test_coil.name, [True, False])
-        assert "could not connect" in str(ex.value)
+        self.modbus_client.write_commands(
+            [CommandMessage(test_coil.name, ["off", "1", 0], self.configuration)]
+        )
+        self.mock_client.write_coils.assert_called_with(1, [False, True, False], 1)
 
+    def test_connect_failure(self):
+        self.mock_client.connect.side_effect = ModbusException("could not connect")
+        test_coil = self.coils[0]
         test_register = self.holding_registers[0]
         with pytest.raises(ModbusClientError) as ex:
-            self.modbus_client._write_register(test_register.name, 0)
+            self.modbus_client._write_request(
+                WriteRequest(
+                    test_coil.address[0],
+                    [True],
+                    input_type=InputTypes.COIL,
+                    device=self.modbus_settings.get_device(),
+                    single_coil=True,
+                )
+            )
         assert "could not connect" in str(ex.value)
 
-        self.modbus_client.write_command(
-            CommandMessage(test_coil.name, True, self.configuration)
-        )
-        self.mock_error_handler.publish.assert_called_with(
-            self.mock_error_handler.Category.MODBUS_ERROR,
-            "Modbus Error: could not connect",
-        )
+        for name, value in [
+            (test_coil.name, True),
+            (test_coil.name, [True, False]),
+            (test_register.name, 0),
+        ]:
+            self.mock_error_handler.reset_mock()
+            sent = self.modbus_client.write_commands(
+                [CommandMessage(name, value, self.configuration)]
+            )
+            assert sent == 0
+            self.mock_error_handler.publish.assert_called_with(
+                self.mock_error_handler.Category.MODBUS_ERROR,
+                "Modbus Error: could not connect",
+            )
+        self.mock_client.write_coil.assert_not_called()
+        self.mock_client.write_coils.assert_not_called()
+        self.mock_client.write_registers.assert_not_called()
         self.mock_client.connect.side_effect = None
 
     def test_bad_payload(self):
@@ -181,3 +231,423 @@ class TestModbusClient:
         self.mock_error_handler.publish.assert_called_with(
             self.mock_error_handler.Category.MODBUS_ERROR, "bad response"
         )
+
+    def test_persistent_connection(self):
+        modbus_settings = ModbusSettings("localhost", 5020, persistent_connection=True)
+        configuration = Configuration(
+            self.coils, self.holding_registers, {}, modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        self.mock_client.connect.return_value = True
+        self.mock_client.connected = True
+        for _ in range(3):
+            modbus_client.write_command(
+                CommandMessage(self.coils[0].name, True, configuration)
+            )
+        assert self.mock_client.connect.call_count == 1
+        assert modbus_client.connection_state == ConnectionState.CONNECTED
+
+        # A failed request drops the connection, and the next one reconnects
+        self.mock_client.write_coil.side_effect = ModbusException("broken pipe")
+        modbus_client.write_command(
+            CommandMessage(self.coils[0].name, True, configuration)
+        )
+        assert modbus_client.connection_state == ConnectionState.DISCONNECTED
+        self.mock_client.write_coil.side_effect = None
+        modbus_client.write_command(
+            CommandMessage(self.coils[0].name, True, configuration)
+        )
+        assert self.mock_client.connect.call_count == 2
+        assert modbus_client.connection_state == ConnectionState.CONNECTED
+
+    def test_write_commands_merges_registers(self):
+        holding_registers = [
+            HoldingRegister("reg_a", MemoryOrder("AB"), "INT16", 1.0, [10]),
+            HoldingRegister("reg_b", MemoryOrder("AB"), "INT32", 1.0, [11, 12]),
+            HoldingRegister("reg_c", MemoryOrder("AB"), "INT16", 1.0, [20]),
+        ]
+        configuration = Configuration(
+            self.coils, holding_registers, {}, self.modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        messages = [
+            CommandMessage(name, value, configuration)
+            for name, value in [("reg_c", 3), ("reg_b", 2), ("reg_a", 1)]
+        ]
+        sent = modbus_client.write_commands(messages)
+        assert sent == 3
+        assert self.mock_client.write_registers.call_count == 2
+        self.mock_client.write_registers.assert_any_call(10, [1, 0, 2], 1)
+        self.mock_client.write_registers.assert_any_call(20, [3], 1)
+
+    def test_write_register_list(self):
+        holding_registers = [
+            HoldingRegister("schedule", MemoryOrder("CDAB"), "INT32", 10.0, [100]),
+            HoldingRegister("reg_after", MemoryOrder("AB"), "INT16", 1.0, [106]),
+        ]
+        configuration = Configuration(
+            self.coils, holding_registers, {}, self.modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+
+        def message(name, value):
+            msg = CommandMessage(name, value, configuration)
+            msg.transform()
+            return msg
+
+        # Each value is scaled and fills its own pair of registers
+        messages = [message("schedule", [1, 2.5, -1]), message("reg_after", 7)]
+        assert messages[0].value == [10, 25, -10]
+        assert modbus_client.write_commands(messages) == 2
+        self.mock_client.write_registers.assert_called_once_with(
+            100, [10, 0, 25, 0, 65526, 65535, 7], 1
+        )
+
+        # A 96-slot table is written in consecutive requests of at most 123 registers
+        self.mock_client.write_registers.reset_mock()
+        table = [message("schedule", list(range(96)))]
+        assert modbus_client.write_commands(table) == 1
+        registers = self.mock_client.write_registers.call_args_list
+        assert [(call.args[0], len(call.args[1])) for call in registers] == [
+            (100, 123),
+            (223, 69),
+        ]
+        assert registers[0].args[1][:4] == [0, 0, 10, 0]
+        assert registers[1].args[1][-2:] == [950, 0]
+
+        # A failed part is reported with the command and the registers it covers
+        self.mock_client.write_registers.side_effect = [
+            MockBadModbusResponse(),
+            MockGoodModbusResponse(),
+        ]
+        assert modbus_client.write_commands(table) == 0
+        self.mock_error_handler.publish.assert_called_once_with(
+            self.mock_error_handler.Category.MODBUS_ERROR,
+            "bad response (action 'schedule', addresses 100 to 222)",
+        )
+        self.mock_client.write_registers.side_effect = None
+
+        modbus_client.write_commands([message("schedule", [2**31])])
+        self.mock_error_handler.publish.assert_called_with(
+            self.mock_error_handler.Category.INVALID_MESSAGE,
+            "'i' format requires -2147483648 <= number <= 2147483647",
+        )
+
+    def test_write_commands_keeps_coil_order(self):
+        calls = []
+        self.mock_client.write_coil.side_effect = lambda *args: (
+            calls.append("coil") or MockGoodModbusResponse()
+        )
+        self.mock_client.write_registers.side_effect = lambda *args: (
+            calls.append("registers") or MockGoodModbusResponse()
+        )
+        messages = [
+            CommandMessage("int_register", 1, self.configuration),
+            CommandMessage("test_coil", True, self.configuration),
+            CommandMessage("float_register", 1.5, self.configuration),
+        ]
+        sent = self.modbus_client.write_commands(messages)
+        assert sent == 3
+        assert calls == ["registers", "coil", "registers"]
+
+    def test_write_commands_failure_attribution(self):
+        holding_registers = [
+            HoldingRegister("reg_a", MemoryOrder("AB"), "INT16", 1.0, [10]),
+            HoldingRegister("reg_b", MemoryOrder("AB"), "INT16", 1.0, [11]),
+            HoldingRegister("reg_bad", MemoryOrder("AB"), "FOO", 1.0, [12]),
+        ]
+        configuration = Configuration(
+            self.coils, holding_registers, {}, self.modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        self.mock_client.write_registers.return_value = MockBadModbusResponse()
+        messages = [
+            CommandMessage(name, 1, configuration)
+            for name in ("reg_a", "reg_b", "reg_bad")
+        ]
+        sent = modbus_client.write_commands(messages)
+        assert sent == 0
+        publish = self.mock_error_handler.publish
+        publish.assert_any_call(
+            self.mock_error_handler.Category.INVALID_MESSAGE, "unknown data type FOO"
+        )
+        publish.assert_any_call(
+            self.mock_error_handler.Category.MODBUS_ERROR,
+            "bad response (action 'reg_a')",
+        )
+        publish.assert_any_call(
+            self.mock_error_handler.Category.MODBUS_ERROR,
+            "bad response (action 'reg_b')",
+        )
+        self.mock_client.write_registers.assert_called_once_with(10, [1, 1], 1)
+
+    def test_write_commands_merges_coils(self):
+        coils = [Coil(f"coil_{i}", [100 + i]) for i in range(4)] + [Coil("far", [200])]
+        configuration = Configuration(
+            coils, [], {}, self.modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        messages = [
+            CommandMessage(coil.name, index % 2 == 0, configuration)
+            for index, coil in enumerate(coils)
+        ]
+        sent = modbus_client.write_commands(messages)
+        assert sent == 5
+        self.mock_client.write_coils.assert_called_once_with(
+            100, [True, False, True, False], 1
+        )
+        self.mock_client.write_coil.assert_called_once_with(200, True, 1)
+
+    def test_write_commands_coil_span(self):
+        coils = [Coil(f"coil_{i}", [i]) for i in range(5)]
+        modbus_settings = ModbusSettings("localhost", 5020, max_coils_per_write=2)
+        configuration = Configuration(
+            coils, [], {}, modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        messages = [CommandMessage(coil.name, True, configuration) for coil in coils]
+        assert modbus_client.write_commands(messages) == 5
+        assert self.mock_client.write_coils.call_count == 2
+        self.mock_client.write_coil.assert_called_once_with(4, True, 1)
+
+    def test_write_commands_coalesces(self):
+        configuration = Configuration(
+            [Coil("coil", [1], coalesce=True)],
+            [
+                HoldingRegister(
+                    "setpoint", MemoryOrder("AB"), "INT16", 1.0, [5], coalesce=True
+                ),
+                HoldingRegister("counter", MemoryOrder("AB"), "INT16", 1.0, [6]),
+            ],
+            {},
+            self.modbus_settings,
+            self.site_settings,
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        messages = [
+            CommandMessage(name, value, configuration)
+            for name, value in [
+                ("setpoint", 1),
+                ("coil", True),
+                ("counter", 1),
+                ("setpoint", 2),
+                ("counter", 2),
+                ("coil", False),
+            ]
+        ]
+        assert modbus_client.write_commands(messages) == 4
+        self.mock_client.write_registers.assert_called_once_with(5, [2, 2], 1)
+        self.mock_client.write_coil.assert_called_once_with(1, False, 1)
+        assert modbus_client.coalesced == 2
+
+    def test_write_cache(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr("app.write_cache.time.monotonic", lambda: now[0])
+        modbus_settings = ModbusSettings("localhost", 5020, write_cache_max_age=60)
+        configuration = Configuration(
+            self.coils, self.holding_registers, {}, modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+
+        def write(name, value):
+            return modbus_client.write_command(
+                CommandMessage(name, value, configuration)
+            )
+
+        assert write("int_register", 5) == 1
+        assert write("test_coil", True) == 1
+        assert write("int_register", 5) == 0
+        assert write("test_coil", True) == 0
+        assert self.mock_client.write_registers.call_count == 1
+        assert modbus_client.skipped == 2
+
+        # A changed value is written, and becomes the cached value
+        assert write("int_register", 6) == 1
+        assert write("int_register", 6) == 0
+
+        # An old value is written again
+        now[0] += 60
+        assert write("int_register", 6) == 1
+
+        # After a failure, every value is written again
+        self.mock_client.write_coil.return_value = MockBadModbusResponse()
+        assert write("test_coil", False) == 0
+        self.mock_client.write_coil.return_value = MockGoodModbusResponse()
+        assert write("int_register", 6) == 1
+        assert write("test_coil", True) == 1
+        assert modbus_client.skipped == 3
+
+    def test_write_cache_after_reconnect(self):
+        modbus_settings = ModbusSettings(
+            "localhost", 5020, persistent_connection=True, write_cache_max_age=60
+        )
+        configuration = Configuration(
+            self.coils, self.holding_registers, {}, modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+
+        def connect():
+            self.mock_client.connected = True
+            return True
+
+        self.mock_client.connect.side_effect = connect
+        messages = [CommandMessage("int_register", 42, configuration)]
+        assert modbus_client.write_commands(messages) == 1
+        assert modbus_client.write_commands(messages) == 0
+
+        # The device restarts and drops the connection, so the setpoint is written again
+        self.mock_client.connected = False
+        assert modbus_client.write_commands(messages) == 1
+        assert self.mock_client.connect.call_count == 2
+        assert self.mock_client.write_registers.call_count == 2
+        assert modbus_client.skipped == 1
+
+    def test_payload_cache(self):
+        modbus_settings = ModbusSettings("localhost", 5020, payload_cache_size=2)
+        configuration = Configuration(
+            self.coils, self.holding_registers, {}, modbus_settings, self.site_settings
+        )
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        for value in (5, 5, 6, 5, 7, 6):
+            modbus_client.write_command(
+                CommandMessage("int_register", value, configuration)
+            )
+        assert [
+            args[1] for args, _ in self.mock_client.write_registers.call_args_list
+        ] == [
+            [5],
+            [5],
+            [6],
+            [5],
+            [7],
+            [6],
+        ]
+        metrics = modbus_client.payload_cache.metrics()
+        assert (metrics.size, metrics.hits, metrics.misses, metrics.evictions) == (
+            2,
+            2,
+            4,
+            2,
+        )
+
+        modbus_settings.payload_cache_size = 0
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler
+        )
+        assert modbus_client.payload_cache is None
+
+    def test_multiple_devices(self):
+        meter_client = MagicMock(spec=ModbusTcpClient)
+        meter_client.write_registers.return_value = MockGoodModbusResponse()
+        meter_client.write_coil.return_value = MockGoodModbusResponse()
+        modbus_settings = ModbusSettings(
+            "localhost",
+            5020,
+            unit_id=2,
+            devices=[
+                ModbusDevice("meter", "10.0.0.5", 502, 3),
+                ModbusDevice("meter2", "10.0.0.5", 502, 4),
+            ],
+        )
+        configuration = Configuration(
+            [Coil("meter_coil", [1], "meter"), Coil("local_coil", [1])],
+            [
+                HoldingRegister(
+                    "meter_reg", MemoryOrder("AB"), "INT16", 1.0, [5], False, "meter"
+                ),
+                HoldingRegister(
+                    "meter2_reg", MemoryOrder("AB"), "INT16", 1.0, [5], False, "meter2"
+                ),
+                HoldingRegister("local_reg", MemoryOrder("AB"), "INT16", 1.0, [5]),
+            ],
+            {},
+            modbus_settings,
+            self.site_settings,
+        )
+        factory = MagicMock(return_value=meter_client)
+        modbus_client = ModbusClient(
+            configuration, self.mock_client, self.mock_error_handler, factory
+        )
+        messages = [
+            CommandMessage(name, value, configuration)
+            for name, value in [
+                ("meter_reg", 7),
+                ("meter2_reg", 8),
+                ("local_reg", 9),
+                ("meter_coil", True),
+                ("local_coil", False),
+            ]
+        ]
+        assert modbus_client.write_commands(messages) == 5
+
+        # Devices sharing a host and port still get their own connection per unit id
+        assert factory.call_count == 2
+        factory.assert_called_with("10.0.0.5", 502)
+        meter_client.write_registers.assert_any_call(5, [7], 3)
+        meter_client.write_registers.assert_any_call(5, [8], 4)
+        meter_client.write_coil.assert_called_once_with(1, True, 3)
+        self.mock_client.write_registers.assert_called_once_with(5, [9], 2)
+        self.mock_client.write_coil.assert_called_once_with(1, False, 2)
+        modbus_client.close()
+
+    def test_devices_written_in_parallel(self):
+        slow_client = MagicMock(spec=ModbusTcpClient)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_write(*args):
+            started.set()
+            release.wait(5)
+            return MockGoodModbusResponse()
+
+        slow_client.write_coil.side_effect = slow_write
+        modbus_settings = ModbusSettings(
+            "localhost", 5020, devices=[ModbusDevice("slow", "10.0.0.9", 502)]
+        )
+        configuration = Configuration(
+            [Coil("slow_coil", [1], "slow"), Coil("fast_coil", [1])],
+            [],
+            {},
+            modbus_settings,
+            self.site_settings,
+        )
+        modbus_client = ModbusClient(
+            configuration,
+            self.mock_client,
+            self.mock_error_handler,
+            lambda host, port: slow_client,
+        )
+
+        def fast_write(*args):
+            # The slow device is still busy while the default device is written
+            assert started.wait(5)
+            release.set()
+            return MockGoodModbusResponse()
+
+        self.mock_client.write_coil.side_effect = fast_write
+        messages = [
+            CommandMessage("slow_coil", True, configuration),
+            CommandMessage("fast_coil", True, configuration),
+        ]
+        assert modbus_client.write_commands(messages) == 2
+        modbus_client.close()
@@ -0,0 +1,95 @@
+"""Unit tests for the ModbusConnection class in the app.modbus_connection module."""
+
+from unittest.mock import MagicMock, patch
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from app.modbus_connection import ModbusConnection, ConnectionState
+from app.exceptions import ModbusClientError
+import pytest
+
+
+class TestModbusConnection:
+    def setup_method(self):
+        self.mock_client = MagicMock(spec=ModbusTcpClient)
+        self.mock_client.connect.return_value = True
+        self.mock_client.connected = True
+
+    def test_non_persistent(self):
+        connection = ModbusConnection(self.mock_client)
+        connection.open()
+        connection.release()
+        connection.open()
+        connection.release()
+        assert self.mock_client.connect.call_count == 2
+        assert self.mock_client.close.call_count == 2
+
+    def test_persistent_reuses_connection(self):
+        connection = ModbusConnection(self.mock_client, persistent=True)
+        for _ in range(3):
+            connection.open()
+            connection.release()
+        assert self.mock_client.connect.call_count == 1
+        assert connection.state == ConnectionState.CONNECTED
+        assert connection.connects == 1
+
+    def test_persistent_reconnects_dead_socket(self):
+        connection = ModbusConnection(self.mock_client, persistent=True)
+        connection.open()
+        self.mock_client.connected = False
+        connection.open()
+        assert self.mock_client.connect.call_count == 2
+        assert connection.connects == 2
+
+    def test_reset_after_error(self):
+        connection = ModbusConnection(self.mock_client, persistent=True)
+        connection.open()
+        connection.reset()
+        assert connection.state == ConnectionState.DISCONNECTED
+        connection.open()
+        assert self.mock_client.connect.call_count == 2
+
+    def test_backoff(self):
+        self.mock_client.connect.return_value = False
+        connection = ModbusConnection(
+            self.mock_client, persistent=True, reconnect_delay=1, reconnect_delay_max=4
+        )
+        with patch("app.modbus_connection.time.monotonic", return_value=100.0):
+            with pytest.raises(ModbusClientError) as ex:
+                connection.open()
+            assert "Unable to connect" in str(ex.value)
+            assert connection.state == ConnectionState.BACKOFF
+
+            # Still backing off, so we don't try to connect again
+            with pytest.raises(ModbusClientError) as ex:
+                connection.open()
+            assert "waiting to reconnect" in str(ex.value)
+            assert self.mock_client.connect.call_count == 1
+
+        self.mock_client.connect.side_effect = ModbusException("could not connect")
+        with patch("app.modbus_connection.time.monotonic", return_value=101.0):
+            with pytest.raises(ModbusClientError) as ex:
+                connection.open()
+            assert "could not connect" in str(ex.value)
+        assert connection.failures == 2
+        # Second failure waits between half and all of twice the initial delay
+        assert 102.0 <= connection._retry_at <= 103.0
+
+        self.mock_client.connect.side_effect = None
+        self.mock_client.connect.return_value = True
+        with patch("app.modbus_connection.time.monotonic", return_value=200.0):
+            connection.open()
+        assert connection.state == ConnectionState.CONNECTED
+        assert connection.failures == 0
+
+    def test_backoff_is_capped(self):
+        self.mock_client.connect.return_value = False
+        connection = ModbusConnection(
+            self.mock_client, persistent=True, reconnect_delay=1, reconnect_delay_max=4
+        )
+        now = 0.0
+        for _ in range(10):
+            now += 10.0
+            with patch("app.modbus_connection.time.monotonic", return_value=now):
+                with pytest.raises(ModbusClientError):
+                    connection.open()
+            assert connection._retry_at - now <= 4
@@ -1,12 +1,19 @@
 """Unit tests for the MqttReader class in the app.mqtt_reader module."""
 
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, call
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import MQTTMessage
 from app.message import CommandMessage
-from app.mqtt_reader import MqttReader
+from app.mqtt_reader import MqttReader, device_partition
 from app.error_handler import ErrorHandler
-from app.configuration import Configuration
+from app.configuration import (
+    Coil,
+    Configuration,
+    ModbusDevice,
+    ModbusSettings,
+    MqttSettings,
+    SiteSettings,
+)
 import pytest
 import json
 
@@ -58,6 +65,26 @@ class TestMqttReader:
         assert mocked_obj.name == msg_obj.name
         assert mocked_obj.input_type == msg_obj.input_type
 
+    def test_batch_callback(self):
+        mock_modbus = Mock()
+        self.mqtt_reader.add_batch_callback(mock_modbus.batch_callback)
+        self.mqtt_reader.run()
+
+        json_str = json.dumps(
+            [
+                {"action": "evgBatteryMode", "value": 1},
+                {"action": "evgBatteryModeCoil", "value": True},
+            ]
+        )
+        paho_msg = MQTTMessage()
+        paho_msg.payload = json_str.encode()
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        mocked_args, _ = mock_modbus.batch_callback.call_args
+        assert [msg.name for msg in mocked_args[0]] == [
+            "evgBatteryMode",
+            "evgBatteryModeCoil",
+        ]
+
     def test_bad_message(self):
         def read_json(json_str):
             json.loads(json_str)
@@ -108,6 +135,255 @@ class TestMqttReader:
 
         self.mqtt_reader.stop()
 
+    def test_stream_large_message(self):
+        self.configuration.mqtt_settings.stream_threshold = 100
+        self.configuration.mqtt_settings.stream_batch_size = 2
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        mock_modbus = Mock()
+        mqtt_reader.add_batch_callback(mock_modbus.batch_callback)
+        mqtt_reader.register_callbacks()
+
+        commands = [
+            {"action": "evgBatteryModeCoil", "value": True},
+            {"action": "noSuchCoil", "value": True},
+            {"action": "evgBatteryMode", "value": 1},
+            {"action": "evgBatteryModeCoil", "value": "not a bool"},
+            {"action": "evgBatteryModeCoil", "value": False},
+        ]
+        paho_msg = MQTTMessage(topic=b"commands/site")
+        paho_msg.payload = json.dumps(commands).encode() + b"]"
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+
+        # Bad commands are reported on their own, and the rest written in batches
+        batches = [args[0] for args, _ in mock_modbus.batch_callback.call_args_list]
+        assert [[(msg.name, msg.value) for msg in batch] for batch in batches] == [
+            [("evgBatteryModeCoil", True), ("evgBatteryMode", 1)],
+            [("evgBatteryModeCoil", False)],
+        ]
+        category = self.mock_error_handler.Category
+        assert self.mock_error_handler.publish.call_args_list == [
+            call(
+                category.UNKNOWN_COMMAND,
+                "Command #1: No coil or register found to match 'noSuchCoil'",
+            ),
+            call(
+                category.INVALID_MESSAGE,
+                "Command #3: The coil value 'not a bool' is invalid.",
+            ),
+            call(
+                category.INVALID_MESSAGE,
+                "Message is invalid JSON syntax: Extra data (char 239)",
+            ),
+        ]
+
+        # Smaller messages are read whole, and rejected whole
+        mock_modbus.reset_mock()
+        paho_msg.payload = json.dumps(commands[:2]).encode()
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        mock_modbus.batch_callback.assert_not_called()
+
+    def test_scalar_topic(self):
+        self.configuration.mqtt_settings.scalar_topic = "setpoints"
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        mock_modbus = Mock()
+        mqtt_reader.add_batch_callback(mock_modbus.batch_callback)
+        mqtt_reader.register_callbacks()
+        assert mqtt_reader._topics == ["commands/#", "setpoints/+"]
+
+        paho_msg = MQTTMessage(topic=b"setpoints/evgBatteryModeCoil")
+        paho_msg.payload = b"true"
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        mocked_args, _ = mock_modbus.batch_callback.call_args
+        assert [(msg.name, msg.value) for msg in mocked_args[0]] == [
+            ("evgBatteryModeCoil", True)
+        ]
+
+        paho_msg = MQTTMessage(topic=b"setpoints/evgBatteryTargetPowerWatts")
+        paho_msg.payload = b"2.5"
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        mocked_args, _ = mock_modbus.batch_callback.call_args
+        assert [msg.name for msg in mocked_args[0]] == ["evgBatteryTargetPowerWatts"]
+
+        paho_msg = MQTTMessage(topic=b"setpoints/noSuchCoil")
+        paho_msg.payload = b"false"
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        self.mock_error_handler.publish.assert_called_with(
+            self.mock_error_handler.Category.UNKNOWN_COMMAND,
+            "No coil or register found to match 'noSuchCoil'",
+        )
+
+        # Other topics still carry lists of commands
+        paho_msg = MQTTMessage(topic=b"commands/site")
+        paho_msg.payload = json.dumps(
+            [{"action": "evgBatteryModeCoil", "value": False}]
+        ).encode()
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        mocked_args, _ = mock_modbus.batch_callback.call_args
+        assert [msg.value for msg in mocked_args[0]] == [False]
+
+    def test_scalar_topic_under_command_topic(self):
+        self.configuration.mqtt_settings.scalar_topic = "commands/set"
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        # Already delivered by the command topic subscription
+        assert mqtt_reader._topics == ["commands/#"]
+        assert mqtt_reader._scalar_action("commands/set/evgBatteryMode") == (
+            "evgBatteryMode"
+        )
+        assert mqtt_reader._scalar_action("commands/set/other") == "other"
+        assert mqtt_reader._scalar_action("commands/setting") is None
+        assert mqtt_reader._scalar_action("other/commands/set/x") is None
+
+    def test_share_group(self):
+        self.configuration.mqtt_settings.share_group = "handlers"
+        self.configuration.mqtt_settings.scalar_topic = "setpoints"
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        mqtt_reader.register_callbacks()
+        self.mock_mqtt_client.on_connect(self.mock_mqtt_client, None, None, 0, None)
+        assert self.mock_mqtt_client.subscribe.call_args_list == [
+            call("$share/handlers/commands/#", 0),
+            call("$share/handlers/setpoints/+", 0),
+        ]
+
+    def _partitioned_reader(self, partition_index):
+        devices = [
+            ModbusDevice(name, "localhost", 502) for name in ("meter", "battery")
+        ]
+        coils = [
+            Coil("default_coil", [1]),
+            Coil("meter_coil", [2], device="meter"),
+            Coil("battery_coil", [3], device="battery"),
+        ]
+        configuration = Configuration(
+            coils,
+            [],
+            MqttSettings(
+                "localhost",
+                1883,
+                "commands/#",
+                "errors",
+                protocol_version="5",
+                share_group="handlers",
+                partition_count=2,
+                partition_index=partition_index,
+            ),
+            ModbusSettings("localhost", 502, devices=devices),
+            SiteSettings("site", "serial"),
+        )
+        error_handler = MagicMock(spec=ErrorHandler)
+        client = MagicMock(spec=mqtt.Client)
+        mqtt_reader = MqttReader(configuration, client, error_handler)
+        batch_callback = Mock()
+        mqtt_reader.add_batch_callback(batch_callback)
+        mqtt_reader.register_callbacks()
+        return mqtt_reader, batch_callback, error_handler
+
+    def test_partitions(self):
+        assert [
+            device_partition(name, 2) for name in ("default", "meter", "battery")
+        ] == [1, 0, 0]
+        commands = [
+            {"action": name, "value": True}
+            for name in ("default_coil", "meter_coil", "battery_coil")
+        ]
+        paho_msg = MQTTMessage(topic=b"commands/site")
+        paho_msg.payload = json.dumps(commands).encode()
+        bad_msgs = []
+        for bad_command in (
+            {"action": "noSuchCoil", "value": True},
+            {"action": "meter_coil", "value": "not a bool"},
+        ):
+            bad_msg = MQTTMessage(topic=b"commands/site")
+            bad_msg.payload = json.dumps(commands + [bad_command]).encode()
+            bad_msgs.append(bad_msg)
+        not_json = MQTTMessage(topic=b"commands/site")
+        not_json.payload = b"not json"
+
+        written = {}
+        errors = {}
+        for index in range(2):
+            mqtt_reader, batch_callback, error_handler = self._partitioned_reader(index)
+            assert mqtt_reader._topics == [f"$share/handlers-{index}/commands/#"]
+            mqtt_reader.client.on_message(mqtt_reader.client, None, paho_msg)
+            (batch,), _ = batch_callback.call_args
+            written[index] = [msg.name for msg in batch]
+
+            # A message with a bad command is rejected by every partition, and the error
+            # reported by the one that owns the command
+            batch_callback.reset_mock()
+            for msg in bad_msgs + [not_json]:
+                mqtt_reader.client.on_message(mqtt_reader.client, None, msg)
+            batch_callback.assert_not_called()
+            errors[index] = [
+                args[1] for args, _ in error_handler.publish.call_args_list
+            ]
+
+        assert written == {0: ["meter_coil", "battery_coil"], 1: ["default_coil"]}
+        assert errors[0][0] == "No coil or register found to match 'noSuchCoil'"
+        assert errors[0][1] == "The coil value 'not a bool' is invalid."
+        assert errors[0][2].startswith("Message is invalid JSON syntax")
+        assert errors[1] == []
+
+    def test_manual_ack(self):
+        settings = self.configuration.mqtt_settings
+        settings.qos = 1
+        settings.manual_ack = True
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        written = []
+        mqtt_reader.add_batch_callback(
+            lambda messages, done: written.append(done), deferred=True
+        )
+        mqtt_reader.register_callbacks()
+        self.mock_mqtt_client.on_connect(self.mock_mqtt_client, None, None, 0, None)
+        self.mock_mqtt_client.subscribe.assert_called_with("commands/#", 1)
+
+        for mid in (1, 2):
+            paho_msg = MQTTMessage(mid, b"commands/site")
+            paho_msg.qos = 1
+            paho_msg.payload = b'[{"action": "evgBatteryMode", "value": 1}]'
+            self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, paho_msg)
+        # Not acknowledged until written
+        self.mock_mqtt_client.ack.assert_not_called()
+        assert mqtt_reader.inflight == 2
+        written[1]()
+        self.mock_mqtt_client.ack.assert_called_once_with(2, 1)
+        written[0]()
+        assert self.mock_mqtt_client.ack.call_args_list == [call(2, 1), call(1, 1)]
+        assert mqtt_reader.inflight == 0
+
+        # A message that cannot be written is acknowledged at once
+        bad_msg = MQTTMessage(3, b"commands/site")
+        bad_msg.qos = 1
+        bad_msg.payload = b"not json"
+        self.mock_mqtt_client.on_message(self.mock_mqtt_client, None, bad_msg)
+        self.mock_mqtt_client.ack.assert_called_with(3, 1)
+        assert mqtt_reader.inflight == 0
+
+    def test_manual_ack_connect_properties(self):
+        settings = self.configuration.mqtt_settings
+        settings.protocol_version = "5"
+        settings.qos = 2
+        settings.manual_ack = True
+        settings.max_inflight = 20
+        settings.client_id = "handler-1"
+        mqtt_reader = MqttReader(
+            self.configuration, self.mock_mqtt_client, self.mock_error_handler
+        )
+        mqtt_reader.connect()
+        _, kwargs = self.mock_mqtt_client.connect.call_args
+        assert kwargs["clean_start"] is False
+        assert kwargs["properties"].ReceiveMaximum == 20
+        assert kwargs["properties"].SessionExpiryInterval > 0
+
     def test_fail_connect(self):
         self.mock_mqtt_client.connect.side_effect = OSError("could not connect")
         with pytest.raises(OSError) as ex:
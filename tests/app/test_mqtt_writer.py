@@ -39,3 +39,45 @@ class TestMqttWriter:
         with pytest.raises(OSError) as ex:
             self.mqtt_writer.publish(self.topic, self.payload)
         assert "Cannot connect to MQTT broker" in str(ex.value)
+
+    def test_publish_in_background(self):
+        self.mqtt_writer.queue_size = 2
+        self.mqtt_writer.start()
+        self.mock_mqtt_client.max_queued_messages_set.assert_called_with(2)
+        self.mock_mqtt_client.connect_async.assert_called_with("localhost", 1883)
+        self.mock_mqtt_client.loop_start.assert_called()
+
+        queued = mqtt.MQTTMessageInfo(1)
+        queued.rc = mqtt.MQTT_ERR_NO_CONN
+        full = mqtt.MQTTMessageInfo(2)
+        full.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+        self.mock_mqtt_client.publish.side_effect = [queued, full]
+        self.mqtt_writer.publish(self.topic, self.payload_str)
+        self.mqtt_writer.publish(self.topic, self.payload_str)
+
+        # Queued without connecting again, and the message that did not fit is counted
+        self.mock_mqtt_client.connect.assert_not_called()
+        assert self.mqtt_writer.dropped == 1
+
+        self.mqtt_writer.stop()
+        self.mock_mqtt_client.disconnect.assert_called()
+        self.mock_mqtt_client.loop_stop.assert_called()
+
+    def test_publish_on_shared_client(self):
+        self.mqtt_writer.start(shared=True)
+        # The owner of the client connects it and runs its loop
+        self.mock_mqtt_client.connect_async.assert_not_called()
+        self.mock_mqtt_client.loop_start.assert_not_called()
+
+        info = mqtt.MQTTMessageInfo(1)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self.mock_mqtt_client.publish.return_value = info
+        self.mqtt_writer.publish(self.topic, self.payload_str)
+        self.mock_mqtt_client.publish.assert_called_with(
+            self.topic, self.payload_str, qos=1
+        )
+        self.mock_mqtt_client.connect.assert_not_called()
+
+        self.mqtt_writer.stop()
+        self.mock_mqtt_client.disconnect.assert_not_called()
+        self.mock_mqtt_client.loop_stop.assert_not_called()
@@ -0,0 +1,62 @@
+"""Tests for the payload_cache module."""
+
+import struct
+from types import SimpleNamespace
+from unittest.mock import Mock
+import pytest
+from app.payload_cache import CacheMetrics, PayloadCache
+
+
+@pytest.fixture
+def entry():
+    return SimpleNamespace(
+        name="setpoint", encoder=Mock(side_effect=lambda value: [int(value) & 0xFFFF])
+    )
+
+
+def test_repeated_values_are_not_encoded_again(entry):
+    cache = PayloadCache(max_size=10)
+    first = cache.encode(entry, 5000)
+    assert first == [5000]
+    assert cache.encode(entry, 5000) is first
+    assert entry.encoder.call_count == 1
+    assert cache.metrics().hits == 1
+    assert cache.metrics().misses == 1
+
+    # Equal values of another type, or for another register, are encoded separately
+    cache.encode(entry, 5000.0)
+    other = Mock(side_effect=lambda value: [1])
+    assert cache.encode(SimpleNamespace(name="other", encoder=other), 5000) == [1]
+    assert entry.encoder.call_count == 2
+    assert cache.metrics().size == 3
+
+
+def test_least_recently_used_is_evicted(entry):
+    cache = PayloadCache(max_size=2)
+    for value in (1, 2, 1, 3, 1, 2):
+        cache.encode(entry, value)
+    # 2 was evicted for 3, then 3 for 2
+    assert [args[0] for args, _ in entry.encoder.call_args_list] == [1, 2, 3, 2]
+    metrics = cache.metrics()
+    assert (metrics.size, metrics.hits, metrics.misses, metrics.evictions) == (
+        2,
+        2,
+        4,
+        2,
+    )
+
+
+def test_uncached_values(entry):
+    cache = PayloadCache(max_size=10)
+    entry.encoder.side_effect = lambda value: [0]
+    for value in ([1, 2], [1, 2], float("nan"), float("nan")):
+        cache.encode(entry, value)
+    assert entry.encoder.call_count == 4
+
+    # Errors are raised every time
+    entry.encoder.side_effect = struct.error("out of range")
+    for _ in range(2):
+        with pytest.raises(struct.error):
+            cache.encode(entry, 70000)
+    assert entry.encoder.call_count == 6
+    assert cache.metrics() == CacheMetrics()
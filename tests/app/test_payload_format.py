@@ -0,0 +1,141 @@
+"""Tests for the payload_format module."""
+
+import json
+from unittest.mock import MagicMock, patch
+import paho.mqtt.client as mqtt
+import pytest
+from paho.mqtt.client import MQTTMessage
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from app import payload_format
+from app.configuration import Configuration
+from app.error_handler import ErrorHandler
+from app.exceptions import InvalidMessageError
+from app.message import CommandMessageList
+from app.mqtt_reader import MqttReader
+from app.payload_format import CBOR, JSON, MSGPACK, PayloadFormatSelector
+
+COMMANDS = [
+    {"action": "somecoil", "value": True},
+    {"action": "someregister", "value": 42.3},
+]
+
+
+def _message(topic, content_type=None):
+    message = MQTTMessage(topic=topic.encode())
+    if content_type:
+        message.properties = Properties(PacketTypes.PUBLISH)
+        message.properties.ContentType = content_type
+    return message
+
+
+@pytest.fixture(params=[MSGPACK, CBOR])
+def encode(request):
+    if request.param == MSGPACK:
+        msgpack = pytest.importorskip("msgpack")
+        return request.param, msgpack.packb
+    cbor2 = pytest.importorskip("cbor2")
+    return request.param, cbor2.dumps
+
+
+def test_select_by_topic():
+    selector = PayloadFormatSelector(
+        {"commands/packed/#": MSGPACK, "commands/+/cbor": CBOR}
+    )
+    assert selector.select(_message("commands/packed/a")) == MSGPACK
+    assert selector.select(_message("commands/x/cbor")) == CBOR
+    assert selector.select(_message("commands/json")) == JSON
+    # Topics are remembered after the first lookup
+    assert selector._by_topic == {
+        "commands/packed/a": MSGPACK,
+        "commands/x/cbor": CBOR,
+        "commands/json": JSON,
+    }
+
+
+def test_select_by_content_type():
+    selector = PayloadFormatSelector({"commands/packed/#": MSGPACK})
+    assert selector.select(_message("commands/a", "application/cbor")) == CBOR
+    assert selector.select(_message("commands/packed/a", "application/json")) == JSON
+    assert (
+        selector.select(_message("commands/a", "application/msgpack; v=1")) == MSGPACK
+    )
+    # An unknown content type falls back to the topic
+    assert selector.select(_message("commands/packed/a", "text/plain")) == MSGPACK
+    assert PayloadFormatSelector().select(_message("commands/a")) == JSON
+
+
+def test_read_binary_commands(encode):
+    fmt, dumps = encode
+    commands = CommandMessageList.read(dumps(COMMANDS), fmt)
+    assert commands == CommandMessageList.read(json.dumps(COMMANDS))
+
+
+def test_read_invalid_binary_commands(encode):
+    fmt, dumps = encode
+    with pytest.raises(InvalidMessageError) as ex:
+        CommandMessageList.read(b"\xc1\xff\xff", fmt)
+    assert f"Message is invalid {fmt} data" in str(ex.value)
+
+    with pytest.raises(InvalidMessageError) as ex:
+        CommandMessageList.read(dumps(COMMANDS[0]), fmt)
+    assert "Message must be a list of commands" in str(ex.value)
+
+    with pytest.raises(InvalidMessageError) as ex:
+        CommandMessageList.read(dumps([{"action": "somecoil"}]), fmt)
+    assert "Message is missing required components" in str(ex.value)
+
+
+def test_package_not_installed():
+    with (
+        patch.object(payload_format, "msgpack", None),
+        patch.object(payload_format, "msgspec", None),
+        patch.object(CommandMessageList, "_decode_msgpack", None),
+    ):
+        assert not payload_format.is_available(MSGPACK)
+        with pytest.raises(InvalidMessageError) as ex:
+            CommandMessageList.read(b"\x90", MSGPACK)
+        assert "'msgpack' package is not installed" in str(ex.value)
+
+
+@pytest.mark.parametrize("decoder", ["msgspec", "msgpack"])
+def test_read_msgpack_with_either_package(decoder):
+    msgpack = pytest.importorskip("msgpack")
+    pytest.importorskip("msgspec")
+    if decoder == "msgspec":
+        # msgspec decodes, and also reports the errors of, messages without msgpack
+        patched = patch.object(payload_format, "msgpack", None)
+    else:
+        patched = patch.object(CommandMessageList, "_decode_msgpack", None)
+    with patched:
+        assert payload_format.is_available(MSGPACK)
+        assert CommandMessageList.read(msgpack.packb(COMMANDS), MSGPACK) == COMMANDS
+        with pytest.raises(InvalidMessageError) as ex:
+            CommandMessageList.read(msgpack.packb([{"action": "a"}]), MSGPACK)
+        assert "Message is missing required components" in str(ex.value)
+        with pytest.raises(InvalidMessageError) as ex:
+            CommandMessageList.read(b"\xc1", MSGPACK)
+        assert "Message is invalid msgpack data" in str(ex.value)
+
+
+def test_warns_when_package_not_installed(caplog):
+    with patch.object(payload_format, "cbor2", None):
+        PayloadFormatSelector({"commands/cbor": CBOR})
+    assert "Install the 'cbor2' package" in caplog.text
+
+
+def test_reader_uses_topic_format(encode):
+    fmt, dumps = encode
+    configuration = Configuration.from_file("tests/config/example_configuration.yaml")
+    configuration.mqtt_settings.payload_formats = {"commands/packed": fmt}
+    client = MagicMock(spec=mqtt.Client)
+    reader = MqttReader(configuration, client, MagicMock(spec=ErrorHandler))
+    callback = MagicMock()
+    reader.add_batch_callback(callback)
+    reader.register_callbacks()
+
+    message = _message("commands/packed")
+    message.payload = dumps([{"action": "evgBatteryModeCoil", "value": True}])
+    client.on_message(client, None, message)
+    (batch,), _ = callback.call_args
+    assert [(m.name, m.value) for m in batch] == [("evgBatteryModeCoil", True)]
@@ -0,0 +1,144 @@
+"""Tests for the register_encoder module."""
+
+import struct
+import pytest
+from app.memory_order import MemoryOrder
+from app.payload_builder import PayloadBuilder
+from app import register_encoder
+from app.register_encoder import compile_encoder
+
+DATA_TYPES = [
+    "FLOAT64-IEEE",
+    "FLOAT32-IEEE",
+    "FLOAT32",
+    "FLOAT16-IEEE",
+    "INT8",
+    "UINT8",
+    "INT16",
+    "UINT16",
+    "INT32",
+    "UINT32",
+    "INT64",
+    "UINT64",
+]
+MEMORY_ORDERS = ["AB", "ABCD", "BA", "CDAB", "BADC"]
+
+
+def _build(data_type, memory_order, value):
+    builder = PayloadBuilder()
+    builder.set_data_type(data_type)
+    builder.set_value(value)
+    builder.set_memory_order(MemoryOrder(memory_order))
+    return builder.build()
+
+
+@pytest.mark.parametrize("memory_order", MEMORY_ORDERS)
+@pytest.mark.parametrize("data_type", DATA_TYPES)
+def test_matches_payload_builder(data_type, memory_order):
+    encoder = compile_encoder(data_type, MemoryOrder(memory_order))
+    for value in (0, 1, 100, 127, -1.5, 1234.5678, -32768, 65535, 2**40):
+        try:
+            expected = _build(data_type, memory_order, value)
+        except struct.error as ex:
+            with pytest.raises(struct.error) as actual:
+                encoder(value)
+            assert str(actual.value) == str(ex)
+        else:
+            assert encoder(value) == expected
+
+
+def test_word_and_byte_order():
+    assert compile_encoder("INT32", MemoryOrder("ABCD"))(0x01020304) == [
+        0x0102,
+        0x0304,
+    ]
+    assert compile_encoder("INT32", MemoryOrder("CDAB"))(0x01020304) == [
+        0x0304,
+        0x0102,
+    ]
+    assert compile_encoder("INT32", MemoryOrder("BADC"))(0x01020304) == [
+        0x0201,
+        0x0403,
+    ]
+    assert compile_encoder("INT32", MemoryOrder("BA"))(0x01020304) == [0x0403, 0x0201]
+    assert compile_encoder("INT8", MemoryOrder("BA"))(1) == [0x0100]
+
+
+@pytest.mark.parametrize("value", ["", "a", "ab", "abc", "héllo"])
+def test_string(value):
+    encoder = compile_encoder("STRING", MemoryOrder("AB"))
+    assert encoder(value) == _build("STRING", "AB", value)
+
+
+def test_errors():
+    encoder = compile_encoder("FOO", MemoryOrder("AB"))
+    with pytest.raises(RuntimeError, match="unknown data type FOO"):
+        encoder(1)
+    with pytest.raises(AttributeError, match="set value"):
+        compile_encoder("INT16", MemoryOrder("AB"))(None)
+    with pytest.raises(struct.error):
+        compile_encoder("UINT16", MemoryOrder("AB"))(-1)
+
+
+def test_errors_are_not_reused():
+    encoder = compile_encoder("FOO", MemoryOrder("AB"))
+    errors = []
+    for _ in range(2):
+        with pytest.raises(RuntimeError) as ex:
+            encoder(1)
+        errors.append(ex.value)
+    assert errors[0] is not errors[1]
+
+
+LISTS = [
+    [0, 1, 100, 127],
+    [True, False, 2],
+    [-1.5, 1234.5678, 3.5e38],
+    [-32768, 65535, 2**40],
+    [1, "2"],
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def array_backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(register_encoder, "np", None)
+    # Compiled encoders are shared, so each backend compiles its own
+    register_encoder._shared_encoder.cache_clear()
+    yield request.param
+    register_encoder._shared_encoder.cache_clear()
+
+
+@pytest.mark.parametrize("memory_order", MEMORY_ORDERS)
+@pytest.mark.parametrize("data_type", DATA_TYPES)
+def test_list_matches_single_values(array_backend, data_type, memory_order):
+    # Encoded while the backend is in place, as the choice is made when compiling
+    encoder = compile_encoder(data_type, MemoryOrder(memory_order))
+    for values in LISTS:
+        try:
+            expected = [register for value in values for register in encoder(value)]
+        except (struct.error, OverflowError) as ex:
+            with pytest.raises(type(ex)) as actual:
+                encoder(values)
+            assert str(actual.value) == str(ex)
+        else:
+            assert encoder(values) == expected
+
+
+def test_list_errors(array_backend):
+    encoder = compile_encoder("INT16", MemoryOrder("AB"))
+    assert encoder([1, 2, 3]) == [1, 2, 3]
+    with pytest.raises(AttributeError, match="set value"):
+        encoder([])
+    with pytest.raises(AttributeError, match="set value"):
+        encoder([1, None])
+    with pytest.raises(struct.error, match="not an integer"):
+        encoder([1, 2.5])
+    with pytest.raises(struct.error, match="not an integer"):
+        encoder([[1, 2], [3, 4]])
+    assert compile_encoder("STRING", MemoryOrder("AB"))(["ab", "c"]) == [
+        0x6162,
+        0x6300,
+    ]
@@ -1,5 +1,9 @@
+from dataclasses import replace
+
 import pytest
+import yaml
 
+from app.configuration import Configuration
 from app.remote_command_handler import RemoteCommandHandler
 
 
@@ -50,3 +54,49 @@ class TestRemoteCommandHandler:
         args = handler.parse_arguments([config_path, "--mqtt_host=example.com"])
         configuration = handler.get_configuration_with_overrides(args)
         assert len(configuration.get_coils()) == 3
+
+    def test_config_overrides_keep_other_mqtt_settings(self, tmp_path):
+        config = yaml.safe_load(
+            open("tests/config/example_configuration.yaml", encoding="utf-8")
+        )
+        config["mqtt_settings"].update(
+            protocol_version="5",
+            payload_formats={"commands/msgpack/#": "msgpack"},
+            qos=1,
+            manual_ack=True,
+            error_window=30,
+            shared_connection=True,
+        )
+        config_file = tmp_path / "configuration.yaml"
+        config_file.write_text(yaml.safe_dump(config), encoding="utf-8")
+
+        handler = RemoteCommandHandler()
+        args = handler.parse_arguments(
+            [f"--config={config_file}", "--mqtt_host=example.com"]
+        )
+        configuration = handler.get_configuration_with_overrides(args)
+        mqtt_settings = Configuration.from_file(str(config_file)).get_mqtt_settings()
+        assert configuration.get_mqtt_settings() == replace(
+            mqtt_settings, host="example.com"
+        )
+        assert configuration.get_mqtt_settings().protocol_version == "5"
+        assert configuration.get_mqtt_settings().qos == 1
+
+    def test_config_snapshot(self, tmp_path):
+        handler = RemoteCommandHandler()
+        config_path = "--config=tests/config/example_configuration.yaml"
+        assert handler.parse_arguments([config_path]).snapshot is None
+        assert handler.parse_arguments([config_path, "--snapshot"]).snapshot == ""
+
+        snapshot_path = tmp_path / "configuration.snapshot"
+        args = handler.parse_arguments([config_path, f"--snapshot={snapshot_path}"])
+        configuration = handler.get_configuration_with_overrides(args)
+        assert snapshot_path.exists()
+        assert len(configuration.get_coils()) == 3
+
+    def test_runtime_arg(self):
+        handler = RemoteCommandHandler()
+        assert handler.parse_arguments([]).runtime == "threaded"
+        assert handler.parse_arguments(["--runtime=asyncio"]).runtime == "asyncio"
+        with pytest.raises(SystemExit):
+            handler.parse_arguments(["--runtime=gevent"])
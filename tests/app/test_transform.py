@@ -0,0 +1,62 @@
+"""Tests for the transform module."""
+
+import logging
+from unittest.mock import patch
+import pytest
+from app.configuration import HoldingRegister
+from app.memory_order import MemoryOrder
+from app.message import MessageTransformer
+from app.transform import compile_transform, compile_transform_many
+
+VALUES = [0, 1, -3, 1.57, 2000, 34.56, True]
+
+
+def _register(scale, data_type, invert_sign=False):
+    return HoldingRegister(
+        "test_register", MemoryOrder("AB"), data_type, scale, [1], invert_sign
+    )
+
+
+@pytest.mark.parametrize(
+    "register, expected",
+    [
+        (_register(10.0, "INT32", True), [0, -10, 30, -15, -20000, -345, -10]),
+        (_register(10.0, "INT32"), [0, 10, -30, 15, 20000, 345, 10]),
+        (
+            _register(0.5, "FLOAT32", True),
+            [-0.0, -0.5, 1.5, -0.785, -1000.0, -17.28, -0.5],
+        ),
+        (_register(0.5, "FLOAT32"), [0.0, 0.5, -1.5, 0.785, 1000.0, 17.28, 0.5]),
+        (_register(None, "INT16", True), [0, -1, 3, -1.57, -2000, -34.56, -1]),
+        (_register(None, "INT16"), VALUES),
+        (_register(None, None), VALUES),
+    ],
+)
+def test_transform(register, expected):
+    transform = compile_transform(register)
+    results = [transform(value) for value in VALUES]
+    assert results == expected
+    assert [type(result) for result in results] == [type(e) for e in expected]
+    assert compile_transform_many(register)(VALUES) == results
+    # Compiled once, when the register is created
+    assert [register.transform(value) for value in VALUES] == results
+    assert register.transform_many(VALUES) == results
+    assert MessageTransformer.transform(register, 1.57) == results[3]
+    assert MessageTransformer.transform_many(register, VALUES) == results
+
+
+def test_debug_logging(caplog):
+    register = _register(10.0, "INT32")
+    with patch("app.transform.logging.debug") as debug:
+        caplog.set_level(logging.INFO)
+        register.transform(1)
+        register.transform_many([1, 2])
+        debug.assert_not_called()
+
+    caplog.set_level(logging.DEBUG)
+    register.transform(1)
+    register.transform_many([1, 2])
+    assert f"transformed value 10 with config {register} to 1" in caplog.text
+    assert f"transformed values [10, 20] with config {register} to [1, 2]" in (
+        caplog.text
+    )
@@ -0,0 +1,60 @@
+"""Tests for the validation module."""
+
+from decimal import Decimal
+import pytest
+from pydantic import TypeAdapter, ValidationError
+from app.validation import is_bool, to_bool
+
+VALUES = [
+    True,
+    False,
+    0,
+    1,
+    2,
+    -1,
+    0.0,
+    1.0,
+    0.5,
+    float("nan"),
+    "0",
+    "1",
+    "true",
+    "TRUE",
+    "Yes",
+    "oFF",
+    " true",
+    "",
+    "1.0",
+    "foo",
+    None,
+    [],
+    [True],
+    {},
+    b"true",
+    b"2",
+    Decimal(1),
+    Decimal("1.5"),
+    10**30,
+]
+
+
+def _pydantic_to_bool(value):
+    return TypeAdapter(bool).validate_python(value)
+
+
+def _pydantic_is_bool(value):
+    try:
+        TypeAdapter(bool).validate_python(value)
+        return True
+    except ValidationError:
+        return False
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_matches_pydantic(value):
+    assert is_bool(value) == _pydantic_is_bool(value)
+
+
+@pytest.mark.parametrize("value", [value for value in VALUES if is_bool(value)])
+def test_to_bool_matches_pydantic(value):
+    assert to_bool(value) is _pydantic_to_bool(value)
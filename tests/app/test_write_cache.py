@@ -0,0 +1,26 @@
+"""Unit tests for the WriteCache class in the app.write_cache module."""
+
+from app.write_cache import WriteCache
+
+
+def test_write_cache(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("app.write_cache.time.monotonic", lambda: now[0])
+    cache = WriteCache(max_age=10)
+    assert not cache.is_unchanged("default", "reg", [1])
+
+    cache.store("default", "reg", [1])
+    assert cache.is_unchanged("default", "reg", [1])
+    assert not cache.is_unchanged("default", "reg", [2])
+    assert not cache.is_unchanged("default", "other", [1])
+
+    now[0] = 10
+    assert not cache.is_unchanged("default", "reg", [1])
+    cache.store("default", "reg", [1])
+    cache.store("meter", "reg", [1])
+
+    cache.invalidate("default")
+    assert not cache.is_unchanged("default", "reg", [1])
+    assert cache.is_unchanged("meter", "reg", [1])
+    cache.invalidate()
+    assert not cache.is_unchanged("meter", "reg", [1])
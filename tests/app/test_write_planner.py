@@ -0,0 +1,86 @@
+"""Tests for the write planner module."""
+
+from app.configuration import InputTypes
+from app.write_planner import (
+    MAX_COILS_PER_WRITE,
+    MAX_REGISTERS_PER_WRITE,
+    PendingWrite,
+    WriteRequest,
+    plan_coil_writes,
+    plan_register_writes,
+)
+
+
+def test_merges_adjacent_registers():
+    writes = [
+        PendingWrite(3, [30, 31], "c"),
+        PendingWrite(0, [0], "a"),
+        PendingWrite(1, [10, 11], "b"),
+    ]
+    assert plan_register_writes(writes) == [
+        WriteRequest(0, [0, 10, 11, 30, 31], ["c", "a", "b"])
+    ]
+
+
+def test_keeps_gaps_separate():
+    writes = [PendingWrite(0, [1], "a"), PendingWrite(2, [3], "b")]
+    assert plan_register_writes(writes) == [
+        WriteRequest(0, [1], ["a"]),
+        WriteRequest(2, [3], ["b"]),
+    ]
+
+
+def test_later_write_wins_on_overlap():
+    writes = [PendingWrite(0, [1, 2], "a"), PendingWrite(1, [9], "b")]
+    assert plan_register_writes(writes) == [WriteRequest(0, [1, 9], ["a", "b"])]
+
+    writes = [PendingWrite(1, [9], "a"), PendingWrite(0, [1, 2], "b")]
+    assert plan_register_writes(writes) == [WriteRequest(0, [1, 2], ["a", "b"])]
+
+
+def test_respects_protocol_limit():
+    writes = [PendingWrite(i * 2, [i, i], i) for i in range(100)]
+    requests = plan_register_writes(writes)
+    assert [len(r.values) for r in requests] == [122, 78]
+    assert all(len(r.values) <= MAX_REGISTERS_PER_WRITE for r in requests)
+    assert requests[1].address == 122
+    assert sum(len(r.commands) for r in requests) == 100
+
+    # A single write that is too long on its own is split into consecutive requests
+    requests = plan_register_writes([PendingWrite(10, list(range(200)), "a")])
+    assert [(r.address, len(r.values)) for r in requests] == [(10, 123), (133, 77)]
+    assert requests[0].values + requests[1].values == list(range(200))
+    assert all(r.commands == ["a"] for r in requests)
+    assert [r.count for r in requests] == [0, 1]
+    # A write with a failed part is not complete, so it is neither counted nor cached
+    requests[0].failed = True
+    assert not requests[1].completes_write
+    assert requests[1].count == 0
+
+
+def test_empty_plan():
+    assert plan_register_writes([]) == []
+
+
+def test_merges_adjacent_coils():
+    writes = [
+        PendingWrite(2, [True], "c"),
+        PendingWrite(0, [True, False], "a"),
+        PendingWrite(5, [False], "d"),
+    ]
+    assert plan_coil_writes(writes) == [
+        WriteRequest(0, [True, False, True], ["c", "a"], InputTypes.COIL),
+        WriteRequest(5, [False], ["d"], InputTypes.COIL),
+    ]
+
+
+def test_coil_span_is_configurable():
+    writes = [PendingWrite(i, [True], i) for i in range(10)]
+    requests = plan_coil_writes(writes, max_span=4)
+    assert [len(r.values) for r in requests] == [4, 4, 2]
+    assert [r.address for r in requests] == [0, 4, 8]
+
+    # The span is never allowed beyond the protocol limit
+    writes = [PendingWrite(i, [True], i) for i in range(2000)]
+    requests = plan_coil_writes(writes, max_span=5000)
+    assert len(requests[0].values) == MAX_COILS_PER_WRITE
@@ -8,17 +8,22 @@ from pymodbus.constants import Endian
 
 import app.configuration
 from app.configuration import (
+    DEFAULT_DEVICE,
     Coil,
     Configuration,
     HoldingRegister,
+    ModbusDevice,
     ModbusSettings,
     MqttSettings,
     SiteSettings,
     InputTypes,
     path_to_yaml_data,
     _validate_config,
+    _modbus_settings_from_yaml_data,
     _mqtt_settings_from_yaml_data,
+    _interpolate_environment_vars,
 )
+from app.memory_order import MemoryOrder
 from app.exceptions import ConfigurationFileNotFoundError, ConfigurationFileInvalidError
 
 
@@ -72,6 +77,8 @@ def test_get_holding_registers():
     )
     assert evg_battery_target_power_watts.data_type == "INT32"
     assert evg_battery_target_power_watts.scale == 10.0
+    assert evg_battery_target_power_watts.coalesce is True
+    assert evg_battery_mode.coalesce is False
 
     evg_battery_target_soc_percent = configuration.get_holding_register(
         "evgBatteryTargetSOCPercent"
@@ -95,6 +102,40 @@ def test_get_holding_registers():
     assert evg_battery_target_power_watts.invert_sign is True
 
 
+def test_command_table():
+    configuration = Configuration(
+        [Coil("shared", [7]), Coil("coil", [8], "meter")],
+        [
+            HoldingRegister("shared", MemoryOrder("AB"), "INT16", 1.0, [1]),
+            HoldingRegister("register", MemoryOrder("CDAB"), "INT32", 10.0, [2], True),
+        ],
+        MqttSettings("test", 100, "test"),
+        ModbusSettings("localhost", 10, devices=[ModbusDevice("meter", "meter", 502)]),
+        SiteSettings("testsite", "testdevice"),
+    )
+
+    coil = configuration.get_command("coil")
+    assert coil.input_type == InputTypes.COIL
+    assert coil.address == 8
+    assert coil.device == "meter"
+    assert coil.write_method == "write_coils"
+    assert coil.encoder(1) == [True]
+    assert coil.encoder([True, False]) == [True, False]
+
+    register = configuration.get_command("register")
+    assert register.input_type == InputTypes.REGISTER
+    assert register.device == DEFAULT_DEVICE
+    assert register.write_method == "write_registers"
+    assert register.transform(1.57) == -15
+    assert register.encoder(-15) == [65521, 65535]
+
+    # As before, a coil is found before a holding register of the same name
+    assert configuration.get_command("shared").input_type == InputTypes.COIL
+    assert configuration.get_command("nothing") is None
+    with pytest.raises(TypeError):
+        configuration.command_table["coil"] = register
+
+
 def test_able_to_get_mqtt_settings():
     configuration = Configuration.from_file(_config_path())
 
@@ -118,6 +159,181 @@ def test_able_to_get_mqtt_settings():
     assert new_mqtt_settings.pub_errors is False
 
 
+def test_mqtt_payload_formats():
+    config = path_to_yaml_data(_config_path())
+
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.protocol_version == "3.1.1"
+    assert mqtt_settings.payload_formats == {}
+
+    config["mqtt_settings"]["protocol_version"] = 5
+    config["mqtt_settings"]["payload_formats"] = {"commands/packed/#": "msgpack"}
+    _validate_config(config)
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.protocol_version == "5"
+    assert mqtt_settings.payload_formats == {"commands/packed/#": "msgpack"}
+
+    bad_version = deepcopy(config)
+    bad_version["mqtt_settings"]["protocol_version"] = "3.1"
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(bad_version)
+    assert "protocol_version" in str(ex.value)
+
+    bad_format = deepcopy(config)
+    bad_format["mqtt_settings"]["payload_formats"] = {"commands/packed/#": "xml"}
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(bad_format)
+    assert "'xml' must be one of json, msgpack, cbor" in str(ex.value)
+
+    assert mqtt_settings.scalar_topic is None
+    config["mqtt_settings"]["scalar_topic"] = "setpoints"
+    _validate_config(config)
+    assert _mqtt_settings_from_yaml_data(config).scalar_topic == "setpoints"
+    for scalar_topic in ("setpoints/+", "a/b/c/d/e/f/g/h"):
+        bad_scalar_topic = deepcopy(config)
+        bad_scalar_topic["mqtt_settings"]["scalar_topic"] = scalar_topic
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(bad_scalar_topic)
+        assert "scalar topic" in str(ex.value)
+
+    not_a_dict = deepcopy(config)
+    not_a_dict["mqtt_settings"]["payload_formats"] = ["msgpack"]
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(not_a_dict)
+    assert "payload_formats" in str(ex.value)
+
+
+def test_mqtt_stream_settings():
+    config = path_to_yaml_data(_config_path())
+
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.stream_threshold == 0
+    assert mqtt_settings.stream_batch_size == 500
+
+    config["mqtt_settings"]["stream_threshold"] = 65536
+    config["mqtt_settings"]["stream_batch_size"] = 100
+    _validate_config(config)
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.stream_threshold == 65536
+    assert mqtt_settings.stream_batch_size == 100
+
+    for key, value in (
+        ("stream_threshold", -1),
+        ("stream_batch_size", 0),
+        ("stream_batch_size", 2.5),
+    ):
+        c = deepcopy(config)
+        c["mqtt_settings"][key] = value
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(c)
+        assert key in str(ex.value)
+
+
+def test_mqtt_share_group_and_partitions():
+    config = path_to_yaml_data(_config_path())
+
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.share_group is None
+    assert (mqtt_settings.partition_count, mqtt_settings.partition_index) == (1, 0)
+
+    config["mqtt_settings"].update(
+        protocol_version=5, share_group="handlers", partition_count=3, partition_index=2
+    )
+    _validate_config(config)
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert mqtt_settings.share_group == "handlers"
+    assert (mqtt_settings.partition_count, mqtt_settings.partition_index) == (3, 2)
+
+    for key, value, error in (
+        ("share_group", "a/b", "share_group must be a name"),
+        ("protocol_version", "3.1.1", "share_group needs protocol_version 5"),
+        ("partition_count", 0, "partition_count"),
+        ("partition_index", 3, "partition_index"),
+        ("partition_index", -1, "partition_index"),
+    ):
+        c = deepcopy(config)
+        c["mqtt_settings"][key] = value
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(c)
+        assert error in str(ex.value)
+
+
+def test_mqtt_manual_ack():
+    config = path_to_yaml_data(_config_path())
+
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert (mqtt_settings.qos, mqtt_settings.manual_ack) == (0, False)
+    assert mqtt_settings.max_inflight == 100
+    assert mqtt_settings.client_id is None
+
+    # Under MQTT 3.1.1, the broker's own in-flight limit applies
+    config["mqtt_settings"].update(qos=1, manual_ack=True, client_id="handler-1")
+    _validate_config(config)
+    config["mqtt_settings"].update(max_inflight=20, protocol_version=5)
+    _validate_config(config)
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert (mqtt_settings.qos, mqtt_settings.manual_ack) == (1, True)
+    assert mqtt_settings.max_inflight == 20
+    assert mqtt_settings.client_id == "handler-1"
+
+    for key, value, error in (
+        ("qos", 3, "qos must be 0, 1 or 2"),
+        ("qos", 0, "manual_ack needs qos 1 or 2"),
+        ("manual_ack", "yes", "manual_ack must be true or false"),
+        ("max_inflight", 0, "max_inflight"),
+        ("max_inflight", 65536, "max_inflight"),
+        ("client_id", 7, "client_id must be a string"),
+        ("protocol_version", "3.1.1", "max_inflight needs protocol_version 5"),
+    ):
+        c = deepcopy(config)
+        c["mqtt_settings"][key] = value
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(c)
+        assert error in str(ex.value)
+
+
+def test_mqtt_error_queue_size():
+    config = path_to_yaml_data(_config_path())
+    assert _mqtt_settings_from_yaml_data(config).error_queue_size == 1000
+
+    assert _mqtt_settings_from_yaml_data(config).shared_connection is False
+
+    config["mqtt_settings"]["error_queue_size"] = 50
+    config["mqtt_settings"]["shared_connection"] = True
+    _validate_config(config)
+    assert _mqtt_settings_from_yaml_data(config).error_queue_size == 50
+    assert _mqtt_settings_from_yaml_data(config).shared_connection is True
+
+    config["mqtt_settings"]["error_queue_size"] = 0
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(config)
+    assert "error_queue_size" in str(ex.value)
+
+
+def test_mqtt_error_aggregation():
+    config = path_to_yaml_data(_config_path())
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert (mqtt_settings.error_window, mqtt_settings.error_rate) == (0, 0)
+    assert mqtt_settings.error_burst == 10
+
+    config["mqtt_settings"].update(error_window=30, error_rate=0.5, error_burst=5)
+    _validate_config(config)
+    mqtt_settings = _mqtt_settings_from_yaml_data(config)
+    assert (mqtt_settings.error_window, mqtt_settings.error_rate) == (30, 0.5)
+    assert mqtt_settings.error_burst == 5
+
+    for key, value in (
+        ("error_window", -1),
+        ("error_rate", "fast"),
+        ("error_burst", 0),
+    ):
+        c = deepcopy(config)
+        c["mqtt_settings"][key] = value
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(c)
+        assert key in str(ex.value)
+
+
 def test_able_to_get_modbus_settings():
     configuration = Configuration.from_file(_config_path())
 
@@ -125,6 +341,135 @@ def test_able_to_get_modbus_settings():
 
     assert modbus_settings.port == 8080
     assert modbus_settings.host == "modbus.host"
+    assert modbus_settings.persistent_connection is False
+
+    config = path_to_yaml_data(_config_path())
+    config["modbus_settings"]["persistent_connection"] = True
+    config["modbus_settings"]["reconnect_delay_max"] = 5
+    modbus_settings = app.configuration._modbus_settings_from_yaml_data(config)
+    assert modbus_settings.persistent_connection is True
+    assert modbus_settings.reconnect_delay == 0.5
+    assert modbus_settings.reconnect_delay_max == 5
+    assert modbus_settings.write_cache_max_age == 0
+    assert modbus_settings.payload_cache_size == 1024
+
+    config["modbus_settings"]["payload_cache_size"] = 0
+    _validate_config(config)
+    assert _modbus_settings_from_yaml_data(config).payload_cache_size == 0
+
+    config["modbus_settings"]["payload_cache_size"] = -1
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(config)
+    assert "payload_cache_size" in str(ex.value)
+    del config["modbus_settings"]["payload_cache_size"]
+
+    config["modbus_settings"]["write_cache_max_age"] = -1
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(config)
+    assert "write_cache_max_age" in str(ex.value)
+    del config["modbus_settings"]["write_cache_max_age"]
+
+    for key, value in (
+        ("max_coils_per_write", 0),
+        ("max_coils_per_write", 1969),
+        ("reconnect_delay", 0),
+        ("reconnect_delay_max", -1),
+        ("reconnect_delay", 10),
+        ("unit_id", 256),
+        ("unit_id", "1"),
+    ):
+        c = deepcopy(config)
+        c["modbus_settings"][key] = value
+        with pytest.raises(ConfigurationFileInvalidError) as ex:
+            _validate_config(c)
+        assert key in str(ex.value)
+
+    config["modbus_settings"]["max_coils_per_write"] = 1968
+    config["modbus_settings"]["reconnect_delay"] = 5
+    config["modbus_settings"]["unit_id"] = 0
+    _validate_config(config)
+
+
+def test_modbus_devices():
+    config = path_to_yaml_data(_config_path())
+    config["modbus_settings"]["unit_id"] = 2
+    config["modbus_settings"]["devices"] = [
+        {"name": "meter", "host": "10.0.0.5", "port": 502, "unit_id": 3},
+        {"name": "inverter", "host": "10.0.0.6", "port": 503},
+    ]
+    config["modbus_mapping"]["coils"][0]["device"] = "meter"
+    config["modbus_mapping"]["holding_registers"][0]["device"] = "inverter"
+    _validate_config(config)
+
+    modbus_settings = app.configuration._modbus_settings_from_yaml_data(config)
+    assert modbus_settings.get_device() == ModbusDevice(
+        DEFAULT_DEVICE, "modbus.host", 8080, 2
+    )
+    assert modbus_settings.get_device("meter") == ModbusDevice(
+        "meter", "10.0.0.5", 502, 3
+    )
+    assert modbus_settings.get_device("inverter").unit_id == 1
+    assert len(modbus_settings.get_devices()) == 3
+
+    coils = app.configuration._coils_data_from_yaml_data(config)
+    assert coils[0].device == "meter"
+    assert coils[1].device is None
+    registers = app.configuration._holding_register_from_yaml_data(config)
+    assert registers[0].device == "inverter"
+
+    unknown_device = deepcopy(config)
+    unknown_device["modbus_mapping"]["coils"][0]["device"] = "nosuchdevice"
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(unknown_device)
+    assert "unknown device 'nosuchdevice'" in str(ex.value)
+
+    duplicate_device = deepcopy(config)
+    duplicate_device["modbus_settings"]["devices"][1]["name"] = "meter"
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(duplicate_device)
+    assert "duplicate name 'meter'" in str(ex.value)
+
+    no_host = deepcopy(config)
+    del no_host["modbus_settings"]["devices"][0]["host"]
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(no_host)
+    assert "'host'" in str(ex.value)
+
+    bad_unit_id = deepcopy(config)
+    bad_unit_id["modbus_settings"]["devices"][0]["unit_id"] = -1
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(bad_unit_id)
+    assert "unit_id" in str(ex.value)
+
+
+def test_able_to_get_queue_settings():
+    configuration = Configuration.from_file(_config_path())
+    queue_settings = configuration.get_queue_settings()
+    assert queue_settings.enabled is False
+    assert queue_settings.capacity == 1000
+
+    config = path_to_yaml_data(_config_path())
+    config["queue_settings"] = {
+        "enabled": True,
+        "capacity": 10,
+        "overflow_policy": "drop_oldest",
+    }
+    _validate_config(config)
+    queue_settings = app.configuration._queue_settings_from_yaml_data(config)
+    assert queue_settings.enabled is True
+    assert queue_settings.capacity == 10
+    assert queue_settings.overflow_policy == "drop_oldest"
+    assert queue_settings.workers == 1
+
+    config["queue_settings"]["overflow_policy"] = "drop_everything"
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(config)
+    assert "overflow_policy" in str(ex.value)
+
+    config["queue_settings"] = {"capacity": 0}
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(config)
+    assert "capacity" in str(ex.value)
 
 
 def test_able_to_get_site():
@@ -227,6 +572,12 @@ def test_validate_config_data():
         _validate_config(inverting_unsigned_int)
     assert "cannot set invert_sign=True" in str(ex.value)
 
+    unknown_data_type = deepcopy(config)
+    unknown_data_type["modbus_mapping"]["holding_registers"][0]["data_type"] = "FOO"
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _validate_config(unknown_data_type)
+    assert "unknown data_type 'FOO'" in str(ex.value)
+
 
 def test_key_error_in_config_parsing(monkeypatch):
     """
@@ -282,3 +633,35 @@ def test_read_settings_from_env():
     )
     os.environ["SITE_NAME"] = ""
     os.environ["SERIAL_NUMBER"] = ""
+
+
+def test_env_var_types(monkeypatch):
+    monkeypatch.setenv("MQTT_PORT", "1884")
+    monkeypatch.setenv("SITE_NAME", "007")
+    config = _interpolate_environment_vars(
+        {
+            "mqtt_settings": {
+                "port": "${MQTT_PORT}",
+                "command_topic": "commands/${SITE_NAME}/#",
+                "addresses": ["${MQTT_PORT}"],
+            }
+        }
+    )
+    # A value that is only a variable is read as YAML, one that contains one stays a string
+    assert config == {
+        "mqtt_settings": {
+            "port": 1884,
+            "command_topic": "commands/007/#",
+            "addresses": [1884],
+        }
+    }
+
+
+def test_missing_env_var_in_document_order(monkeypatch):
+    monkeypatch.delenv("SITE_NAME", raising=False)
+    monkeypatch.delenv("MQTT_HOST", raising=False)
+    with pytest.raises(ConfigurationFileInvalidError) as ex:
+        _interpolate_environment_vars(
+            {"mqtt_settings": {"host": "${MQTT_HOST}"}, "site": "${SITE_NAME}"}
+        )
+    assert "'MQTT_HOST'" in str(ex.value)